@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks of pastefile.
+
+Seeds a db with --entries files, then measures the throughput and the
+p50/p99 latency of uploads, downloads, /infos, /ls and clean_files, with
+the flask test client (--mode client) and/or against a multi-process WSGI
+server on localhost (--mode server).
+
+    ./benchmarks/bench.py --entries 10000 --concurrency 1,8 --save baseline.json
+    ./benchmarks/bench.py --entries 10000 --concurrency 1,8 --baseline baseline.json
+
+With --baseline, the exit code is 1 if a p99 latency or a throughput is
+worse than the baseline by more than --tolerance."""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import Queue
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import uuid
+from StringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CONFIG = """UPLOAD_FOLDER = "%(root)s/files"
+FILE_LIST = "%(root)s/uploaded_files_jsondb"
+TMP_FOLDER = "%(root)s/tmp"
+LOG = "%(root)s/pastefile.log"
+EXPIRE = 86400
+DISABLED_FEATURE = []
+CLEAN_MODE = "cron"
+DB_BACKEND = "%(backend)s"
+DB_JOURNAL = %(journal)s
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark pastefile')
+    parser.add_argument('--entries', type=int, default=10000,
+                        help='files in the seeded db, default: 10000')
+    parser.add_argument('--expired', type=float, default=0.1,
+                        help='part of the seeded files already expired, default: 0.1')
+    parser.add_argument('--sizes', default='1024,1048576',
+                        help='comma separated sizes of the uploaded files, '
+                             'default: 1024,1048576')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per endpoint, default: 200')
+    parser.add_argument('--ls-requests', type=int, default=20,
+                        help='requests of the whole /ls, default: 20')
+    parser.add_argument('--concurrency', default='1,8',
+                        help='comma separated numbers of concurrent clients, '
+                             'default: 1,8')
+    parser.add_argument('--mode', choices=['client', 'server', 'both'],
+                        default='client',
+                        help='flask test client, WSGI server on localhost, '
+                             'or both. default: client')
+    parser.add_argument('--server', choices=['werkzeug', 'uwsgi'],
+                        default='werkzeug',
+                        help='WSGI server of --mode server, default: werkzeug')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='processes of the WSGI server, default: 4')
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json',
+                        help='DB_BACKEND, default: json')
+    parser.add_argument('--journal', action='store_true',
+                        help='DB_JOURNAL = True')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, default: 0')
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--baseline', help='compare to the results saved in this file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed regression against the baseline, default: 0.2')
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(',')]
+    args.concurrency = [int(c) for c in args.concurrency.split(',')]
+    return args
+
+
+def setup_instance(args):
+    "Create the directories and the config of a pastefile instance, return its root"
+    root = tempfile.mkdtemp(prefix='pastefile-bench-')
+    for directory in ['files', 'tmp']:
+        os.makedirs(os.path.join(root, directory))
+    config_file = os.path.join(root, 'pastefile.cfg')
+    with open(config_file, 'w') as f:
+        f.write(CONFIG % {'root': root, 'backend': args.backend,
+                          'journal': args.journal})
+    os.environ['PASTEFILE_SETTINGS'] = config_file
+    return root
+
+
+def seed(config, entries, expired, rnd):
+    "Add entries small files in the db, the expired part of them already expired"
+    from pastefile import controller
+    now = int(time.time())
+    with controller.open_db(dbfile=config['FILE_LIST'], config=config) as db:
+        for i in range(entries):
+            content = 'pastefile benchmark %d\n' % i
+            md5 = hashlib.md5(content).hexdigest()
+            dest = controller.storage_path(md5, config)
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            with open(dest, 'w') as f:
+                f.write(content)
+            if rnd.random() < expired:
+                timestamp = now - int(config['EXPIRE']) - rnd.randint(1, 3600)
+            else:
+                timestamp = now - rnd.randint(0, int(config['EXPIRE']) - 3600)
+            db.write(md5, {
+                'real_name': 'seed-%d.txt' % i,
+                'type': 'ASCII text',
+                'mime_type': 'text/plain',
+                'storage_full_filename': dest,
+                'timestamp': timestamp,
+                'burn_after_read': 'False',
+                'size': len(content),
+            })
+
+
+class TestClient(object):
+    "Requests through the flask test client, one per thread"
+
+    def __init__(self, app):
+        self._app = app
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self._app.test_client()
+        return self._local.client
+
+    def upload(self, name, content):
+        rv = self._client().post('/', data={'file': (StringIO(content), name)})
+        return rv.status_code, rv.get_data()
+
+    def get(self, path):
+        rv = self._client().get(path, headers={'User-Agent': 'curl'})
+        return rv.status_code, rv.get_data()
+
+
+class HttpClient(object):
+    "Requests to a server on localhost"
+
+    def __init__(self, base_url):
+        self._base_url = base_url
+
+    def _open(self, request):
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            return e.code, e.read()
+        return response.getcode(), response.read()
+
+    def upload(self, name, content):
+        boundary = uuid.uuid4().hex
+        body = ('--%s\r\nContent-Disposition: form-data; name="file"; '
+                'filename="%s"\r\nContent-Type: application/octet-stream\r\n\r\n'
+                '%s\r\n--%s--\r\n' % (boundary, name, content, boundary))
+        return self._open(urllib2.Request(
+            '%s/' % self._base_url, body,
+            {'Content-Type': 'multipart/form-data; boundary=%s' % boundary,
+             'User-Agent': 'curl'}))
+
+    def get(self, path):
+        return self._open(urllib2.Request('%s%s' % (self._base_url, path),
+                                          headers={'User-Agent': 'curl'}))
+
+
+def _serve_werkzeug(port, workers):
+    from werkzeug.serving import run_simple
+    from pastefile.app import app
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    run_simple('127.0.0.1', port, app, processes=workers, threaded=False,
+               use_reloader=False)
+
+
+def start_server(args):
+    "Start the WSGI server, return the url and a function stopping it"
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    if args.server == 'uwsgi':
+        server = subprocess.Popen(
+            ['uwsgi', '--http', '127.0.0.1:%d' % port, '--module', 'pastefile.app:app',
+             '--chdir', ROOT, '--processes', str(args.workers), '--master',
+             '--disable-logging', '--env',
+             'PASTEFILE_SETTINGS=%s' % os.environ['PASTEFILE_SETTINGS']],
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        stop = server.terminate
+    else:
+        server = multiprocessing.Process(target=_serve_werkzeug,
+                                         args=(port, args.workers))
+        server.daemon = True
+        server.start()
+        stop = server.terminate
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except socket.error:
+            time.sleep(0.1)
+    else:
+        stop()
+        raise RuntimeError('The server did not start')
+    return 'http://127.0.0.1:%d' % port, stop
+
+
+def percentile(latencies, p):
+    "Nearest rank percentile of sorted latencies"
+    if not latencies:
+        return 0.0
+    return latencies[max(int(math.ceil(p / 100.0 * len(latencies))) - 1, 0)]
+
+
+def run(requests, concurrency):
+    """Run the requests (callables returning the status code) with
+       concurrency threads, return their statistics"""
+    todo = Queue.Queue()
+    for request in requests:
+        todo.put(request)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                request = todo.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                status = request()
+            except Exception:
+                status = None
+            latency = time.time() - start
+            with lock:
+                latencies.append(latency)
+                if status not in (200, 206, 304):
+                    errors[0] += 1
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def bench_endpoints(mode, client, seeded, args, rnd):
+    "Return the results of the endpoints for every size and concurrency"
+    results = []
+
+    def add(op, size, concurrency, requests):
+        result = run(requests, concurrency)
+        result.update({'mode': mode, 'op': op, 'size': size,
+                       'concurrency': concurrency})
+        results.append(result)
+        print_result(result)
+
+    for concurrency in args.concurrency:
+        for size in args.sizes:
+            block = os.urandom(size)
+            uploaded = []
+
+            def upload(content):
+                status, data = client.upload('bench.bin', content)
+                uploaded.append(data.strip().rsplit('/', 1)[-1])
+                return status
+            # Every upload is a new file
+            add('upload', size, concurrency,
+                [lambda content=uuid.uuid4().hex + block[32:]: upload(content)
+                 for i in range(args.requests)])
+            add('download', size, concurrency,
+                [lambda md5=rnd.choice(uploaded): client.get('/%s' % md5)[0]
+                 for i in range(args.requests)])
+
+        add('infos', 0, concurrency,
+            [lambda md5=rnd.choice(seeded): client.get('/%s/infos' % md5)[0]
+             for i in range(args.requests)])
+        add('ls_page', 0, concurrency,
+            [lambda: client.get('/ls?limit=100')[0] for i in range(args.requests)])
+        add('ls', 0, concurrency,
+            [lambda: client.get('/ls')[0] for i in range(args.ls_requests)])
+    return results
+
+
+def bench_clean(mode, config):
+    "Remove the expired seeded files once"
+    from pastefile import controller
+    result = run([lambda: controller.clean_files(dbfile=config['FILE_LIST'],
+                                                 expire=config['EXPIRE'],
+                                                 config=config) is not False and 200],
+                 1)
+    result.update({'mode': mode, 'op': 'clean_files', 'size': 0, 'concurrency': 1})
+    print_result(result)
+    return result
+
+
+def result_key(result):
+    return '%(mode)s/%(op)s/%(size)d/c%(concurrency)d' % result
+
+
+def print_result(result):
+    print('%-40s %6d req %4d err %9.1f req/s  p50 %8.2fms  p99 %8.2fms'
+          % (result_key(result), result['requests'], result['errors'],
+             result['throughput'], result['p50'] * 1000, result['p99'] * 1000))
+    sys.stdout.flush()
+
+
+def compare(results, baseline, tolerance):
+    "Print the regressions against the baseline, return how many were found"
+    previous = dict((result_key(result), result) for result in baseline['results'])
+    regressions = 0
+    for result in results:
+        base = previous.get(result_key(result))
+        if base is None:
+            continue
+        problems = []
+        if result['p99'] > base['p99'] * (1 + tolerance):
+            problems.append('p99 %.2fms -> %.2fms' % (base['p99'] * 1000,
+                                                      result['p99'] * 1000))
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            problems.append('throughput %.1f -> %.1f req/s' % (base['throughput'],
+                                                              result['throughput']))
+        if result['errors'] > base['errors']:
+            problems.append('errors %d -> %d' % (base['errors'], result['errors']))
+        if problems:
+            regressions += 1
+            print('REGRESSION %s: %s' % (result_key(result), ', '.join(problems)))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    rnd = random.Random(args.seed)
+    root = setup_instance(args)
+    try:
+        from pastefile.app import app
+        app.logger.setLevel(logging.WARNING)
+        config = app.config
+        seed(config, args.entries, args.expired, rnd)
+        from pastefile import controller
+        db = controller.open_db(dbfile=config['FILE_LIST'], config=config)
+        db.load()
+        seeded = sorted(k for k, v in db.iteritems())
+
+        results = []
+        if args.mode in ('client', 'both'):
+            results.extend(bench_endpoints('client', TestClient(app), seeded, args, rnd))
+        if args.mode in ('server', 'both'):
+            base_url, stop = start_server(args)
+            try:
+                results.extend(bench_endpoints('server', HttpClient(base_url),
+                                               seeded, args, rnd))
+            finally:
+                stop()
+        results.append(bench_clean(args.mode, config))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'entries': args.entries,
+                       'backend': args.backend,
+                       'journal': args.journal,
+                       'python': sys.version.split()[0],
+                       'timestamp': int(time.time()),
+                       'results': results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
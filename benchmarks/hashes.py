@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Throughput of the algorithms of HASH_ALGORITHM.
+
+Hashes --size random bytes with each algorithm and chunk size, and with
+--threads threads at once to check the hash releases the GIL.
+
+    ./benchmarks/hashes.py --size 256 --chunks 65536,1048576"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pastefile import utils
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the hash algorithms')
+    parser.add_argument('--algorithms', default='md5,sha1,sha256,blake2b,blake2s',
+                        help='comma separated, default: md5,sha1,sha256,blake2b,blake2s')
+    parser.add_argument('--size', type=int, default=256,
+                        help='MiB hashed by each thread, default: 256')
+    parser.add_argument('--chunks', default='65536,1048576',
+                        help='comma separated chunk sizes, default: 65536,1048576')
+    parser.add_argument('--threads', default='1,4',
+                        help='comma separated number of threads, default: 1,4')
+    return parser.parse_args()
+
+
+def hash_data(algorithm, data, size):
+    digest = utils.new_hash(algorithm)
+    for _ in range(size / len(data)):
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def run(algorithm, chunksize, threads, size):
+    "Return the MB/s of threads threads hashing size bytes each"
+    data = os.urandom(chunksize)
+    workers = [threading.Thread(target=hash_data, args=(algorithm, data, size))
+               for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * size / 2.0**20 / (time.time() - start)
+
+
+def main():
+    args = parse_args()
+    size = args.size * 2**20
+    print '%-10s %10s %8s %10s' % ('algorithm', 'chunk', 'threads', 'MB/s')
+    for algorithm in args.algorithms.split(','):
+        try:
+            utils.new_hash(algorithm)
+        except ValueError as e:
+            print '%-10s unsupported: %s' % (algorithm, e)
+            continue
+        for chunksize in [int(c) for c in args.chunks.split(',')]:
+            for threads in [int(t) for t in args.threads.split(',')]:
+                print '%-10s %10d %8d %10.1f' % (
+                    algorithm, chunksize, threads,
+                    run(algorithm, chunksize, threads, size))
+
+
+if __name__ == '__main__':
+    main()
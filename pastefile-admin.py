@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import os
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config",
+                        help="specify config file,"
+                             "default: /etc/pastefile.cfg",
+                        default='/etc/pastefile.cfg')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('clean',
+                          help='remove the expired files, '
+                               'to be run from cron or an uwsgi timer')
+    subparsers.add_parser('purge',
+                          help='remove from the db the files missing on disk')
+    subparsers.add_parser('backfill',
+                          help='store in the db the size of the files '
+                               'uploaded by older versions')
+    migrate = subparsers.add_parser('migrate',
+                                    help='move the stored files to the '
+                                         'UPLOAD_FOLDER_LEVELS layout, or '
+                                         'to the s3 storage')
+    migrate.add_argument('--batch-size', type=int, default=1000,
+                         help='number of files moved per db lock, '
+                              'default: 1000')
+
+    args = parser.parse_args()
+    os.environ["PASTEFILE_SETTINGS"] = args.config
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    from pastefile.app import app
+    from pastefile import controller
+    from pastefile import scheduler
+    if args.command == 'clean':
+        scheduler.run_maintenance(config=app.config)
+    elif args.command == 'purge':
+        controller.db_purge(dbfile=app.config['FILE_LIST'], config=app.config)
+    elif args.command == 'backfill':
+        controller.backfill_files(dbfile=app.config['FILE_LIST'], config=app.config)
+    elif args.command == 'migrate':
+        controller.migrate_files(dbfile=app.config['FILE_LIST'], config=app.config,
+                                 batch_size=args.batch_size)
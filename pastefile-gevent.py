@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# The threads are not patched: the blocking work runs in real threads
+from gevent import monkey
+monkey.patch_all(thread=False)
+
+import argparse
+import os
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Serve pastefile with gevent')
+    parser.add_argument("-c", "--config",
+                        help="specify config file,"
+                             "default: /etc/pastefile.cfg",
+                        default='/etc/pastefile.cfg')
+    parser.add_argument("--host", default='0.0.0.0',
+                        help="listen address, default: 0.0.0.0")
+    parser.add_argument("--port", type=int,
+                        help="listen port, default: DEBUG_PORT of the config")
+    parser.add_argument("--threads", type=int, default=10,
+                        help="threads running the blocking work, default: 10")
+    parser.add_argument("--connections", type=int, default=10000,
+                        help="max concurrent connections, default: 10000")
+
+    args = parser.parse_args()
+    os.environ["PASTEFILE_SETTINGS"] = args.config
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+    from pastefile.app import app
+    from pastefile import asyncserver
+    asyncserver.serve(app, host=args.host,
+                      port=args.port or int(app.config['DEBUG_PORT']),
+                      threads=args.threads,
+                      connections=args.connections)
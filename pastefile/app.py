@@ -2,13 +2,38 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
 import logging
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Request, request, abort, jsonify, g
 from flask import render_template
 from pastefile import utils
+from pastefile import archives
 from pastefile import controller
+from pastefile import scheduler
+from pastefile import sessions
+from pastefile import stats
+from pastefile import metrics
+
+
+class PastefileRequest(Request):
+    _last_upload = None
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        # A file is complete when the next one starts: its type is detected
+        # and its first bytes released, so that a request with many files
+        # only keeps the first bytes of one of them
+        if self._last_upload is not None:
+            utils.run_blocking(self._last_upload.release_head)
+        # Uploaded files are written in TMP_FOLDER and hashed as they are
+        # received, so they are never read back from the disk
+        self._last_upload = utils.SpooledUpload(dest_dir=app.config['TMP_FOLDER'],
+                                                algorithm=app.config['HASH_ALGORITHM'])
+        return self._last_upload
+
 
 app = Flask("pastefile")
+app.request_class = PastefileRequest
 LOG = app.logger
 LOG.setLevel(logging.DEBUG)
 hdl_stream = logging.StreamHandler()
@@ -22,11 +47,35 @@ def init_default_configuration(_app):
     _app.config.setdefault('UPLOAD_FOLDER', "/opt/pastefile/files")
     _app.config.setdefault('FILE_LIST', "/opt/pastefile/uploaded_files_jsondb")
     _app.config.setdefault('TMP_FOLDER', "/opt/pastefile/tmp")
+    _app.config.setdefault('UPLOAD_FOLDER_LEVELS', 0)
     _app.config.setdefault('EXPIRE',  "86400")
     _app.config.setdefault('DEBUG_PORT',  "5000")
     _app.config.setdefault('LOG', "/opt/pastefile/pastefile.log")
     _app.config.setdefault('DISABLED_FEATURE', [])
     _app.config.setdefault('DISPLAY_FOR', ['chrome', 'firefox'])
+    _app.config.setdefault('DB_BACKEND', 'json')
+    _app.config.setdefault('DB_JOURNAL', False)
+    _app.config.setdefault('DB_JOURNAL_COMPACT_SIZE', 1048576)
+    _app.config.setdefault('DB_LOCK_TIMEOUT', 10)
+    _app.config.setdefault('CLEAN_MODE', 'thread')
+    _app.config.setdefault('CLEAN_INTERVAL', 60)
+    _app.config.setdefault('UPLOAD_SESSION_EXPIRE', 86400)
+    _app.config.setdefault('WORKER_THREADS', 4)
+    _app.config.setdefault('HASH_ALGORITHM', 'md5')
+    _app.config.setdefault('MAX_STORAGE_BYTES', None)
+    _app.config.setdefault('MAX_FILES', None)
+    _app.config.setdefault('SENDFILE_MODE', None)
+    _app.config.setdefault('SENDFILE_PREFIX', '/_pastefile_files')
+    _app.config.setdefault('COMPRESS', {})
+    _app.config.setdefault('METRICS_FOLDER', None)
+    _app.config.setdefault('STORAGE_BACKEND', 'local')
+    _app.config.setdefault('S3_BUCKET', None)
+    _app.config.setdefault('S3_PREFIX', '')
+    _app.config.setdefault('S3_ENDPOINT_URL', None)
+    _app.config.setdefault('S3_REGION', None)
+    _app.config.setdefault('S3_ACCESS_KEY', None)
+    _app.config.setdefault('S3_SECRET_KEY', None)
+    _app.config.setdefault('S3_MULTIPART_SIZE', 8 * 2**20)
 
 
 def init_check_directories(_app):
@@ -61,6 +110,12 @@ except RuntimeError:
     LOG.error('PASTEFILE_SETTINGS envvar is not set')
     exit(1)
 
+try:
+    utils.new_hash(app.config['HASH_ALGORITHM'])
+except ValueError as e:
+    LOG.error("Unsupported HASH_ALGORITHM: %s" % e)
+    exit(1)
+
 
 try:
     if os.environ['TESTING'] == 'TRUE':
@@ -77,17 +132,87 @@ except KeyError:
     pass
 
 
+def clean_files_in_request():
+    "With CLEAN_MODE = 'request', expired files are removed by the requests"
+    if app.config['CLEAN_MODE'] == 'request':
+        utils.run_blocking(controller.clean_files,
+                           dbfile=app.config['FILE_LIST'],
+                           expire=app.config['EXPIRE'],
+                           config=app.config)
+
+
+@app.before_first_request
+def start_maintenance():
+    # Started in the worker that serves requests, after uwsgi forked it
+    if app.config['CLEAN_MODE'] != 'thread':
+        return
+    if not scheduler.threads_enabled():
+        LOG.warning("[CLEAN] uwsgi threads are disabled (enable-threads), "
+                    "expired files are removed by the requests instead")
+        app.config['CLEAN_MODE'] = 'request'
+        return
+    scheduler.start_maintenance_thread(config=app.config)
+
+
+@app.before_request
+def start_timer():
+    g.start = time.time()
+
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule else 'none'
+    stats.observe('request_duration_seconds', time.time() - g.start,
+                  route=route, method=request.method,
+                  status=str(response.status_code))
+    metrics.dump_process(config=app.config)
+    return response
+
+
 @app.route('/', methods=['GET', 'POST'])
 def upload_file():
     if request.method == 'POST':
-        controller.clean_files(dbfile=app.config['FILE_LIST'],
-                               expire=app.config['EXPIRE'])
+        clean_files_in_request()
         return controller.upload_file(request=request, config=app.config)
     else:
         # In case no file, return help
         return abort(404)
 
 
+@app.route('/uploads', methods=['POST'])
+def create_upload_session():
+    status = sessions.create_session(request=request, config=app.config)
+    if status is None:
+        return 'Missing or invalid size\n', 400
+    return jsonify(status)
+
+
+@app.route('/uploads/<session_id>', methods=['GET', 'PUT', 'POST', 'DELETE'])
+def upload_session(session_id):
+    if request.method == 'GET':
+        result = sessions.get_session(session_id=session_id,
+                                      request=request,
+                                      config=app.config)
+    elif request.method == 'PUT':
+        result = sessions.put_chunk(session_id=session_id,
+                                    request=request,
+                                    config=app.config)
+    elif request.method == 'POST':
+        result = sessions.finalize_session(session_id=session_id,
+                                           request=request,
+                                           config=app.config)
+    else:
+        result = sessions.delete_session(session_id=session_id,
+                                         config=app.config)
+        if result:
+            result = 'Upload session %s deleted\n' % session_id
+    if not result:
+        return abort(404)
+    if isinstance(result, dict):
+        return jsonify(result)
+    return result
+
+
 @app.route('/<id_file>/infos', methods=['GET'])
 def display_file_infos(id_file):
     file_infos = controller.get_file_info(id_file=id_file,
@@ -98,6 +223,13 @@ def display_file_infos(id_file):
     return jsonify(file_infos)
 
 
+@app.route('/<id_file>/exists', methods=['GET'])
+def file_exists(id_file):
+    if not controller.file_exists(id_file=id_file, config=app.config):
+        return abort(404)
+    return "%s/%s\n" % (utils.build_base_url(env=request.environ), id_file)
+
+
 @app.route('/<id_file>', methods=['GET', 'DELETE'])
 def get_or_delete_file(id_file):
     if request.method == 'GET':
@@ -113,7 +245,64 @@ def get_or_delete_file(id_file):
             pass
         return controller.delete_file(request=request,
                                       id_file=id_file,
-                                      dbfile=app.config['FILE_LIST'])
+                                      dbfile=app.config['FILE_LIST'],
+                                      config=app.config)
+
+
+def request_ids():
+    "Ids of a bulk request: a json list, or the id form fields"
+    ids = request.get_json(silent=True)
+    if ids is None:
+        ids = request.form.getlist('id')
+    if not isinstance(ids, list) or \
+            not all(isinstance(id_file, basestring) for id_file in ids):
+        return None
+    return ids
+
+
+@app.route('/infos', methods=['POST'])
+def display_files_infos():
+    ids = request_ids()
+    if ids is None:
+        return 'Expected a json list of ids\n', 400
+    return jsonify(controller.get_files_info(ids=ids,
+                                             config=app.config,
+                                             env=request.environ))
+
+
+@app.route('/delete', methods=['POST'])
+def delete_files():
+    try:
+        if 'delete' in app.config['DISABLED_FEATURE']:
+            LOG.info("[delete] Tried to call delete but this url is disabled")
+            return 'Administrator disabled the delete option.\n'
+    except (KeyError, TypeError):
+        pass
+    ids = request_ids()
+    if ids is None:
+        return 'Expected a json list of ids\n', 400
+    result = controller.delete_files(request=request, ids=ids, config=app.config)
+    if result is None:
+        return 'Lock timed out\n', 503
+    return jsonify(result)
+
+
+@app.route('/archive', methods=['GET', 'POST'])
+def get_archive():
+    if request.method == 'GET':
+        ids = request.args.getlist('id')
+    else:
+        ids = request_ids()
+    if not ids:
+        return 'Expected a json list of ids\n', 400
+    archive_format = request.args.get('format', 'tar')
+    if archive_format not in archives.FORMATS:
+        return 'Unknown format %s, expected one of %s\n' % (
+            archive_format, ', '.join(sorted(archives.FORMATS))), 400
+    return controller.get_archive(request=request,
+                                  ids=ids,
+                                  archive_format=archive_format,
+                                  config=app.config)
 
 
 @app.route('/ls', methods=['GET'])
@@ -125,10 +314,21 @@ def list_all_files():
     except (KeyError, TypeError):
         pass
 
-    controller.clean_files(dbfile=app.config['FILE_LIST'],
-                           expire=app.config['EXPIRE'])
+    clean_files_in_request()
+
+    return controller.list_files(request=request, config=app.config)
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    try:
+        if 'metrics' in app.config['DISABLED_FEATURE']:
+            LOG.info("[METRICS] Tried to call /metrics but this url is disabled")
+            return 'Administrator disabled the /metrics option.\n'
+    except (KeyError, TypeError):
+        pass
 
-    return jsonify(controller.get_all_files(request=request, config=app.config))
+    return metrics.metrics_response(config=app.config)
 
 
 @app.errorhandler(404)
@@ -140,8 +340,18 @@ def page_not_found(e):
       ("Upload a file:", "curl %s -F file=@**filename**" % base_url),
       ("View all uploaded files:", "curl %s/ls" % base_url),
       ("Get infos about one file:", "curl %s/**file_id**/infos" % base_url),
+      ("Check if a file is already uploaded:", "curl %s/**md5**/exists" % base_url),
       ("Get a file:", "curl -JO %s/**file_id**" % base_url),
       ("Delete a file:", "curl -XDELETE %s/**id**" % base_url),
+      ("Get infos about several files:",
+       "curl %s/infos -H 'Content-Type: application/json' -d '[\"**id**\", \"**id**\"]'" % base_url),
+      ("Delete several files:", "curl %s/delete -d id=**id** -d id=**id**" % base_url),
+      ("Get several files in a tar or zip archive:",
+       "curl -JO '%s/archive?format=zip&id=**id**&id=**id**'" % base_url),
+      ("Start a resumable upload:", "curl %s/uploads -F size=**bytes** -F filename=**filename**" % base_url),
+      ("Send a chunk of a resumable upload:",
+       "curl -XPUT '%s/uploads/**session_id**?offset=**offset**' --data-binary @**chunk**" % base_url),
+      ("Finish a resumable upload:", "curl -XPOST %s/uploads/**session_id**" % base_url),
       ("Create an alias for cli usage", 'pastefile() { curl -F file=@"$1" %s; }' % base_url),
     )
     context = {'user_agent': request.headers.get('User-Agent', ''),
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tar and zip archives of several files, built while they are sent.
+
+A member is (name, size, mtime, chunks): chunks generates its content, and
+is only read when the archive reaches it, so the memory used does not
+depend on the size of the files. The size of the archive is known before
+it is sent. Zip members are stored without compression, and without the
+zip64 extensions: a zip archive is limited to ZIP_MAX bytes."""
+
+import time
+import stat
+import struct
+import tarfile
+import zlib
+
+FORMATS = {'tar': 'application/x-tar', 'zip': 'application/zip'}
+
+ZIP_MAX = 0xffffffff
+ZIP_MAX_MEMBERS = 0xffff
+
+# Data descriptor after the content (its crc is not known before),
+# utf-8 names
+_ZIP_FLAGS = 0x08 | 0x800
+_ZIP_VERSION = 20
+_ZIP_LOCAL = struct.Struct('<4sHHHHHLLLHH')
+_ZIP_DESCRIPTOR = struct.Struct('<4sLLL')
+_ZIP_CENTRAL = struct.Struct('<4sBBHHHHHLLLHHHHHLL')
+_ZIP_END = struct.Struct('<4sHHHHLLH')
+
+
+def _content(chunks, size):
+    "Generate the chunks, fail if they are not size bytes"
+    sent = 0
+    for chunk in chunks:
+        sent += len(chunk)
+        yield chunk
+    if sent != size:
+        raise IOError('%d bytes sent instead of %d' % (sent, size))
+
+
+def _tar_header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0644
+    return info.tobuf(format=tarfile.GNU_FORMAT, encoding='utf-8')
+
+
+def _tar_padding(size):
+    return -size % tarfile.BLOCKSIZE
+
+
+def _tar_end(size):
+    "Bytes of the end of archive blocks, and of the padding to a full record"
+    end = 2 * tarfile.BLOCKSIZE
+    return end + -(size + end) % tarfile.RECORDSIZE
+
+
+def tar_size(members):
+    size = sum(len(_tar_header(name, length, mtime)) + length + _tar_padding(length)
+               for name, length, mtime, chunks in members)
+    return size + _tar_end(size)
+
+
+def tar_stream(members):
+    size = 0
+    for name, length, mtime, chunks in members:
+        header = _tar_header(name, length, mtime)
+        yield header
+        for chunk in _content(chunks, length):
+            yield chunk
+        padding = _tar_padding(length)
+        if padding:
+            yield tarfile.NUL * padding
+        size += len(header) + length + padding
+    yield tarfile.NUL * _tar_end(size)
+
+
+def _dos_time(mtime):
+    "Date and time of a zip member, from 1980 (the oldest a zip can tell)"
+    t = time.localtime(max(mtime, 315532800))
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((max(t.tm_year, 1980) - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def _zip_name(name):
+    return name.encode('utf-8') if isinstance(name, unicode) else name
+
+
+def zip_size(members):
+    "Size of the zip archive, None if it would need zip64"
+    if len(members) > ZIP_MAX_MEMBERS:
+        return None
+    size = _ZIP_END.size
+    for name, length, mtime, chunks in members:
+        name = _zip_name(name)
+        size += (_ZIP_LOCAL.size + len(name) + length + _ZIP_DESCRIPTOR.size +
+                 _ZIP_CENTRAL.size + len(name))
+    if size > ZIP_MAX:
+        return None
+    return size
+
+
+def zip_stream(members):
+    central = []
+    offset = 0
+    for name, length, mtime, chunks in members:
+        name = _zip_name(name)
+        dos_time, dos_date = _dos_time(mtime)
+        header = _ZIP_LOCAL.pack('PK\x03\x04', _ZIP_VERSION, _ZIP_FLAGS, 0,
+                                 dos_time, dos_date, 0, length, length,
+                                 len(name), 0)
+        yield header + name
+        crc = 0
+        for chunk in _content(chunks, length):
+            crc = zlib.crc32(chunk, crc)
+            yield chunk
+        crc &= 0xffffffff
+        yield _ZIP_DESCRIPTOR.pack('PK\x07\x08', crc, length, length)
+        # Made by unix (3), for the permissions
+        central.append(_ZIP_CENTRAL.pack('PK\x01\x02', _ZIP_VERSION, 3,
+                                         _ZIP_VERSION, _ZIP_FLAGS, 0,
+                                         dos_time, dos_date, crc, length,
+                                         length, len(name), 0, 0, 0, 0,
+                                         (stat.S_IFREG | 0644) << 16,
+                                         offset) + name)
+        offset += len(header) + len(name) + length + _ZIP_DESCRIPTOR.size
+    central_size = sum(len(entry) for entry in central)
+    yield ''.join(central)
+    yield _ZIP_END.pack('PK\x05\x06', 0, 0, len(central), len(central),
+                        central_size, offset, 0)
+
+
+def size(archive_format, members):
+    "Size of the archive_format (tar or zip) archive, None if it can't be built"
+    if archive_format == 'zip':
+        return zip_size(members)
+    return tar_size(members)
+
+
+def stream(archive_format, members):
+    "Generate the archive_format (tar or zip) archive"
+    if archive_format == 'zip':
+        return zip_stream(members)
+    return tar_stream(members)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Serve pastefile with gevent, for many concurrent slow clients.
+
+Each connection is a greenlet: request and response bodies are streamed
+without holding a thread. The blocking work of the requests (db locks and
+parsing, type detection, compression, hashing a finalized upload session,
+reading the sent files) runs in a pool of threads, see utils.run_blocking.
+
+The process must be monkey patched before anything else is imported,
+without patching the threads: see pastefile-gevent.py."""
+
+import thread
+import logging
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from gevent.threadpool import ThreadPool
+from werkzeug.wsgi import FileWrapper
+from pastefile import utils
+from pastefile import jsondb
+
+LOG = logging.getLogger(__name__)
+
+# Bytes read at once from the sent files
+CHUNK_SIZE = 2**16
+
+_DONE = object()
+
+
+def _file_wrapper(f, buffer_size=8192):
+    return FileWrapper(f, max(buffer_size, CHUNK_SIZE))
+
+
+def _next_chunk(iterator):
+    try:
+        return iterator.next()
+    except StopIteration:
+        return _DONE
+
+
+class ThreadPoolIterator(object):
+    "Response body whose chunks are produced in the pool"
+
+    def __init__(self, pool, app_iter):
+        self._pool = pool
+        self._app_iter = app_iter
+        self._iterator = iter(app_iter)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        chunk = self._pool.apply(_next_chunk, (self._iterator,))
+        if chunk is _DONE:
+            raise StopIteration
+        return chunk
+
+    def close(self):
+        if hasattr(self._app_iter, 'close'):
+            self._app_iter.close()
+
+
+class AsyncMiddleware(object):
+    """Produce the response bodies in the pool, except the small ones
+       which are already built"""
+
+    def __init__(self, app, pool):
+        self._app = app
+        self._pool = pool
+
+    def __call__(self, environ, start_response):
+        environ['wsgi.file_wrapper'] = _file_wrapper
+        length = []
+
+        def _start_response(status, headers, exc_info=None):
+            length.extend(v for k, v in headers if k.lower() == 'content-length')
+            return start_response(status, headers, exc_info)
+
+        app_iter = self._app(environ, _start_response)
+        if length and int(length[0]) <= CHUNK_SIZE:
+            return app_iter
+        return ThreadPoolIterator(self._pool, app_iter)
+
+
+def make_app(app, threads=10):
+    """Return the wsgi application of the gevent server, running the
+       blocking work of app in a pool of threads"""
+    pool = ThreadPool(threads)
+    hub_thread = thread.get_ident()
+
+    def run_blocking(func, args, kwargs):
+        if thread.get_ident() != hub_thread:
+            # Already in the pool
+            return func(*args, **kwargs)
+        return pool.apply(func, args, kwargs)
+
+    utils.BLOCKING_RUNNER = run_blocking
+    # A lock wait must not block the event loop
+    jsondb.BLOCKING_WAIT = False
+    return AsyncMiddleware(app, pool)
+
+
+def serve(app, host, port, threads=10, connections=10000):
+    server = WSGIServer((host, port), make_app(app, threads=threads),
+                        spawn=Pool(connections), log=None)
+    LOG.info("[ASYNC] Serving on %s:%d, %d threads, %d connections max"
+             % (host, port, threads, connections))
+    server.serve_forever()
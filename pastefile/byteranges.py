@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"HTTP Range responses (RFC 7233) of stored files"
+
+import uuid
+from flask import Response
+
+
+def resolve_ranges(request_range, size):
+    """Return the [start, stop) ranges of a parsed Range header for a file
+       of size bytes, an empty list if the header must be ignored, or None
+       if none of the ranges can be satisfied"""
+    if request_range is None or request_range.units != 'bytes':
+        return []
+    ranges = []
+    for start, stop in request_range.ranges:
+        if start < 0:
+            # Suffix range: the last bytes
+            start, stop = max(size + start, 0), size
+        elif stop is None or stop > size:
+            stop = size
+        if start >= size:
+            continue
+        ranges.append((start, stop))
+    if not ranges:
+        return None
+    return ranges
+
+
+def _multipart(read, parts, boundary):
+    for part_headers, start, stop in parts:
+        yield part_headers
+        for chunk in read(start, stop):
+            yield chunk
+    yield '\r\n--%s--\r\n' % boundary
+
+
+def range_response(read, ranges, size, mimetype):
+    """206 response streaming the ranges of a file, as multipart/byteranges
+       if there is more than one range. read(start, stop) generates the
+       content of the file from start to stop"""
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        rv = Response(read(start, stop), 206,
+                      mimetype=mimetype, direct_passthrough=True)
+        rv.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+        rv.headers['Content-Length'] = str(stop - start)
+        return rv
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    length = len('\r\n--%s--\r\n' % boundary)
+    for start, stop in ranges:
+        part_headers = ('\r\n--%s\r\nContent-Type: %s\r\n'
+                        'Content-Range: bytes %d-%d/%d\r\n\r\n'
+                        % (boundary, mimetype, start, stop - 1, size))
+        parts.append((part_headers, start, stop))
+        length += len(part_headers) + stop - start
+    rv = Response(_multipart(read, parts, boundary), 206,
+                  content_type='multipart/byteranges; boundary=%s' % boundary,
+                  direct_passthrough=True)
+    rv.headers['Content-Length'] = str(length)
+    return rv
+
+
+def unsatisfiable_response(size):
+    rv = Response('Requested range not satisfiable\n', 416)
+    rv.headers['Content-Range'] = 'bytes */%d' % size
+    return rv
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compression at rest of the stored files.
+
+The encoding of a file is chosen from its mime type (see COMPRESS), and the
+file is only kept compressed if it saves at least MIN_SAVING of its size.
+zstd needs the optional zstandard module."""
+
+import os
+import zlib
+import logging
+from functools import partial
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG = logging.getLogger(__name__)
+
+# Minimal part of the size a compressed file must save to be kept
+MIN_SAVING = 0.1
+
+
+def _gzip_compressor():
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+# Content-Encoding: (compressor, decompressor)
+ENCODINGS = {'gzip': (_gzip_compressor, _gzip_decompressor)}
+if zstandard is not None:
+    ENCODINGS['zstd'] = (lambda: zstandard.ZstdCompressor(level=3).compressobj(),
+                         lambda: zstandard.ZstdDecompressor().decompressobj())
+
+
+def choose_encoding(mime_type, config):
+    """Return the encoding of the longest mime type prefix of COMPRESS
+       matching mime_type, None if the file is stored as is"""
+    prefixes = [p for p in config['COMPRESS'] if mime_type.startswith(p)]
+    if not prefixes:
+        return None
+    encoding = config['COMPRESS'][max(prefixes, key=len)]
+    if encoding not in ENCODINGS:
+        LOG.warning("Compression %s is not available for %s"
+                    % (encoding, mime_type))
+        return None
+    return encoding
+
+
+def accepts(request, encoding):
+    "Return True if the client accepts the encoding"
+    return request.accept_encodings[encoding] > 0
+
+
+def compress_file(filename, encoding, chunksize=2**16):
+    """Write filename compressed to filename.<encoding> and return it,
+       or None if the compression doesn't help"""
+    compressed = '%s.%s' % (filename, encoding)
+    compressor = ENCODINGS[encoding][0]()
+    size = 0
+    try:
+        with open(filename, 'rb') as source:
+            with open(compressed, 'wb') as dest:
+                for chunk in iter(partial(source.read, chunksize), b''):
+                    size += len(chunk)
+                    dest.write(compressor.compress(chunk))
+                dest.write(compressor.flush())
+        compressed_size = os.stat(compressed).st_size
+    except (IOError, OSError) as e:
+        LOG.error("Can't compress %s: %s" % (filename, e))
+        compressed_size = size
+    if compressed_size > size * (1 - MIN_SAVING):
+        try:
+            os.remove(compressed)
+        except OSError:
+            pass
+        return None
+    LOG.info("%s compressed with %s: %d -> %d bytes"
+             % (filename, encoding, size, compressed_size))
+    return compressed
+
+
+def decompress(chunks, encoding):
+    "Generate the decompressed content of the compressed chunks"
+    decompressor = ENCODINGS[encoding][1]()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    flush = getattr(decompressor, 'flush', None)
+    if flush is not None:
+        data = flush()
+        if data:
+            yield data
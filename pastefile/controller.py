@@ -2,66 +2,244 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
 import time
-import magic
 import datetime
+import tarfile
+import itertools
 import logging
+import threading
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from pastefile import utils
+from pastefile import archives
+from pastefile import byteranges
+from pastefile import compression
+from pastefile import stats
+from pastefile import storage
 from jsondb import JsonDB
-from flask import send_from_directory, abort
+from sqlitedb import SqliteDB
+from flask import send_from_directory, abort, Response
 from werkzeug import secure_filename
+from werkzeug.wsgi import ClosingIterator
 
 LOG = logging.getLogger(__name__)
 
-def get_infos_file_from_md5(md5, dbfile):
-    # Open JsonDB for read only
-    db = JsonDB(dbfile=dbfile)
-    db.load()
+# Sort orders of /ls
+LS_ORDERS = ('timestamp', 'id')
+
+# A file id is the digest of its content (md5, or HASH_ALGORITHM),
+# a stored file never changes
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# See _thread_pool
+_THREAD_POOL = []
+_THREAD_POOL_LOCK = threading.Lock()
+
+
+def open_db(dbfile, config=None, cache=False, **kwargs):
+    """Return the metadata store selected by the DB_BACKEND option.
+       cache=True is for read only usage: the json db parsed by a previous
+       request is reused if nobody modified it since.
+       operation names what the db is opened for in the lock statistics"""
+    if config is None:
+        config = {}
+    kwargs.setdefault('timeout', float(config.get('DB_LOCK_TIMEOUT', 10)))
+    if config.get('DB_BACKEND', 'json') == 'sqlite':
+        # The JsonDB file is imported on first start
+        return SqliteDB(dbfile='%s.sqlite' % dbfile, import_from=dbfile, **kwargs)
+    return JsonDB(dbfile=dbfile,
+                  journal=config.get('DB_JOURNAL', False),
+                  compact_size=int(config.get('DB_JOURNAL_COMPACT_SIZE', 1048576)),
+                  cache=cache,
+                  **kwargs)
+
+
+def storage_path(md5, config):
+    """Location of a stored file in the storage. With the local storage, in
+       UPLOAD_FOLDER_LEVELS levels of directories named after the md5
+       (ab/cd/abcd... for 2 levels)"""
+    return storage.get_storage(config).location(md5)
+
+
+def locate_file(md5, infos, config):
+    """Return the location of a stored file. While the files are migrated to
+       another layout, the file may already be moved but not its db entry"""
+    storage_full_filename = infos['storage_full_filename']
+    current = storage_path(md5, config)
+    if storage_full_filename != current and \
+            not storage.get_storage(config).exists(storage_full_filename):
+        return current
+    return storage_full_filename
+
+
+def _blob_claimed(md5, infos, store, config):
+    """True if a reader claimed the local blob of a burn after read file.
+       Its db entry is still 'True' until clean_files removes it, while the
+       entries of the other storages are marked 'Burned' by the reader"""
+    if not store.local or infos['burn_after_read'] != 'True':
+        return False
+    if config is None:
+        full_filename = infos['storage_full_filename']
+    else:
+        full_filename = locate_file(md5, infos, config)
+    return not store.exists(full_filename)
+
+
+def get_infos_file_from_md5(md5, dbfile, config=None):
+    # Open db for read only
+    db = open_db(dbfile=dbfile, config=config, cache=True, operation='read')
+    utils.run_blocking(db.load)
     return db.read(md5)
 
 
-def remove_file(db, file_id):
-    "Remove a file on disk and in db"
+def _remove_blob(store, file_id, storage_full_filename):
+    "Remove a file from the storage, return True if it is gone"
     try:
-        os.remove(db.db[file_id]['storage_full_filename'])
+        store.delete(storage_full_filename)
     except OSError:
         LOG.error('Error while trying to remove %s'
                   % file_id)
-    if not os.path.isfile(db.db[file_id]['storage_full_filename']):
-        db.delete(file_id)
-        return True
-    return False
+    try:
+        return not store.exists(storage_full_filename)
+    except OSError:
+        return False
+
+
+def remove_file(db, file_id, config=None):
+    "Remove a file from the storage and from the db"
+    if not _remove_blob(storage.get_storage(config), file_id,
+                        db.read(file_id)['storage_full_filename']):
+        return False
+    db.delete(file_id)
+    return True
 
 
-def clean_files(dbfile, expire=86400):
-    with JsonDB(dbfile=dbfile) as db:
+def _burned(md5, infos, store, config):
+    "True if a burn after read file was read"
+    return (infos['burn_after_read'] == 'Burned' or
+            _blob_claimed(md5, infos, store, config))
+
+
+def _burned_files(db, claims, store, config):
+    """Keys of the burn after read files already read: marked 'Burned', or
+       whose local blob was claimed. Only these entries are read"""
+    burned = set(db.burned())
+    for md5, claimed in claims:
+        infos = db.read(md5)
+        if infos and _burned(md5, infos, store, config):
+            burned.add(md5)
+    return sorted(burned)
+
+
+def clean_files(dbfile, expire=86400, config=None):
+    """Remove the expired and the burned files, return how many were removed.
+       The db is only locked if some files have to be removed"""
+    before = int(time.time() - int(expire))
+    store = storage.get_storage(config)
+    # Listed before the db is read: a file claimed later is seen next time
+    claims = store.claims() if store.local else []
+    db = open_db(dbfile=dbfile, config=config, cache=True,
+                 operation='clean')
+    db.load()
+    burned = _burned_files(db, claims, store, config)
+    if not db.expired(before) and not burned and not claims:
+        return 0
+
+    removed = 0
+    with open_db(dbfile=dbfile, config=config,
+                 operation='clean') as db:
         if db.lock_error:
             LOG.warning('Cant clean files')
             return False
-        for k, v in list(db.db.iteritems()):
-            if int(db.db[k]['timestamp']) < int(time.time() - int(expire)):
-                remove_file(db=db, file_id=k)
+        for k in db.expired(before):
+            if remove_file(db=db, file_id=k, config=config):
+                removed += 1
+        # Their blob is already removed by the reader. Uploaded again
+        # meanwhile, they are not burned anymore
+        for k in burned:
+            infos = db.read(k)
+            if infos and _burned(k, infos, store, config):
+                db.delete(k)
+                removed += 1
+    # Their entry is gone, or belongs to a file uploaded again
+    for md5, claimed in claims:
+        try:
+            store.delete(claimed)
+        except OSError:
+            # Removed by the clean of another process
+            pass
+    stats.increment('clean_removed_files_total', removed)
+    LOG.info("[CLEAN] %d expired or burned files removed" % removed)
+    return removed
+
+
+def make_room(db, size, config=None, exclude=None):
+    """Remove the oldest files, but exclude, until a new file of size bytes
+       fits under MAX_STORAGE_BYTES and MAX_FILES. db must be locked.
+       Return False if it does not fit"""
+    if config is None:
+        config = {}
+    max_bytes = int(config.get('MAX_STORAGE_BYTES') or 0)
+    max_files = int(config.get('MAX_FILES') or 0)
+    if max_bytes and size > max_bytes:
+        return False
+
+    def full():
+        stored_bytes, files = db.usage()[:2]
+        return bool(max_bytes and stored_bytes + size > max_bytes or
+                    max_files and files + 1 > max_files)
+
+    if not full():
+        return True
+    evicted = evicted_bytes = 0
+    for k in db.oldest():
+        if not full():
+            break
+        if k == exclude or k not in db:
+            continue
+        stored_size = utils.stored_size(db.read(k))
+        if remove_file(db=db, file_id=k, config=config):
+            evicted += 1
+            evicted_bytes += stored_size
+    stats.increment('evicted_files_total', evicted)
+    stats.increment('evicted_bytes_total', evicted_bytes)
+    LOG.info("[EVICT] %d files removed, %d bytes freed" % (evicted, evicted_bytes))
+    return not full()
 
 
 def get_file_info(id_file, config, env):
-    infos = get_infos_file_from_md5(md5=id_file, dbfile=config['FILE_LIST'])
+    infos = get_infos_file_from_md5(md5=id_file, dbfile=config['FILE_LIST'],
+                                    config=config)
     if not infos:
         return False
+    return format_file_info(id_file=id_file, infos=infos, config=config,
+                            base_url=utils.build_base_url(env=env))
+
+
+def format_file_info(id_file, infos, config, base_url):
+    "Build the infos of a file displayed to the user from its db entry"
     try:
-        size = utils.human_readable(os.stat(infos['storage_full_filename']).st_size)
+        if 'size' in infos:
+            size = infos['size']
+        else:
+            # Entry not backfilled yet
+            size = storage.get_storage(config).size(infos['storage_full_filename'])
+        size = utils.human_readable(size)
         expire = datetime.datetime.fromtimestamp(
                       int(infos['timestamp']) +
                       int(config['EXPIRE'])).strftime('%d-%m-%Y %H:%M:%S'),
         file_infos = {
             'name': infos['real_name'],
             'md5': id_file,
+            'hash': infos.get('hash', 'md5'),
             'burn_after_read': infos['burn_after_read'],
             'timestamp': infos['timestamp'],
             'expire': expire,
             'mime_type': infos['mime_type'],
             'type': infos['type'],
             'size': size,
-            'url': "%s/%s" % (utils.build_base_url(env=env), id_file)
+            'url': "%s/%s" % (base_url, id_file)
         }
         return file_infos
     except:
@@ -69,85 +247,131 @@ def get_file_info(id_file, config, env):
         return False
 
 
-def add_new_file(filename, source, dest, db, mime_type, type, md5, burn_after_read):
+def add_new_file(filename, dest, db, mime_type, type, md5, burn_after_read,
+                 size, stored_size=None, encoding=None, config=None):
+    """Register a file in the db, which must be locked. The file is already
+       in the storage at dest, or dest is None if it was already stored.
+       Return False if the file is not registered"""
 
     # IMPROVE : possible "bug" If a file is already uploaded, the burn_after_read
     #           Will not bu updated
-    # File already exist, return True and remove ths source
-    if md5 in db.db:
-        try:
-            os.remove(source)
-        except OSError as e:
-            LOG.error("Can't remove tmp file: %s" % e)
+    # File already exist, return True.
+    # A burned file is stored again. A file whose blob was just written
+    # replaces its entry: it may be the one of a burn after read file
+    # already read, which only clean_files removes
+    if md5 in db and dest is None and db.read(md5)['burn_after_read'] != 'Burned':
+        stats.increment('dedup_hits_total', source='content')
         return True
 
-    # If no lock, return false
-    if db.lock_error:
+    # If no lock, or removed since we found it stored, return false
+    if db.lock_error or dest is None:
         return False
 
-    try:
-        os.rename(source, dest)
-    except OSError as e:
-        LOG.error("Can't move processing file to storage directory: %s" % e)
+    # Stay under MAX_STORAGE_BYTES and MAX_FILES
+    if not make_room(db, stored_size, config=config, exclude=md5):
+        LOG.error("Not enough room to store %s (%d bytes)" % (md5, stored_size))
         return False
 
-    db.write(md5, {
+    infos = {
         'real_name': filename,
         'type': type,
         'mime_type': mime_type,
         'storage_full_filename': dest,
         'timestamp': int(time.time()),
         'burn_after_read': str(burn_after_read),
-    })
+        'size': size,
+    }
+    # The stored file is compressed, size is the one of the original
+    if encoding:
+        infos['encoding'] = encoding
+        infos['stored_size'] = stored_size
+    # The id is not an md5
+    algorithm = (config or {}).get('HASH_ALGORITHM', 'md5')
+    if algorithm != 'md5':
+        infos['hash'] = algorithm
+    db.write(md5, infos)
     return True
 
 
+def file_exists(id_file, config):
+    "Return True if a file with this md5 is stored and can still be downloaded"
+    infos = get_infos_file_from_md5(md5=id_file, dbfile=config['FILE_LIST'],
+                                    config=config)
+    return (bool(infos) and infos['burn_after_read'] != 'Burned' and
+            not _blob_claimed(id_file, infos, storage.get_storage(config), config))
+
+
 def upload_file(request, config):
-    value_burn_after_read = request.form.getlist('burn')
+    # The client can give the md5 of the file. If we already have it,
+    # answer before the body is read
+    client_md5 = request.headers.get('X-Pastefile-Digest')
+    if client_md5 and file_exists(id_file=client_md5, config=config):
+        stats.increment('dedup_hits_total', source='digest')
+        LOG.info("[POST] Client %s already has uploaded: %s"
+                 % (request.remote_addr, client_md5))
+        return "%s/%s\n" % (utils.build_base_url(env=request.environ),
+                            client_md5)
+
+    # Parsing the form writes the files in TMP_FOLDER
+    try:
+        value_burn_after_read = request.form.getlist('burn')
+        request_files = request.files.getlist('file')
+        tars = request.files.getlist('tar')
+        if not request_files and not tars:
+            abort(400)
+    except (IOError, OSError) as e:
+        LOG.error("Can't receive the uploaded file: %s" % e)
+        return 'Server error, contact administrator\n'
     if value_burn_after_read:
         burn_after_read = True
     else:
         burn_after_read = False
 
+    if len(request_files) > 1 or tars:
+        # The digest is the one of a single file, it can't be checked
+        if client_md5:
+            LOG.info("[POST] Client %s sent X-Pastefile-Digest with several files"
+                     % request.remote_addr)
+            return 'X-Pastefile-Digest applies to a single file\n', 400
+        return upload_files(request=request,
+                            request_files=request_files,
+                            tars=tars,
+                            burn_after_read=burn_after_read,
+                            config=config)
+    request_file = request_files[0]
+
     # Write tmp file on disk
     try:
-        file_md5, tmp_full_filename = utils.write_tmpfile_to_disk(file=request.files['file'],
-                                                                  dest_dir=config['TMP_FOLDER'])
+        file_md5, tmp_full_filename, head, size = utils.write_tmpfile_to_disk(
+            file=request_file, dest_dir=config['TMP_FOLDER'],
+            algorithm=config['HASH_ALGORITHM'])
     except IOError:
         return 'Server error, contact administrator\n'
 
-    secure_name = secure_filename(request.files['file'].filename)
-
-    with JsonDB(dbfile=config['FILE_LIST']) as db:
-
-        # Just inform for debug purpose
-        if db.lock_error:
-            LOG.error("Unable to get lock during file upload %s" % file_md5)
-
-        # Try to write file on disk and db. Return false if file is not writed
-        storage_full_filename = os.path.join(config['UPLOAD_FOLDER'], file_md5)
-        mime_type = magic.from_file(tmp_full_filename, mime=True)
-        _type = magic.from_file(tmp_full_filename)
-        succed_add_file = add_new_file(filename=secure_name,
-                                       source=tmp_full_filename,
-                                       dest=storage_full_filename,
-                                       mime_type=mime_type,
-                                       type=_type,
-                                       db=db,
-                                       md5=file_md5,
-                                       burn_after_read=burn_after_read)
-
-    if not succed_add_file:
-        # In the case the file is not in db, we have 2 reason :
-        #  * We was not able to have the lock and write the file in the db.
-        #  * Or an error occure during the file processing
-        # In any case just tell the user to try later
+    # The md5 sent by an older client when HASH_ALGORITHM is not md5 can't
+    # be checked, the file gets the id of the new algorithm
+    legacy_md5 = config['HASH_ALGORITHM'] != 'md5' and len(client_md5 or '') == 32
+    if client_md5 and not legacy_md5 and client_md5 != file_md5:
         try:
             os.remove(tmp_full_filename)
         except OSError as e:
             LOG.error("Can't remove tmp file: %s" % e)
+        LOG.info("[POST] Client %s sent %s but announced %s"
+                 % (request.remote_addr, file_md5, client_md5))
+        return 'Digest mismatch, the file is %s\n' % file_md5, 400
 
-        LOG.info('Unable lock the db and find the file %s in db during upload' % file_md5)
+    secure_name = secure_filename(request_file.filename)
+
+    storage_full_filename = utils.run_blocking(store_file,
+                                               tmp_full_filename=tmp_full_filename,
+                                               file_md5=file_md5,
+                                               head=head,
+                                               size=size,
+                                               filename=secure_name,
+                                               burn_after_read=burn_after_read,
+                                               config=config,
+                                               file_type=getattr(request_file.stream, 'file_type', None))
+    if not storage_full_filename:
         return 'Unable to upload the file, try again later ...\n'
 
     LOG.info("[POST] Client %s has successfully uploaded: %s (%s)"
@@ -156,81 +380,784 @@ def upload_file(request, config):
                         file_md5)
 
 
-def delete_file(request, id_file, dbfile):
-    with JsonDB(dbfile=dbfile) as db:
+def upload_files(request, request_files, tars, burn_after_read, config):
+    """Store the files of a request with several files, and the files of its
+       tar archives, in a single db transaction. Return one line per file,
+       in order: its url, or why it was not stored"""
+    files = []
+    try:
+        for request_file in request_files:
+            file_md5, tmp_full_filename, head, size = utils.write_tmpfile_to_disk(
+                file=request_file, dest_dir=config['TMP_FOLDER'],
+                algorithm=config['HASH_ALGORITHM'])
+            # Only the type is kept, not the first bytes of every file
+            files.append({'tmp_full_filename': tmp_full_filename,
+                          'file_md5': file_md5,
+                          'file_type': _file_type(request_file, head),
+                          'size': size,
+                          'filename': secure_filename(request_file.filename),
+                          'burn_after_read': burn_after_read})
+        for tar in tars:
+            tar_md5, tar_full_filename, head, size = utils.write_tmpfile_to_disk(
+                file=tar, dest_dir=config['TMP_FOLDER'])
+            try:
+                members = utils.run_blocking(utils.write_tar_members_to_disk,
+                                             filename=tar_full_filename,
+                                             dest_dir=config['TMP_FOLDER'],
+                                             algorithm=config['HASH_ALGORITHM'])
+            finally:
+                os.remove(tar_full_filename)
+            for name, file_md5, tmp_full_filename, file_type, size in members:
+                files.append({'tmp_full_filename': tmp_full_filename,
+                              'file_md5': file_md5,
+                              'file_type': file_type,
+                              'size': size,
+                              'filename': secure_filename(name),
+                              'burn_after_read': burn_after_read})
+    except (IOError, OSError, tarfile.TarError) as e:
+        for infos in files:
+            try:
+                os.remove(infos['tmp_full_filename'])
+            except OSError:
+                pass
+        if isinstance(e, tarfile.TarError):
+            LOG.info("[POST] Client %s sent an invalid tar archive: %s"
+                     % (request.remote_addr, e))
+            return 'Invalid tar archive: %s\n' % e, 400
+        return 'Server error, contact administrator\n'
+    if not files:
+        return 'No file\n', 400
+
+    stored = utils.run_blocking(store_files, files=files, config=config)
+
+    base_url = utils.build_base_url(env=request.environ)
+    lines = []
+    for infos, storage_full_filename in zip(files, stored):
+        if storage_full_filename:
+            lines.append('%s/%s' % (base_url, infos['file_md5']))
+        else:
+            lines.append('Unable to upload the file %s, try again later ...'
+                         % infos['filename'])
+    LOG.info("[POST] Client %s has uploaded %d of %d files"
+             % (request.remote_addr, len([f for f in stored if f]), len(files)))
+    return '%s\n' % '\n'.join(lines)
+
+
+def _file_type(request_file, head):
+    """Type of a received file, see utils.get_file_type. It is already
+       detected if its first bytes were released"""
+    if head is None:
+        return request_file.stream.file_type
+    return utils.run_blocking(utils.get_file_type, head)
+
+
+def _thread_pool(config):
+    """Threads preparing the files of a batch upload and removing the files
+       of a bulk delete, created on first use"""
+    with _THREAD_POOL_LOCK:
+        if not _THREAD_POOL:
+            _THREAD_POOL.append(ThreadPool(int(config['WORKER_THREADS'])))
+        return _THREAD_POOL[0]
+
+
+def _prepare_file(infos, config):
+    """Detect the type of a received file, compress it and put it in the
+       storage, unless the file is already stored. Return the mime type, the
+       type, the compressed file, its encoding, the stored size and where
+       the file was put (None if it was not)"""
+    store = storage.get_storage(config)
+    stored = get_infos_file_from_md5(md5=infos['file_md5'],
+                                     dbfile=config['FILE_LIST'], config=config)
+    if stored and stored['burn_after_read'] != 'Burned' and \
+            store.exists(locate_file(infos['file_md5'], stored, config)):
+        return stored['mime_type'], stored['type'], None, None, None, None
+
+    if infos.get('file_type'):
+        mime_type, _type = infos['file_type']
+    else:
+        mime_type, _type = utils.get_file_type(infos['head'])
+    encoding = compression.choose_encoding(mime_type, config)
+    compressed = None
+    if encoding:
+        compressed = compression.compress_file(infos['tmp_full_filename'], encoding)
+    source = compressed or infos['tmp_full_filename']
+    dest = storage_path(infos['file_md5'], config)
+    try:
+        stored_size = os.stat(source).st_size
+        store.put(source, dest)
+    except OSError as e:
+        LOG.error("Can't move processing file to storage directory: %s" % e)
+        return mime_type, _type, compressed, encoding, None, None
+    return mime_type, _type, compressed, encoding, stored_size, dest
+
+
+def _unput_file(store, file_id, dest, restore=None):
+    """Remove a file put in the storage but not registered. With restore,
+       move it back there"""
+    if restore is not None:
+        try:
+            if store.local:
+                os.rename(dest, restore)
+                return
+            with open(restore, 'wb') as f:
+                for chunk in store.get(dest):
+                    f.write(chunk)
+        except (IOError, OSError) as e:
+            LOG.error("Can't restore %s: %s" % (restore, e))
+    _remove_blob(store, file_id, dest)
+
+
+def store_file(tmp_full_filename, file_md5, head, size, filename,
+               burn_after_read, config, keep_on_error=False, file_type=None):
+    """Move a received file from TMP_FOLDER to the storage and add it in the db.
+       The type is detected from head unless file_type is given.
+       Return the storage filename, or None if the file can't be stored, in
+       which case the received file is removed unless keep_on_error"""
+    return store_files(files=[{'tmp_full_filename': tmp_full_filename,
+                               'file_md5': file_md5,
+                               'head': head,
+                               'file_type': file_type,
+                               'size': size,
+                               'filename': filename,
+                               'burn_after_read': burn_after_read}],
+                       config=config,
+                       keep_on_error=keep_on_error)[0]
+
+
+def store_files(files, config, keep_on_error=False):
+    """Move received files from TMP_FOLDER to the storage and add them in the
+       db, in a single transaction. files are dicts of the arguments of
+       store_file, with the file_type (see utils.get_file_type) instead of the
+       head if it is already known. Return the storage filename of each file,
+       see store_file"""
+    # Detect the types, compress and upload the files before locking the db,
+    # unless the files are already stored. Files are addressed by their
+    # content, only their metadata is written under the lock
+    if len(files) > 1:
+        prepared = _thread_pool(config).map(partial(_prepare_file, config=config),
+                                            files)
+    else:
+        prepared = [_prepare_file(files[0], config)]
+
+    succed = []
+    with open_db(dbfile=config['FILE_LIST'], config=config,
+                 operation='upload') as db:
+
+        # Just inform for debug purpose
         if db.lock_error:
-            return "Lock timed out\n"
-        if id_file not in db.db:
-            return abort(404)
+            LOG.error("Unable to get lock during file upload %s"
+                      % ', '.join(infos['file_md5'] for infos in files))
+
+        for infos, (mime_type, _type, compressed, encoding, stored_size, dest) in \
+                zip(files, prepared):
+            # Return false if file is not writed in the db
+            succed.append(add_new_file(filename=infos['filename'],
+                                       dest=dest,
+                                       mime_type=mime_type,
+                                       type=_type,
+                                       db=db,
+                                       md5=infos['file_md5'],
+                                       burn_after_read=infos['burn_after_read'],
+                                       size=infos['size'],
+                                       stored_size=stored_size,
+                                       encoding=encoding if compressed else None,
+                                       config=config))
+
+    store = storage.get_storage(config)
+    stored = []
+    for infos, (mime_type, _type, compressed, encoding, stored_size, dest), succed_add_file in \
+            zip(files, prepared, succed):
+        tmp_full_filename = infos['tmp_full_filename']
+        if dest is not None and not succed_add_file:
+            # The received file is moved back if it must be kept
+            _unput_file(store, infos['file_md5'], dest,
+                        restore=tmp_full_filename if keep_on_error and not compressed
+                        else None)
+        # Those moved to the storage are already gone
+        leftovers = [compressed] if compressed else []
+        if succed_add_file or not keep_on_error:
+            leftovers.append(tmp_full_filename)
+        for leftover in leftovers:
+            try:
+                os.remove(leftover)
+            except OSError:
+                pass
+
+        if not succed_add_file:
+            # In the case the file is not in db, we have 2 reason :
+            #  * We was not able to have the lock and write the file in the db.
+            #  * Or an error occure during the file processing
+            # In any case just tell the user to try later
+            LOG.info('Unable lock the db and find the file %s in db during upload'
+                     % infos['file_md5'])
+            stored.append(None)
+            continue
+        stats.increment('uploaded_bytes_total', infos['size'])
+        stored.append(storage_path(infos['file_md5'], config))
+    return stored
+
+
+def _delete_file(id_file, dbfile, config):
+    "Return 'deleted', 'not found' or 'error', None if the db can't be locked"
+    with open_db(dbfile=dbfile, config=config,
+                 operation='delete') as db:
+        if db.lock_error:
+            return None
+        if id_file not in db:
+            return 'not found'
+        if not remove_file(db=db, file_id=id_file, config=config):
+            return 'error'
+        return 'deleted'
+
+
+def delete_file(request, id_file, dbfile, config=None):
+    result = utils.run_blocking(_delete_file, id_file=id_file, dbfile=dbfile,
+                                config=config)
+    if result is None:
+        return "Lock timed out\n"
+    if result == 'not found':
+        return abort(404)
+    if result == 'error':
+        return 'Unable to delete file %s\n' % id_file
+
+    LOG.info("[DELETE] Client %s has deleted: %s"
+             % (request.remote_addr, id_file))
+    return "File %s deleted\n" % id_file
 
-        if not remove_file(db=db, file_id=id_file):
-            return 'Unable to delete file %s\n' % id_file
 
-        LOG.info("[DELETE] Client %s has deleted: %s"
-                 % (request.remote_addr, id_file))
-        return "File %s deleted\n" % id_file
+def get_files_info(ids, config, env):
+    """Infos of several files, from a single snapshot of the db.
+       Return {id: infos, or None if the file is unknown}"""
+    db = open_db(dbfile=config['FILE_LIST'], config=config, cache=True,
+                 operation='read')
+    utils.run_blocking(db.load)
+    base_url = utils.build_base_url(env=env)
+    result = {}
+    for id_file in ids:
+        infos = db.read(id_file)
+        if infos:
+            infos = format_file_info(id_file=id_file, infos=infos, config=config,
+                                     base_url=base_url)
+        result[id_file] = infos or None
+    return result
+
+
+def delete_files(request, ids, config):
+    """Delete several files in a single db transaction, their blobs are
+       removed in parallel. Return {id: 'deleted', 'not found' or 'error'},
+       or None if the db can't be locked"""
+    result = utils.run_blocking(_delete_files, ids=ids, config=config)
+    if result is not None:
+        LOG.info("[DELETE] Client %s has deleted %d of %d files"
+                 % (request.remote_addr, result.values().count('deleted'),
+                    len(result)))
+    return result
+
+
+def _delete_files(ids, config):
+    store = storage.get_storage(config)
+    with open_db(dbfile=config['FILE_LIST'], config=config,
+                 operation='delete') as db:
+        if db.lock_error:
+            return None
+        result = dict((id_file, 'not found') for id_file in ids)
+        known = sorted(set(id_file for id_file in ids if id_file in db))
+        blobs = [(id_file, db.read(id_file)['storage_full_filename'])
+                 for id_file in known]
+        removed = _thread_pool(config).map(lambda blob: _remove_blob(store, *blob),
+                                           blobs)
+        for id_file, gone in zip(known, removed):
+            if gone:
+                db.delete(id_file)
+                result[id_file] = 'deleted'
+            else:
+                result[id_file] = 'error'
+    return result
 
 
 def get_file(request, id_file, config):
-    # First, open JsonDB for read-only
-    db = JsonDB(dbfile=config['FILE_LIST'])
-    db.load()
-    if id_file not in db.db or db.db[id_file]['burn_after_read'] == 'Burned':
+    # First, open db for read-only
+    db = open_db(dbfile=config['FILE_LIST'], config=config, cache=True,
+                 operation='download')
+    utils.run_blocking(db.load)
+    infos = db.read(id_file)
+    if not infos or infos['burn_after_read'] == 'Burned':
         return abort(404)
-    if db.db[id_file]['burn_after_read'] == 'True':
-        # Now, try to lock the db
-        if not db._lock():
-            return "Can't lock db for burning file"
-        db.db[id_file]['burn_after_read'] = 'Burned'
-        db.save()
-        db._release()
-
-    filename = os.path.basename(db.db[id_file]['storage_full_filename'])
+    burn_after_read = infos['burn_after_read'] == 'True'
+    store = storage.get_storage(config)
+    full_filename = locate_file(id_file, infos, config)
+    if burn_after_read:
+        full_filename = utils.run_blocking(_claim_burn, id_file, full_filename,
+                                           store, config)
+        if full_filename is None:
+            return abort(404)
+
     LOG.info("[GET] Client %s has requested: %s (%s)"
-             % (request.remote_addr, db.db[id_file]['real_name'], id_file))
+             % (request.remote_addr, infos['real_name'], id_file))
+
+    # If the user agent is in the display list, format headers to direct display feature
+    as_attachment = request.user_agent.browser not in config['DISPLAY_FOR']
+
+    # A compressed file is sent as is to the clients accepting its encoding,
+    # and decompressed on the fly for the others
+    encoding = infos.get('encoding')
+    decompress = bool(encoding) and not compression.accepts(request, encoding)
+    if decompress:
+        encoding = None
 
+    # Burn after read files are always sent whole and never cached:
+    # they can be read only once
+    if burn_after_read:
+        rv = _send_file(store=store, full_filename=full_filename, infos=infos,
+                        decompress=decompress, as_attachment=as_attachment,
+                        config=config)
+        # call_on_close is not called for direct passthrough responses
+        rv.response = ClosingIterator(rv.response,
+                                      partial(_unlink_burned, store, full_filename))
+        rv.headers['Cache-Control'] = 'no-store'
+        rv.headers.pop('Expires', None)
+        if encoding:
+            rv.headers['Content-Encoding'] = encoding
+        _count_download(rv, infos)
+        return rv
+
+    # The compressed and the original content are two representations
+    etag = '%s-%s' % (id_file, encoding) if encoding else id_file
+    rv = _not_modified_response(request=request, etag=etag, infos=infos)
+    if rv is None and config['SENDFILE_MODE'] and store.local and \
+            not infos.get('encoding'):
+        rv = _offload_response(infos=infos,
+                               full_filename=full_filename,
+                               as_attachment=as_attachment,
+                               config=config)
+    if rv is None and not decompress:
+        rv = _range_response(request=request,
+                             etag=etag,
+                             infos=infos,
+                             store=store,
+                             full_filename=full_filename,
+                             encoded=bool(encoding))
+        if rv is not None and rv.status_code == 206 and as_attachment:
+            rv.headers.add('Content-Disposition', 'attachment',
+                           filename=infos['real_name'])
+    if rv is None:
+        rv = _send_file(store=store, full_filename=full_filename, infos=infos,
+                        decompress=decompress, as_attachment=as_attachment,
+                        config=config)
+    if rv.status_code == 416:
+        return rv
+    rv.set_etag(etag)
+    rv.last_modified = datetime.datetime.utcfromtimestamp(int(infos['timestamp']))
+    rv.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    rv.headers.pop('Expires', None)
+    rv.headers['Accept-Ranges'] = 'none' if decompress else 'bytes'
+    if infos.get('encoding'):
+        rv.vary.add('Accept-Encoding')
+    if encoding and rv.status_code != 304:
+        rv.headers['Content-Encoding'] = encoding
+    _count_download(rv, infos)
+    return rv
+
+
+def get_archive(request, ids, archive_format, config):
+    """Send the files ids in a tar or zip archive, named after their
+       real_name. The files are read from the storage while the archive is
+       sent. Unknown and burned files are skipped, burn after read files are
+       burned"""
+    db = open_db(dbfile=config['FILE_LIST'], config=config, cache=True,
+                 operation='download')
+    utils.run_blocking(db.load)
+    store = storage.get_storage(config)
+    files = []
+    seen = set()
+    for id_file in ids:
+        infos = db.read(id_file)
+        if not infos or infos['burn_after_read'] == 'Burned' or id_file in seen:
+            continue
+        full_filename = locate_file(id_file, infos, config)
+        if 'size' in infos:
+            size = infos['size']
+        else:
+            # Entry not backfilled yet
+            size = store.size(full_filename)
+        name = infos['real_name'] or id_file
+        if name in seen:
+            name = '%s-%s' % (id_file, name)
+        seen.update([id_file, name])
+        files.append((id_file, infos, full_filename, name, size))
+    if not files:
+        return abort(404)
+    # Nothing is burned if the archive can't be built
+    if archives.size(archive_format,
+                     [(f[3], f[4], 0, None) for f in files]) is None:
+        return 'Too many or too big files for a zip archive, use tar\n', 400
+
+    members = []
+    claimed = []
+    for id_file, infos, full_filename, name, size in files:
+        if infos['burn_after_read'] == 'True':
+            full_filename = utils.run_blocking(_claim_burn, id_file, full_filename,
+                                               store, config)
+            if full_filename is None:
+                continue
+            claimed.append(full_filename)
+        chunks = store.get(full_filename)
+        if infos.get('encoding'):
+            chunks = compression.decompress(chunks, infos['encoding'])
+        members.append((name, size, int(infos['timestamp']), chunks))
+    if not members:
+        return abort(404)
+
+    LOG.info("[GET] Client %s has requested a %s archive of %d files"
+             % (request.remote_addr, archive_format, len(members)))
+    size = archives.size(archive_format, members)
+    rv = Response(archives.stream(archive_format, members),
+                  mimetype=archives.FORMATS[archive_format],
+                  direct_passthrough=True)
+    rv.headers['Content-Length'] = str(size)
+    rv.headers.add('Content-Disposition', 'attachment',
+                   filename='pastefile.%s' % archive_format)
+    rv.headers['Cache-Control'] = 'no-store'
+    rv.response = ClosingIterator(rv.response,
+                                  [partial(_unlink_burned, store, location)
+                                   for location in claimed])
+    stats.increment('downloaded_bytes_total', size)
+    return rv
+
+
+def _count_download(rv, infos):
+    if rv.status_code not in (200, 206):
+        return
+    if 'X-Accel-Redirect' in rv.headers or 'X-Sendfile' in rv.headers:
+        # Sent by the web server
+        sent = infos.get('size', 0)
+    else:
+        sent = rv.content_length or 0
+    stats.increment('downloaded_bytes_total', sent)
+
+
+def _claim_burn(md5, full_filename, store, config):
+    """Claim a burn after read file, only one reader succeeds, even across
+       processes. Return the location to send, or None if it is already burned"""
+    if store.local:
+        # Its blob is moved aside
+        return store.claim(full_filename)
+    # Objects can't be renamed atomically, the entry is marked burned
+    with open_db(dbfile=config['FILE_LIST'], config=config,
+                 operation='download') as db:
+        if db.lock_error:
+            LOG.error("Unable to get lock to burn %s" % md5)
+            return None
+        infos = db.read(md5)
+        if not infos or infos['burn_after_read'] != 'True':
+            return None
+        db.write(md5, dict(infos, burn_after_read='Burned'))
+    return full_filename
+
+
+def _unlink_burned(store, claimed):
+    "Remove the content of a file sent once, see _claim_burn"
+    try:
+        if store.local:
+            # The empty file tells clean_files to remove its entry
+            store.release(claimed)
+        else:
+            store.delete(claimed)
+    except OSError as e:
+        LOG.error("Can't remove burned file %s: %s" % (claimed, e))
+
+
+def _upload_folder(config):
     if not os.path.isabs(config['UPLOAD_FOLDER']):
-        path = "%s/%s" % (os.path.dirname(config['instance_path']),
+        return "%s/%s" % (os.path.dirname(config['instance_path']),
                           config['UPLOAD_FOLDER'])
+    return config['UPLOAD_FOLDER']
+
+
+def _send_file(store, full_filename, infos, decompress, as_attachment, config):
+    "Send the whole file, decompressed if needed"
+    if store.local and not decompress:
+        return send_from_directory(_upload_folder(config),
+                                   os.path.relpath(full_filename,
+                                                   config['UPLOAD_FOLDER']),
+                                   mimetype=infos['mime_type'],
+                                   attachment_filename=infos['real_name'],
+                                   as_attachment=as_attachment)
+    if decompress:
+        rv = Response(compression.decompress(store.get(full_filename),
+                                             infos['encoding']),
+                      mimetype=infos['mime_type'],
+                      direct_passthrough=True)
+        if 'size' in infos:
+            rv.headers['Content-Length'] = str(infos['size'])
     else:
-        path = config['UPLOAD_FOLDER']
+        rv = Response(store.get(full_filename),
+                      mimetype=infos['mime_type'],
+                      direct_passthrough=True)
+        rv.headers['Content-Length'] = str(store.size(full_filename))
+    if as_attachment:
+        rv.headers.add('Content-Disposition', 'attachment',
+                       filename=infos['real_name'])
+    return rv
 
-    # If the user agent is in the display list, format headers to direct display feature
-    if request.user_agent.browser in config['DISPLAY_FOR']:
-        return send_from_directory(path,
-                                   filename,
-                                   mimetype=db.db[id_file]['mime_type'],
-                                   attachment_filename=db.db[id_file]['real_name'])
 
-    # Else keep the regular send file
-    return send_from_directory(path,
-                               filename,
-                               mimetype=db.db[id_file]['mime_type'],
-                               attachment_filename=db.db[id_file]['real_name'],
-                               as_attachment=True)
+def _offload_response(infos, full_filename, as_attachment, config):
+    """Let the front web server send the file (and handle ranges), the
+       worker is released as soon as the headers are sent"""
+    rv = Response(mimetype=infos['mime_type'])
+    if config['SENDFILE_MODE'] == 'x-accel':
+        rv.headers['X-Accel-Redirect'] = '%s/%s' % (
+            config['SENDFILE_PREFIX'].rstrip('/'),
+            os.path.relpath(full_filename, config['UPLOAD_FOLDER']))
+    else:
+        rv.headers['X-Sendfile'] = os.path.abspath(
+            os.path.join(_upload_folder(config),
+                         os.path.relpath(full_filename, config['UPLOAD_FOLDER'])))
+    if as_attachment:
+        rv.headers.add('Content-Disposition', 'attachment',
+                       filename=infos['real_name'])
+    return rv
 
 
-def get_all_files(request, config):
-    # Open JsonDB for read only
-    db = JsonDB(dbfile=config['FILE_LIST'], logger=config['LOGGER_NAME'])
-    db.load()
-    files_list_infos = {}
-    for k, v in db.db.iteritems():
-        _infos = get_file_info(id_file=k,
-                               config=config,
-                               env=request.environ)
+def _not_modified_response(request, etag, infos):
+    "Return a 304 response if the client already has the file, else None"
+    if request.if_none_match:
+        if not request.if_none_match.contains_weak(etag):
+            return None
+    elif request.if_modified_since:
+        uploaded = datetime.datetime.utcfromtimestamp(int(infos['timestamp']))
+        if uploaded > request.if_modified_since.replace(tzinfo=None):
+            return None
+    else:
+        return None
+    return Response(status=304)
+
+
+def _range_response(request, etag, infos, store, full_filename, encoded=False):
+    """Return a 206 or 416 response if the client asked for ranges, else None.
+       The ranges of an encoded file are ranges of the compressed content"""
+    if request.range is None:
+        return None
+    # If-Range: only send ranges of the version the client has
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and if_range.date.replace(tzinfo=None) < \
+            datetime.datetime.utcfromtimestamp(int(infos['timestamp'])):
+        return None
+
+    if 'size' in infos and not encoded:
+        size = infos['size']
+    else:
+        size = store.size(full_filename)
+    ranges = byteranges.resolve_ranges(request.range, size)
+    if ranges is None:
+        return byteranges.unsatisfiable_response(size)
+    if not ranges:
+        return None
+    return byteranges.range_response(read=partial(store.get, full_filename),
+                                     ranges=ranges,
+                                     size=size,
+                                     mimetype=infos['mime_type'])
+
+
+def _match_filters(id_file, infos, filters, config):
+    if 'mime_type' in filters and not infos['mime_type'].startswith(filters['mime_type']):
+        return False
+    if 'name' in filters and not infos['real_name'].startswith(filters['name']):
+        return False
+    if 'since' in filters and int(infos['timestamp']) < filters['since']:
+        return False
+    if 'burn' in filters and infos['burn_after_read'] != filters['burn']:
+        return False
+    return True
+
+
+def ls_position(order, id_file, infos):
+    "Position of an entry in the /ls order, as expected by db.scan"
+    if order == 'id':
+        return id_file
+    return (int(infos['timestamp']), id_file)
+
+
+def encode_cursor(position):
+    if isinstance(position, tuple):
+        return '%d-%s' % position
+    return position
+
+
+def decode_cursor(cursor, order):
+    "Return the position of a cursor, raise ValueError if it is invalid"
+    if order == 'id':
+        return cursor
+    timestamp, id_file = cursor.split('-', 1)
+    return (int(timestamp), id_file)
+
+
+def iter_file_infos(db, config, base_url, order='timestamp', after=None, filters=None):
+    """Yield md5, db entry and displayed infos of the files matching the filters,
+       sorted by order, starting after the position after"""
+    for k, v in db.scan(order=order, after=after):
+        if filters and not _match_filters(k, v, filters, config):
+            continue
+        _infos = format_file_info(id_file=k,
+                                  infos=v,
+                                  config=config,
+                                  base_url=base_url)
         if not _infos:
             continue
-        files_list_infos[k] = _infos
-    return files_list_infos
+        yield k, v, _infos
+
+
+def get_all_files(request, config):
+    # Open db for read only
+    db = open_db(dbfile=config['FILE_LIST'], config=config, cache=True,
+                 logger=config['LOGGER_NAME'], operation='ls')
+    utils.run_blocking(db.load)
+    base_url = utils.build_base_url(env=request.environ)
+    return dict((k, _infos) for k, v, _infos in iter_file_infos(db=db,
+                                                                config=config,
+                                                                base_url=base_url))
+
+
+def _stream_json(files):
+    "Generate a json object {md5: infos} one file at a time"
+    yield '{'
+    separator = ''
+    for k, v, _infos in files:
+        yield '%s%s: %s' % (separator, json.dumps(k), json.dumps(_infos))
+        separator = ', '
+    yield '}\n'
+
+
+def _stream_ndjson(files):
+    "Generate the infos of one file per line"
+    for k, v, _infos in files:
+        yield '%s\n' % json.dumps(_infos)
+
 
+def list_files(request, config):
+    """Streamed response of /ls. Arguments, all optional:
+        order: timestamp (default) or id
+        limit: max number of files, the cursor of the next page is sent in
+               the X-Next-Cursor header
+        cursor: start after this cursor
+        mime_type, name: prefix of the mime type or of the name of the files
+        since: files uploaded since this timestamp
+        burn: burn after read state of the files (True, False or Burned)
+        format: json (default), or ndjson for one file per line"""
+    args = request.args
+    order = args.get('order', 'timestamp')
+    if order not in LS_ORDERS:
+        return 'Unknown order %s\n' % order, 400
+    filters = {}
+    for key in ['mime_type', 'name', 'burn']:
+        if key in args:
+            filters[key] = args[key]
+    try:
+        limit = None
+        if 'limit' in args:
+            limit = int(args['limit'])
+            if limit < 1:
+                raise ValueError('limit must be positive')
+        after = None
+        if 'cursor' in args:
+            after = decode_cursor(args['cursor'], order)
+        if 'since' in args:
+            filters['since'] = int(args['since'])
+    except ValueError as e:
+        return 'Invalid argument: %s\n' % e, 400
+
+    # Open db for read only
+    db = open_db(dbfile=config['FILE_LIST'], config=config, cache=True,
+                 logger=config['LOGGER_NAME'], operation='ls')
+    utils.run_blocking(db.load)
+    files = iter_file_infos(db=db,
+                            config=config,
+                            base_url=utils.build_base_url(env=request.environ),
+                            order=order,
+                            after=after,
+                            filters=filters)
+
+    headers = {}
+    if limit is not None:
+        # Fetch one more file to know if there is a next page
+        files = utils.run_blocking(list, itertools.islice(files, limit + 1))
+        if len(files) > limit:
+            files = files[:limit]
+            k, v, _infos = files[-1]
+            headers['X-Next-Cursor'] = encode_cursor(ls_position(order, k, v))
 
-def db_purge(dbfile):
+    if args.get('format') == 'ndjson':
+        return Response(_stream_ndjson(files), headers=headers,
+                        mimetype='application/x-ndjson')
+    return Response(_stream_json(files), headers=headers,
+                    mimetype='application/json')
+
+
+def db_purge(dbfile, config=None):
     """If a file is not present but present in db
     this function will clean it from the db"""
-    with JsonDB(dbfile=dbfile) as db:
-        for k, v in db.db.items():
-            elt = db.db[k]['storage_full_filename']
-            if not os.path.exists(elt):
+    with open_db(dbfile=dbfile, config=config,
+                 operation='purge') as db:
+        for k, v in list(db.iteritems()):
+            elt = v['storage_full_filename']
+            if not storage.get_storage(config).exists(elt):
                 LOG.info("%s present in db but doesn't exist" % elt)
                 db.delete(k)
+
+
+def backfill_files(dbfile, config=None):
+    """Store the size of the files uploaded before it was stored in the db,
+    return how many entries were updated"""
+    updated = 0
+    with open_db(dbfile=dbfile, config=config,
+                 operation='backfill') as db:
+        if db.lock_error:
+            LOG.warning("Can't backfill the db")
+            return False
+        for k, v in list(db.iteritems()):
+            if 'size' in v:
+                continue
+            try:
+                size = storage.get_storage(config).size(v['storage_full_filename'])
+            except OSError as e:
+                LOG.info("%s present in db but can't be read: %s" % (k, e))
+                continue
+            db.write(k, dict(v, size=size))
+            updated += 1
+    LOG.info("[BACKFILL] %d entries updated" % updated)
+    return updated
+
+
+def migrate_files(dbfile, config, batch_size=1000):
+    """Move the stored files to the UPLOAD_FOLDER_LEVELS layout, or from the
+    local disk to the storage selected by STORAGE_BACKEND.
+    The db is locked for batch_size files at a time, so pastefile can keep
+    running meanwhile. Return how many entries were migrated"""
+    store = storage.get_storage(config)
+    migrated = 0
+    while True:
+        with open_db(dbfile=dbfile, config=config,
+                     operation='migrate') as db:
+            if db.lock_error:
+                LOG.warning("Can't migrate the files, %d migrated" % migrated)
+                return False
+            todo = itertools.islice(
+                ((k, v) for k, v in db.iteritems()
+                 if v['storage_full_filename'] != storage_path(k, config)),
+                batch_size)
+            todo = list(todo)
+            for k, v in todo:
+                dest = storage_path(k, config)
+                try:
+                    store.put(v['storage_full_filename'], dest)
+                except OSError as e:
+                    # Already moved, or missing and left to db_purge
+                    if not store.exists(dest):
+                        LOG.info("%s can't be moved: %s" % (k, e))
+                db.write(k, dict(v, storage_full_filename=dest))
+            migrated += len(todo)
+        LOG.info("[MIGRATE] %d entries migrated" % migrated)
+        if len(todo) < batch_size:
+            return migrated
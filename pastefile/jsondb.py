@@ -1,27 +1,124 @@
 #!/usr/bin/python
 
 import json
+import heapq
+import errno
 import logging
 import fcntl
+import signal
+import threading
 import time
 import os
+from pastefile import stats
+from pastefile import utils
 
 
-def timeout(timeout=3, start=None):
-    now = int(time.time())
-    if (now - start) >= 3:
+# Parsed db shared by every JsonDB(cache=True) of the process:
+# {dbfile: (signature, db, usage)}
+_CACHE = {}
+
+# Wait for a lock in a blocking flock interrupted by SIGALRM when possible,
+# see _blocking_flock. Must be disabled if a blocking syscall would block
+# other threads of execution (gevent)
+BLOCKING_WAIT = True
+
+# Max delay between two tries of the threads waiting for a lock
+MAX_RETRY_DELAY = 0.05
+
+# SIGALRM is sent again at this interval after the timeout, in case the
+# first one fired before flock started waiting
+ALARM_INTERVAL = 0.05
+
+
+def _interrupt(signum, frame):
+    "SIGALRM handler, the interrupted flock fails with EINTR"
+
+
+def _blocking_flock(fd, mode, timeout):
+    """Wait for the lock in a blocking flock, interrupted after timeout
+       seconds. Return None if SIGALRM can't be used: outside of the main
+       thread, or already used by someone else"""
+    if signal.getsignal(signal.SIGALRM) not in (signal.SIG_DFL, None) or \
+            signal.getitimer(signal.ITIMER_REAL)[0]:
+        return None
+    try:
+        signal.signal(signal.SIGALRM, _interrupt)
+    except ValueError:
+        # Not the main thread
+        return None
+    try:
+        signal.setitimer(signal.ITIMER_REAL, timeout, ALARM_INTERVAL)
+        fcntl.flock(fd, mode)
         return True
-    return False
+    except IOError as e:
+        if e.errno != errno.EINTR:
+            raise
+        return False
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+
+
+def wait_flock(fd, mode, timeout):
+    "flock fd in mode (LOCK_SH or LOCK_EX), return False after timeout seconds"
+    start = time.time()
+    delay = 0.001
+    while True:
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            return True
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            return False
+        if BLOCKING_WAIT:
+            locked = _blocking_flock(fd, mode, remaining)
+            if locked is not None:
+                return locked
+        # Other threads retry with an exponential backoff
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, MAX_RETRY_DELAY)
 
 
 class JsonDB(object):
-    def __init__(self, dbfile, logger=__name__, timeout=60, tmp_dir='/tmp'):
+    """Dictionary stored as a json file.
+
+    In journal mode, save() does not rewrite the whole file but appends the
+    mutations done with write() and delete() as json lines to a journal
+    next to the db. load() replays the journal on top of the snapshot, and
+    the journal is folded into a new snapshot by compact() once it grows
+    over compact_size bytes.
+
+    With cache=True, load() reuses the db parsed by a previous load() of
+    the process as long as the snapshot and the journal are unchanged
+    (same inode, mtime and size).
+
+    usage() is computed once per parse of the db, and cached with it, then
+    kept up to date by write() and delete()."""
+
+    def __init__(self, dbfile, logger=__name__, timeout=60, tmp_dir='/tmp',
+                 journal=False, compact_size=1048576, cache=False,
+                 operation='db'):
         self._dbfile = dbfile
+        self._journal_file = '%s.journal' % dbfile
         self._logger = logging.getLogger(logger)
         self.db = {}
         self._timeout = timeout
         self.lock_error = False
         self._tmp_dir = tmp_dir
+        self._journal = journal
+        self._compact_size = compact_size
+        self._pending = []
+        self._cache = cache
+        # True while self.db is the dict shared through _CACHE
+        self._shared = False
+        # What the lock is taken for, in the lock statistics
+        self._operation = operation
+        self._f = None
+        # [stored bytes, files], see usage
+        self._usage = None
 
     def __enter__(self):
         if not self._lock():
@@ -31,51 +128,296 @@ class JsonDB(object):
 
     def __exit__(self, type, value, traceback):
         if not self.lock_error:
-            self.save()
+            # Nothing is saved if the block raised
+            if type is None:
+                self.save()
             self._release()
 
+    def __contains__(self, key):
+        return key in self.db
+
     def _lock(self):
-        self._start = int(time.time())
-        # Open the file for lock only. If the file does not exist,
+        "Take the exclusive lock of the writers"
+        return self._acquire(fcntl.LOCK_EX, 'exclusive')
+
+    def _lock_shared(self):
+        "Take the shared lock of the readers"
+        return self._acquire(fcntl.LOCK_SH, 'shared')
+
+    def _acquire(self, mode, mode_name):
+        self._start = time.time()
+        # Open a dedicated file for lock only. The db file itself is
+        # replaced on save, so a lock held on it would not be seen by
+        # processes that open the new one. If the file does not exist,
         # it will be created
         try:
-            self._f = open(self._dbfile, 'a')
+            self._f = open('%s.lock' % self._dbfile, 'a')
         except IOError as e:
             self._logger.error('Error opening db file: %s' % e)
+            self._f = None
             return False
-        while True:
-            try:
-                fcntl.flock(self._f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                return True
-            except IOError:
-                time.sleep(0.01)
-                if timeout(timeout=self._timeout, start=self._start):
-                    self._logger.critical('Unable to lock')
-                    self._f.close()
-                    return False
+        locked = wait_flock(self._f.fileno(), mode, self._timeout)
+        self._locked_at = time.time()
+        self._mode = mode_name
+        stats.observe('db_lock_wait_seconds', self._locked_at - self._start,
+                      operation=self._operation, mode=mode_name)
+        if not locked:
+            stats.increment('db_lock_timeouts_total',
+                            operation=self._operation, mode=mode_name)
+            self._logger.critical('Unable to lock after %ss' % self._timeout)
+            self._f.close()
+            self._f = None
+            return False
+        return True
 
     def _release(self):
+        if self._f is None:
+            return
         self._f.close()
+        self._f = None
+        stats.observe('db_lock_hold_seconds', time.time() - self._locked_at,
+                      operation=self._operation, mode=self._mode)
+
+    def _signature(self):
+        signature = []
+        for path in (self._dbfile, self._journal_file):
+            try:
+                st = os.stat(path)
+                signature.append((st.st_ino, st.st_mtime, st.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
 
     def load(self):
+        if not self._cache:
+            return self._load()
+        # Take the signature before reading, so a change done while we
+        # read is seen on the next load
+        signature = self._signature()
+        cached = _CACHE.get(self._dbfile)
+        if cached is not None and cached[0] == signature:
+            stats.increment('db_cache_total', result='hit')
+            self.db = cached[1]
+            self._usage = list(cached[2])
+        else:
+            stats.increment('db_cache_total', result='miss')
+            self._logger.debug('Reloading %s' % self._dbfile)
+            self.db = {}
+            self._load()
+            _CACHE[self._dbfile] = (signature, self.db, self.usage())
+        self._shared = True
+        self._pending = []
+
+    def _unshare(self):
+        "Copy the cached db before modifying it"
+        if self._shared:
+            self.db = dict(self.db)
+            self._shared = False
+
+    def _load(self):
+        self._shared = False
+        # Readers hold the shared lock while they read the snapshot and the
+        # journal. If it can't be taken in time, read anyway: the snapshot
+        # is replaced atomically
+        locked = self._f is None and not self.lock_error and self._lock_shared()
+        start = time.time()
+        size = 0
         try:
-            self.db = json.load(open(self._dbfile, 'r'))
-        except (IOError, AttributeError, ValueError) as e:
-            self._logger.debug("Can't load file: %s" % e)
+            # Open the journal before the snapshot: compact() replaces the
+            # snapshot before the journal, so we never miss an entry
+            try:
+                journal = open(self._journal_file, 'r')
+            except IOError:
+                journal = None
+            try:
+                with open(self._dbfile, 'r') as f:
+                    size += os.fstat(f.fileno()).st_size
+                    self.db = json.load(f)
+            except (IOError, AttributeError, ValueError) as e:
+                self._logger.debug("Can't load file: %s" % e)
+            if journal is not None:
+                with journal:
+                    size += os.fstat(journal.fileno()).st_size
+                    self._replay(journal)
+        finally:
+            if locked:
+                self._release()
+        stats.observe('db_load_seconds', time.time() - start, backend='json')
+        stats.increment('db_load_bytes_total', size, backend='json')
+        self._pending = []
+        self._usage = None
+
+    def _replay(self, journal):
+        for line in journal:
+            try:
+                if not line.endswith('\n'):
+                    raise ValueError('truncated line')
+                entry = json.loads(line)
+            except ValueError as e:
+                # Torn write, it will be truncated on next save
+                self._logger.warning('Ignoring journal tail: %s' % e)
+                return
+            if entry['op'] == 'write':
+                self.db[entry['key']] = entry['value']
+            elif entry['op'] == 'delete':
+                self.db.pop(entry['key'], None)
 
     def save(self):
+        if self._journal:
+            return self._save_journal()
+        self._save_snapshot()
+        # The snapshot now contains everything, drop a leftover journal
+        if os.path.exists(self._journal_file):
+            try:
+                os.remove(self._journal_file)
+            except OSError as e:
+                self._logger.error('Error while removing the journal: %s' % e)
+
+    def _save_snapshot(self):
+        start = time.time()
         try:
             tmp_file = '%s.atomic' % self._dbfile
-            json.dump(self.db, open(tmp_file, 'w'))
+            with open(tmp_file, 'w') as f:
+                json.dump(self.db, f)
+                size = f.tell()
             os.rename(tmp_file, self._dbfile)
-        except OSError as e:
+        except (IOError, OSError) as e:
             self._logger.error('Error while saving the db: %s' % e)
+            return False
+        stats.observe('db_save_seconds', time.time() - start, backend='json')
+        stats.increment('db_save_bytes_total', size, backend='json')
+        return True
+
+    def _save_journal(self):
+        if not self._pending:
+            return
+        start = time.time()
+        try:
+            with open(self._journal_file, 'a+') as journal:
+                self._truncate_torn_tail(journal)
+                entries = ''.join('%s\n' % json.dumps(entry)
+                                  for entry in self._pending)
+                journal.write(entries)
+                journal.flush()
+                size = journal.tell()
+        except (IOError, OSError) as e:
+            self._logger.error('Error while writing the journal: %s' % e)
+            return
+        stats.observe('db_save_seconds', time.time() - start, backend='json')
+        stats.increment('db_save_bytes_total', len(entries), backend='json')
+        self._pending = []
+        if size > self._compact_size:
+            compaction = threading.Thread(target=JsonDB(
+                dbfile=self._dbfile, logger=self._logger.name,
+                timeout=self._timeout, journal=True,
+                operation='compact').compact)
+            compaction.daemon = True
+            compaction.start()
+
+    def _truncate_torn_tail(self, journal):
+        "Cut a partially written last line left by a crash"
+        journal.seek(0, os.SEEK_END)
+        end = journal.tell()
+        if end == 0:
+            return
+        journal.seek(end - 1)
+        if journal.read(1) == '\n':
+            return
+        pos = end
+        while pos > 0:
+            step = min(4096, pos)
+            pos -= step
+            journal.seek(pos)
+            chunk = journal.read(step)
+            newline = chunk.rfind('\n')
+            if newline != -1:
+                pos += newline + 1
+                break
+        self._logger.warning('Truncating torn journal tail at %d' % pos)
+        journal.truncate(pos)
+        journal.seek(pos)
+
+    def compact(self):
+        "Fold the journal into a new snapshot"
+        if not self._lock():
+            self._logger.warning('Unable to compact the journal')
+            return False
+        try:
+            self.load()
+            if not self._save_snapshot():
+                return False
+            # Replace the journal by an empty one, readers that already
+            # opened the previous journal keep reading it
+            tmp_file = '%s.atomic' % self._journal_file
+            open(tmp_file, 'w').close()
+            os.rename(tmp_file, self._journal_file)
+        except (IOError, OSError) as e:
+            self._logger.error('Error while compacting the journal: %s' % e)
+            return False
+        finally:
+            self._release()
+        return True
+
+    def _account(self, infos, sign):
+        if self._usage is not None and infos is not None:
+            self._usage[0] += sign * utils.stored_size(infos)
+            self._usage[1] += sign
+            self._usage[2] += sign * infos.get('size', 0)
 
     def delete(self, key):
+        self._unshare()
+        self._account(self.db[key], -1)
         del self.db[key]
+        self._pending.append({'op': 'delete', 'key': key})
 
     def read(self, key):
         return self.db.get(key)
 
     def write(self, key, value):
+        self._unshare()
+        self._account(self.db.get(key), -1)
+        self._account(value, 1)
         self.db[key] = value
+        self._pending.append({'op': 'write', 'key': key, 'value': value})
+
+    def iteritems(self):
+        return self.db.iteritems()
+
+    def scan(self, order='timestamp', after=None):
+        """Iterate over the entries sorted by timestamp or by key (order='id'),
+           starting after the position after: (timestamp, key) or key"""
+        if order == 'id':
+            position = lambda item: item[0]
+        else:
+            position = lambda item: (int(item[1]['timestamp']), item[0])
+        for item in sorted(self.db.iteritems(), key=position):
+            if after is not None and position(item) <= after:
+                continue
+            yield item
+
+    def usage(self):
+        "Return the stored bytes, the number of files and their size before compression"
+        if self._usage is None:
+            self._usage = [sum(utils.stored_size(v) for v in self.db.itervalues()),
+                           len(self.db),
+                           sum(v.get('size', 0) for v in self.db.itervalues())]
+        return tuple(self._usage)
+
+    def oldest(self):
+        """Iterate over the keys, oldest first. Only the entries consumed are
+           sorted, the db can be modified meanwhile"""
+        heap = [(int(v['timestamp']), k) for k, v in self.db.iteritems()]
+        heapq.heapify(heap)
+        while heap:
+            yield heapq.heappop(heap)[1]
+
+    def expired(self, before):
+        "Return the keys of the entries older than the before timestamp, oldest first"
+        return [k for timestamp, k in sorted((int(v['timestamp']), k)
+                                             for k, v in self.db.iteritems()
+                                             if int(v['timestamp']) < before)]
+
+    def burned(self):
+        "Return the keys of the burn after read files marked 'Burned'"
+        return [k for k, v in self.db.iteritems()
+                if v.get('burn_after_read') == 'Burned']
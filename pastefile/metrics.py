@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""/metrics in the Prometheus text format.
+
+Each worker process dumps its samples (see pastefile.stats) to
+METRICS_FOLDER/metrics-<pid>-<start time>.json, at most every DUMP_INTERVAL
+seconds. /metrics sums the files of every process with the live samples of
+the process serving it. The files of the processes that exited are summed
+into EXITED_FILE, so the counters never go backward when uwsgi respawns a
+worker, and the folder does not grow with every respawn."""
+
+import os
+import re
+import time
+import errno
+import fcntl
+import logging
+from flask import Response
+from pastefile import stats
+from pastefile import controller
+
+LOG = logging.getLogger(__name__)
+
+PREFIX = 'pastefile_'
+
+DUMP_INTERVAL = 1
+
+EXITED_FILE = 'metrics-exited.json'
+
+# Files of the worker processes, the ones without a start time are dumped
+# by older versions
+_WORKER_FILE = re.compile(r'^metrics-(\d+)(-\d+)?\.json$')
+
+HELP = {
+    'request_duration_seconds': ('histogram', 'Time to build the response of a request'),
+    'uploaded_bytes_total': ('counter', 'Bytes of the uploaded files'),
+    'downloaded_bytes_total': ('counter', 'Bytes of the downloaded files'),
+    'dedup_hits_total': ('counter', 'Uploads of a file already stored'),
+    'db_load_seconds': ('histogram', 'Time to read the db'),
+    'db_load_bytes_total': ('counter', 'Bytes read from the db'),
+    'db_save_seconds': ('histogram', 'Time to write the db'),
+    'db_save_bytes_total': ('counter', 'Bytes written to the db'),
+    'db_lock_wait_seconds': ('histogram', 'Time waited for the lock of the db'),
+    'db_lock_hold_seconds': ('histogram', 'Time the lock of the db was held'),
+    'db_lock_timeouts_total': ('counter', 'Locks of the db not acquired in time'),
+    'db_cache_total': ('counter', 'Loads of the json db served by the cache of the process, or parsed'),
+    'type_detection_seconds': ('histogram', 'Time to detect the type of a file'),
+    'clean_removed_files_total': ('counter', 'Expired or burned files removed'),
+    'evicted_files_total': ('counter', 'Files removed to stay under MAX_STORAGE_BYTES and MAX_FILES'),
+    'evicted_bytes_total': ('counter', 'Stored bytes of the evicted files'),
+    'files': ('gauge', 'Files in the db'),
+    'files_bytes': ('gauge', 'Size of the files in the db, before compression'),
+    'stored_bytes': ('gauge', 'Size of the files in the storage'),
+    'db_size_bytes': ('gauge', 'Size of the db on disk'),
+}
+
+# Time of the last dump of the process
+_LAST_DUMP = [0]
+
+# Id of the worker process, set after the fork: a respawned worker reusing
+# a pid does not overwrite the samples of the previous one
+_WORKER = {}
+
+
+def metrics_folder(config):
+    if config['METRICS_FOLDER']:
+        return config['METRICS_FOLDER']
+    return os.path.join(config['TMP_FOLDER'], 'metrics')
+
+
+def worker_id():
+    "pid and start time, in ms, of the process"
+    pid = os.getpid()
+    if _WORKER.get('pid') != pid:
+        _WORKER['pid'] = pid
+        _WORKER['id'] = '%d-%d' % (pid, time.time() * 1000)
+    return _WORKER['id']
+
+
+def _dump_file(folder, worker):
+    return os.path.join(folder, 'metrics-%s.json' % worker)
+
+
+def _exited(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+def _fold_exited(folder, filenames):
+    """Sum the files of the exited processes into EXITED_FILE and remove
+       them. Return the files left"""
+    exited = [filename for filename in filenames
+              if _exited(int(_WORKER_FILE.match(filename).group(1)))]
+    if not exited:
+        return filenames
+    accumulated = os.path.join(folder, EXITED_FILE)
+    snapshots = [stats.load(os.path.join(folder, filename))
+                 for filename in exited]
+    if os.path.isfile(accumulated):
+        snapshots.append(stats.load(accumulated))
+    stats.dump(accumulated, stats.merge(snapshots))
+    for filename in exited:
+        os.remove(os.path.join(folder, filename))
+    LOG.info("[METRICS] Samples of %d exited processes folded" % len(exited))
+    return [filename for filename in filenames if filename not in exited]
+
+
+def dump_process(config, force=False):
+    "Dump the samples of the process, unless it was done less than DUMP_INTERVAL ago"
+    now = time.time()
+    if not force and now - _LAST_DUMP[0] < DUMP_INTERVAL:
+        return
+    _LAST_DUMP[0] = now
+    folder = metrics_folder(config)
+    try:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        stats.dump(_dump_file(folder, worker_id()))
+    except (IOError, OSError) as e:
+        LOG.error("Can't dump the metrics: %s" % e)
+
+
+def collect(config):
+    "Return the samples of every process"
+    folder = metrics_folder(config)
+    snapshots = [stats.snapshot()]
+    if not os.path.isdir(folder):
+        return stats.merge(snapshots)
+    own = os.path.basename(_dump_file(folder, worker_id()))
+    # The files are folded and read by one process at a time, so that the
+    # samples of an exited process are counted once
+    with open(os.path.join(folder, 'metrics.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        filenames = [filename for filename in os.listdir(folder)
+                     if _WORKER_FILE.match(filename) and filename != own]
+        try:
+            filenames = _fold_exited(folder, filenames)
+        except (IOError, OSError, ValueError) as e:
+            LOG.warning("Can't fold the metrics of the exited processes: %s" % e)
+        if os.path.isfile(os.path.join(folder, EXITED_FILE)):
+            filenames.append(EXITED_FILE)
+        for filename in filenames:
+            filename = os.path.join(folder, filename)
+            try:
+                snapshots.append(stats.load(filename))
+            except (IOError, OSError, ValueError) as e:
+                LOG.warning("Can't read the metrics of %s: %s" % (filename, e))
+    return stats.merge(snapshots)
+
+
+def storage_gauges(config):
+    "Return the gauges of the db, from the totals it keeps up to date"
+    db = controller.open_db(dbfile=config['FILE_LIST'], config=config,
+                            cache=True, operation='metrics')
+    db.load()
+    stored_bytes, files, files_bytes = db.usage()
+    if config['DB_BACKEND'] == 'sqlite':
+        db_files = ['%s.sqlite' % config['FILE_LIST'],
+                    '%s.sqlite-wal' % config['FILE_LIST']]
+    else:
+        db_files = [config['FILE_LIST'], '%s.journal' % config['FILE_LIST']]
+    db_size = 0
+    for db_file in db_files:
+        try:
+            db_size += os.stat(db_file).st_size
+        except OSError:
+            pass
+    return {('files', ()): files,
+            ('files_bytes', ()): files_bytes,
+            ('stored_bytes', ()): stored_bytes,
+            ('db_size_bytes', ()): db_size}
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def _format_bound(bound):
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(bound)
+
+
+def render(counters, histograms, gauges):
+    "Return the samples in the Prometheus text format"
+    # {name: [(labels, lines)]}
+    samples = {}
+    for (name, labels), value in counters.items() + gauges.items():
+        samples.setdefault(name, []).append((labels, [
+            '%s%s%s %s' % (PREFIX, name, _format_labels(labels), value)]))
+    for (name, labels), histogram in histograms.iteritems():
+        lines = []
+        cumulated = 0
+        for bound, count in zip(stats.BUCKETS, histogram['buckets']):
+            cumulated += count
+            lines.append('%s%s_bucket%s %d' % (
+                PREFIX, name,
+                _format_labels(labels + (('le', _format_bound(bound)),)),
+                cumulated))
+        lines.append('%s%s_sum%s %r' % (PREFIX, name, _format_labels(labels),
+                                        histogram['sum']))
+        lines.append('%s%s_count%s %d' % (PREFIX, name, _format_labels(labels),
+                                          histogram['count']))
+        samples.setdefault(name, []).append((labels, lines))
+
+    output = []
+    for name in sorted(samples):
+        if name in HELP:
+            output.append('# HELP %s%s %s' % (PREFIX, name, HELP[name][1]))
+            output.append('# TYPE %s%s %s' % (PREFIX, name, HELP[name][0]))
+        for labels, lines in sorted(samples[name]):
+            output.extend(lines)
+    return '%s\n' % '\n'.join(output)
+
+
+def metrics_response(config):
+    counters, histograms = collect(config)
+    return Response(render(counters, histograms, storage_gauges(config)),
+                    mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from pastefile import controller
+from pastefile import sessions
+from pastefile import metrics
+
+try:
+    import uwsgi
+except ImportError:
+    # Not served by uwsgi
+    uwsgi = None
+
+LOG = logging.getLogger(__name__)
+
+# Maintenance thread of this process, see start_maintenance_thread
+_THREAD = None
+
+
+def run_maintenance(config):
+    "Run the periodic tasks once"
+    controller.clean_files(dbfile=config['FILE_LIST'],
+                           expire=config['EXPIRE'],
+                           config=config)
+    sessions.clean_sessions(config=config)
+
+
+class MaintenanceThread(threading.Thread):
+    "Run the periodic tasks every interval seconds, out of the request path"
+
+    def __init__(self, config, interval):
+        super(MaintenanceThread, self).__init__(name='pastefile-maintenance')
+        self.daemon = True
+        self._config = config
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                run_maintenance(config=self._config)
+            except Exception:
+                LOG.exception('Error during the maintenance')
+            # Samples of an idle worker are dumped too
+            metrics.dump_process(config=self._config, force=True)
+
+    def stop(self):
+        self._stopped.set()
+
+
+def threads_enabled():
+    "False under uwsgi without enable-threads (or threads): a thread would never run"
+    if uwsgi is None:
+        return True
+    return bool(uwsgi.opt.get('enable-threads') or uwsgi.opt.get('threads'))
+
+
+def start_maintenance_thread(config):
+    "Start the maintenance thread of the process, if not already started"
+    global _THREAD
+    if _THREAD is not None and _THREAD.is_alive():
+        return _THREAD
+    _THREAD = MaintenanceThread(config=config,
+                                interval=int(config['CLEAN_INTERVAL']))
+    _THREAD.start()
+    LOG.info('Maintenance thread started, running every %s seconds'
+             % config['CLEAN_INTERVAL'])
+    return _THREAD
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Resumable chunked uploads.
+
+A session is created with the size of the file, then its chunks are sent
+by offset, in any order and in parallel. Chunks are written in place in
+TMP_FOLDER/session-<id>, and the received ranges are kept in
+TMP_FOLDER/session-<id>.json. Once every byte is received, the session
+is finalized and the file goes through the same registration as a
+regular upload."""
+
+import os
+import re
+import glob
+import time
+import uuid
+import logging
+from functools import partial
+from pastefile import utils
+from pastefile import controller
+from jsondb import JsonDB
+from werkzeug import secure_filename
+
+LOG = logging.getLogger(__name__)
+
+SESSION_ID = re.compile('^[0-9a-f]{32}$')
+
+
+class SessionGone(Exception):
+    "The session was finalized or deleted while waiting for its lock"
+
+
+def _data_file(session_id, config):
+    return os.path.join(config['TMP_FOLDER'], 'session-%s' % session_id)
+
+
+def _meta_file(session_id, config):
+    return '%s.json' % _data_file(session_id, config)
+
+
+def merge_ranges(ranges):
+    "Merge a list of [start, end) ranges"
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def session_status(session_id, session, base_url):
+    return {
+        'id': session_id,
+        'url': '%s/uploads/%s' % (base_url, session_id),
+        'name': session.read('real_name'),
+        'size': session.read('size'),
+        'received': session.read('received'),
+    }
+
+
+def _check_session(session_id, session, config):
+    """Raise SessionGone if the locked session was removed meanwhile, it
+       must not be saved back"""
+    if session.read('size') is None or session.read('received') is None or \
+            not os.path.isfile(_data_file(session_id, config)):
+        raise SessionGone(session_id)
+
+
+def _open_session(session_id, config):
+    "Return the JsonDB of a session, None if it does not exist"
+    if not SESSION_ID.match(session_id):
+        return None
+    meta_file = _meta_file(session_id, config)
+    if not os.path.isfile(meta_file):
+        return None
+    return JsonDB(dbfile=meta_file, timeout=float(config['DB_LOCK_TIMEOUT']),
+                  operation='session')
+
+
+def create_session(request, config):
+    "Create a session for a file of `size` bytes, return its status or None"
+    try:
+        size = int(request.values['size'])
+        if size < 0:
+            raise ValueError('negative size')
+        if config['MAX_STORAGE_BYTES'] and size > int(config['MAX_STORAGE_BYTES']):
+            raise ValueError('bigger than MAX_STORAGE_BYTES')
+    except (KeyError, ValueError) as e:
+        LOG.info("[UPLOADS] Invalid size: %s" % e)
+        return None
+    session_id = uuid.uuid4().hex
+    session = utils.run_blocking(
+        _create_session, session_id=session_id, size=size,
+        filename=secure_filename(request.values.get('filename', '')),
+        burn_after_read=bool(request.values.getlist('burn')),
+        config=config)
+    LOG.info("[UPLOADS] Client %s has created the session %s (%d bytes)"
+             % (request.remote_addr, session_id, size))
+    return session_status(session_id, session,
+                          utils.build_base_url(env=request.environ))
+
+
+def _create_session(session_id, size, filename, burn_after_read, config):
+    # Sparse file filled by the chunks
+    with open(_data_file(session_id, config), 'wb') as f:
+        f.truncate(size)
+    with JsonDB(dbfile=_meta_file(session_id, config),
+                timeout=float(config['DB_LOCK_TIMEOUT']),
+                operation='session') as session:
+        session.write('real_name', filename)
+        session.write('burn_after_read', burn_after_read)
+        session.write('size', size)
+        session.write('received', [])
+        session.write('created', int(time.time()))
+    return session
+
+
+def get_session(session_id, request, config):
+    session = _open_session(session_id, config)
+    if session is None:
+        return None
+    utils.run_blocking(session.load)
+    return session_status(session_id, session,
+                          utils.build_base_url(env=request.environ))
+
+
+def put_chunk(session_id, request, config, chunksize=2**16):
+    """Write the request body at `offset` in the session file.
+       Return the session status, None if the session does not exist,
+       or an error message and its status code"""
+    session = _open_session(session_id, config)
+    if session is None:
+        return None
+    utils.run_blocking(session.load)
+    size = session.read('size')
+    try:
+        offset = int(request.args.get('offset', 0))
+        if offset < 0 or offset > size:
+            raise ValueError('offset out of the file')
+    except ValueError:
+        return 'Invalid offset\n', 400
+
+    written = 0
+    try:
+        f = open(_data_file(session_id, config), 'r+b')
+    except IOError:
+        # Finalized or deleted meanwhile
+        return None
+    with f:
+        f.seek(offset)
+        for chunk in iter(partial(request.stream.read, chunksize), b''):
+            if offset + written + len(chunk) > size:
+                return 'Chunk goes beyond the size of the file\n', 400
+            f.write(chunk)
+            written += len(chunk)
+
+    session = utils.run_blocking(_add_received, session_id=session_id,
+                                 start=offset, end=offset + written,
+                                 config=config)
+    if session is None or isinstance(session, tuple):
+        return session
+    return session_status(session_id, session,
+                          utils.build_base_url(env=request.environ))
+
+
+def _add_received(session_id, start, end, config):
+    """Add [start, end) to the received ranges of a session. Return the
+       session, None if it does not exist anymore, or an error message and
+       its status code"""
+    # Only the list of received ranges needs the lock,
+    # chunks are written in parallel
+    try:
+        with JsonDB(dbfile=_meta_file(session_id, config),
+                    timeout=float(config['DB_LOCK_TIMEOUT']),
+                    operation='session') as session:
+            if session.lock_error:
+                return 'Lock timed out\n', 503
+            _check_session(session_id, session, config)
+            session.write('received', merge_ranges(session.read('received') +
+                                                   [[start, end]]))
+    except SessionGone:
+        # Only its lock file was created again
+        _remove_session(session_id, config)
+        return None
+    return session
+
+
+def _remove_session(session_id, config):
+    data_file = _data_file(session_id, config)
+    for filename in [data_file, '%s.json' % data_file, '%s.json.lock' % data_file]:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+def finalize_session(session_id, request, config):
+    """Register the file of a complete session. Return the url of the file,
+       None if the session does not exist, or an error message and its
+       status code"""
+    session = _open_session(session_id, config)
+    if session is None:
+        return None
+    file_md5 = utils.run_blocking(_register_session, session_id=session_id,
+                                  session=session, config=config)
+    if file_md5 is None or isinstance(file_md5, tuple):
+        return file_md5
+
+    LOG.info("[UPLOADS] Client %s has successfully uploaded: %s (%s)"
+             % (request.remote_addr, controller.storage_path(file_md5, config),
+                file_md5))
+    return "%s/%s\n" % (utils.build_base_url(env=request.environ), file_md5)
+
+
+def _register_session(session_id, session, config):
+    """Store the file of a complete session and remove the session. Return
+       the md5 of the file, None if the session does not exist anymore, or
+       an error message and its status code"""
+    try:
+        with session:
+            if session.lock_error:
+                return 'Lock timed out\n', 503
+            _check_session(session_id, session, config)
+            size = session.read('size')
+            if size and session.read('received') != [[0, size]]:
+                return 'Upload not complete, received %s of %d bytes\n' % (
+                    session.read('received'), size), 400
+
+            data_file = _data_file(session_id, config)
+            file_md5 = utils.get_digest(data_file, config['HASH_ALGORITHM'])
+            with open(data_file, 'rb') as f:
+                head = f.read(utils.HEAD_SIZE)
+            storage_full_filename = controller.store_file(
+                tmp_full_filename=data_file,
+                file_md5=file_md5,
+                head=head,
+                size=size,
+                filename=session.read('real_name'),
+                burn_after_read=session.read('burn_after_read'),
+                config=config,
+                keep_on_error=True)
+            if not storage_full_filename:
+                # The session is kept, finalize can be retried
+                return 'Unable to upload the file, try again later ...\n', 503
+    except SessionGone:
+        # Only its lock file was created again
+        _remove_session(session_id, config)
+        return None
+    _remove_session(session_id, config)
+    return file_md5
+
+
+def delete_session(session_id, config):
+    if _open_session(session_id, config) is None:
+        return False
+    _remove_session(session_id, config)
+    return True
+
+
+def clean_sessions(config):
+    "Remove the sessions without activity for UPLOAD_SESSION_EXPIRE seconds"
+    before = time.time() - int(config['UPLOAD_SESSION_EXPIRE'])
+    removed = 0
+    for meta_file in glob.glob(os.path.join(config['TMP_FOLDER'], 'session-*.json')):
+        try:
+            if os.stat(meta_file).st_mtime >= before:
+                continue
+        except OSError:
+            continue
+        session_id = os.path.basename(meta_file)[len('session-'):-len('.json')]
+        LOG.info("[UPLOADS] Removing abandoned session %s" % session_id)
+        _remove_session(session_id, config)
+        removed += 1
+    return removed
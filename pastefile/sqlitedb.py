@@ -0,0 +1,308 @@
+#!/usr/bin/python
+
+import json
+import time
+import thread
+import logging
+import sqlite3
+from pastefile import stats
+from pastefile import utils
+from pastefile.jsondb import JsonDB
+
+
+class SqliteDB(object):
+    """Metadata store backed by SQLite in WAL mode.
+
+    Exposes the same interface as JsonDB (context manager, load, read,
+    write, delete, iteritems, `in`), but entries are stored one row per
+    md5, so a write or a delete only touches a single row, and readers
+    never block the writer. The stored bytes and the number of files are
+    kept up to date in the usage table by write and delete.
+    Each thread uses its own connection: with the gevent server, the
+    blocking work and the response bodies run in a pool of threads.
+    If `import_from` points to an existing JsonDB file, its entries are
+    imported the first time the database is created."""
+
+    SCHEMA_VERSION = 4
+
+    # Rows read at once by scan and oldest
+    BATCH = 100
+
+    def __init__(self, dbfile, logger=__name__, timeout=60, import_from=None,
+                 operation='db'):
+        self._dbfile = dbfile
+        self._logger = logging.getLogger(logger)
+        self._timeout = timeout
+        self._import_from = import_from
+        # Connection of the current thread, see _connect
+        self._conn = None
+        self._conns = {}
+        self._in_transaction = False
+        self.lock_error = False
+        # What the lock is taken for, in the lock statistics
+        self._operation = operation
+        self._locked_at = None
+
+    def __enter__(self):
+        if not self._lock():
+            self.lock_error = True
+        self.load()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if not self.lock_error:
+            # Nothing is saved if the block raised
+            if type is None:
+                self.save()
+            self._release()
+
+    def __contains__(self, key):
+        return self.read(key) is not None
+
+    def _connect(self):
+        """Return the connection of the current thread, sqlite connections
+           can't be shared between threads. A locked db is only used by
+           the thread which locked it"""
+        self._conn = self._conns.get(thread.get_ident())
+        if self._conn is not None:
+            return self._conn
+        # isolation_level=None: transactions are explicitly handled by
+        # _lock and save
+        self._conn = sqlite3.connect(self._dbfile,
+                                     timeout=self._timeout,
+                                     isolation_level=None)
+        self._conns[thread.get_ident()] = self._conn
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._init_schema()
+        return self._conn
+
+    def _init_schema(self):
+        version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another worker may have created the schema while we waited
+            version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < 1:
+                self._conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                                   'md5 TEXT PRIMARY KEY, '
+                                   'timestamp INTEGER NOT NULL, '
+                                   'infos TEXT NOT NULL)')
+                self._conn.execute('CREATE INDEX IF NOT EXISTS files_timestamp '
+                                   'ON files (timestamp)')
+            if version < 2:
+                self._add_usage()
+            if version < 3:
+                self._add_burned()
+            if version < 4:
+                self._add_original_size()
+            if version < 1:
+                self._import_jsondb()
+            if version < self.SCHEMA_VERSION:
+                self._conn.execute('PRAGMA user_version = %d'
+                                   % self.SCHEMA_VERSION)
+            self._conn.execute('COMMIT')
+        except sqlite3.Error:
+            self._conn.execute('ROLLBACK')
+            raise
+
+    def _add_usage(self):
+        "Stored size of each file, and their total in the usage table"
+        self._conn.execute('ALTER TABLE files ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+        for key, infos in self._conn.execute('SELECT md5, infos FROM files').fetchall():
+            self._conn.execute('UPDATE files SET size = ? WHERE md5 = ?',
+                               (utils.stored_size(json.loads(infos)), key))
+        self._conn.execute('CREATE TABLE usage ('
+                           'bytes INTEGER NOT NULL, '
+                           'files INTEGER NOT NULL)')
+        self._conn.execute('INSERT INTO usage SELECT COALESCE(SUM(size), 0), COUNT(*) '
+                           'FROM files')
+
+    def _add_burned(self):
+        "Index of the burn after read files marked 'Burned'"
+        self._conn.execute('ALTER TABLE files ADD COLUMN burned INTEGER NOT NULL DEFAULT 0')
+        for key, infos in self._conn.execute('SELECT md5, infos FROM files').fetchall():
+            if json.loads(infos).get('burn_after_read') == 'Burned':
+                self._conn.execute('UPDATE files SET burned = 1 WHERE md5 = ?', (key,))
+        self._conn.execute('CREATE INDEX files_burned ON files (burned)')
+
+    def _add_original_size(self):
+        "Size before compression of each file, and their total in the usage table"
+        self._conn.execute('ALTER TABLE files ADD COLUMN original_size INTEGER NOT NULL DEFAULT 0')
+        self._conn.execute('ALTER TABLE usage ADD COLUMN original_bytes INTEGER NOT NULL DEFAULT 0')
+        for key, infos in self._conn.execute('SELECT md5, infos FROM files').fetchall():
+            self._conn.execute('UPDATE files SET original_size = ? WHERE md5 = ?',
+                               (json.loads(infos).get('size', 0), key))
+        self._conn.execute('UPDATE usage SET original_bytes = '
+                           '(SELECT COALESCE(SUM(original_size), 0) FROM files)')
+
+    def _import_jsondb(self):
+        if not self._import_from:
+            return
+        # The entries of the journal are replayed over the snapshot
+        jsondb = JsonDB(dbfile=self._import_from, logger=self._logger.name,
+                        journal=True, operation='import')
+        jsondb.load()
+        entries = jsondb.db
+        if not entries:
+            self._logger.debug("Nothing to import from %s" % self._import_from)
+            return
+        for key, value in entries.iteritems():
+            self._write(key, value)
+        self._logger.info("Imported %d entries from %s"
+                          % (len(entries), self._import_from))
+
+    def _lock(self):
+        # sqlite waits up to timeout seconds for the other writers
+        start = time.time()
+        try:
+            self._connect().execute('BEGIN IMMEDIATE')
+        except sqlite3.Error as e:
+            stats.observe('db_lock_wait_seconds', time.time() - start,
+                          operation=self._operation, mode='exclusive')
+            stats.increment('db_lock_timeouts_total',
+                            operation=self._operation, mode='exclusive')
+            self._logger.critical('Unable to lock: %s' % e)
+            return False
+        self._locked_at = time.time()
+        stats.observe('db_lock_wait_seconds', self._locked_at - start,
+                      operation=self._operation, mode='exclusive')
+        self._in_transaction = True
+        return True
+
+    def _release(self):
+        # The connections of the other threads are closed when collected
+        self._conn = self._conns.pop(thread.get_ident(), None)
+        self._conns = {}
+        if self._conn is None:
+            return
+        if self._in_transaction:
+            self._conn.execute('ROLLBACK')
+            self._in_transaction = False
+        self._conn.close()
+        self._conn = None
+        if self._locked_at is not None:
+            stats.observe('db_lock_hold_seconds', time.time() - self._locked_at,
+                          operation=self._operation, mode='exclusive')
+            self._locked_at = None
+
+    def load(self):
+        try:
+            self._connect()
+        except sqlite3.Error as e:
+            self._logger.debug("Can't load file: %s" % e)
+
+    def save(self):
+        if not self._in_transaction:
+            return
+        start = time.time()
+        try:
+            self._connect().execute('COMMIT')
+            self._in_transaction = False
+        except sqlite3.Error as e:
+            self._logger.error('Error while saving the db: %s' % e)
+            return
+        stats.observe('db_save_seconds', time.time() - start, backend='sqlite')
+
+    def _account(self, size, files, original_size):
+        self._conn.execute('UPDATE usage SET bytes = bytes + ?, files = files + ?, '
+                           'original_bytes = original_bytes + ?',
+                           (size, files, original_size))
+
+    def _unaccount(self, key):
+        "Remove the file key, if it is stored, from the usage"
+        row = self._conn.execute('SELECT size, original_size FROM files WHERE md5 = ?',
+                                 (key,)).fetchone()
+        if row is not None:
+            self._account(-row[0], -1, -row[1])
+
+    def _write(self, key, value):
+        self._unaccount(key)
+        size = utils.stored_size(value)
+        original_size = value.get('size', 0)
+        self._conn.execute('INSERT OR REPLACE INTO files '
+                           '(md5, timestamp, infos, size, burned, original_size) '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           (key, int(value['timestamp']), json.dumps(value), size,
+                            value.get('burn_after_read') == 'Burned', original_size))
+        self._account(size, 1, original_size)
+
+    def delete(self, key):
+        self._connect()
+        self._unaccount(key)
+        self._conn.execute('DELETE FROM files WHERE md5 = ?', (key,))
+
+    def read(self, key):
+        row = self._connect().execute('SELECT infos FROM files WHERE md5 = ?',
+                                      (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def write(self, key, value):
+        self._connect()
+        self._write(key, value)
+
+    def scan(self, order='timestamp', after=None):
+        """Iterate over the entries sorted by timestamp or by key (order='id'),
+           starting after the position after: (timestamp, key) or key.
+           BATCH rows are read at once, the iteration can go on in another
+           thread"""
+        while True:
+            query = 'SELECT md5, timestamp, infos FROM files'
+            args = ()
+            if order == 'id':
+                if after is not None:
+                    query += ' WHERE md5 > ?'
+                    args = (after,)
+                query += ' ORDER BY md5'
+            else:
+                if after is not None:
+                    query += ' WHERE timestamp >= ? AND (timestamp > ? OR md5 > ?)'
+                    args = (after[0], after[0], after[1])
+                query += ' ORDER BY timestamp, md5'
+            rows = self._connect().execute('%s LIMIT ?' % query,
+                                           args + (self.BATCH,)).fetchall()
+            if not rows:
+                return
+            for key, timestamp, infos in rows:
+                yield key, json.loads(infos)
+            key, timestamp = rows[-1][:2]
+            after = key if order == 'id' else (timestamp, key)
+
+    def usage(self):
+        "Return the stored bytes, the number of files and their size before compression"
+        return tuple(self._connect().execute(
+            'SELECT bytes, files, original_bytes FROM usage').fetchone())
+
+    def oldest(self):
+        """Iterate over the keys, oldest first, read BATCH at once by
+           the timestamp index. The db can be modified meanwhile"""
+        after = (-1, '')
+        while True:
+            rows = self._connect().execute(
+                'SELECT timestamp, md5 FROM files '
+                'WHERE timestamp >= ? AND (timestamp > ? OR md5 > ?) '
+                'ORDER BY timestamp, md5 LIMIT ?',
+                (after[0], after[0], after[1], self.BATCH)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[1]
+            after = rows[-1]
+
+    def expired(self, before):
+        "Return the keys of the entries older than the before timestamp, oldest first"
+        return [row[0] for row in self._connect().execute(
+            'SELECT md5 FROM files WHERE timestamp < ? ORDER BY timestamp',
+            (before,))]
+
+    def burned(self):
+        "Return the keys of the burn after read files marked 'Burned'"
+        return [row[0] for row in self._connect().execute(
+            'SELECT md5 FROM files WHERE burned = 1')]
+
+    def iteritems(self):
+        return self.scan(order='id')
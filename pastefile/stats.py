@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Counters and histograms of the process.
+
+Samples are keyed by a metric name and labels:
+    stats.increment('db_lock_timeouts_total', operation='upload')
+    stats.observe('db_lock_wait_seconds', 0.002, operation='upload')
+
+Each process dumps its samples to a file, see dump, so that they can be
+merged with the ones of the other worker processes."""
+
+import os
+import json
+import threading
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, float('inf'))
+
+_LOCK = threading.Lock()
+# {(name, labels): value}
+_COUNTERS = {}
+# {(name, labels): {'buckets': [count per bucket], 'count': n, 'sum': s}}
+_HISTOGRAMS = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    key = _key(name, labels)
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _LOCK:
+        histogram = _HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = _HISTOGRAMS[key] = {'buckets': [0] * len(BUCKETS),
+                                            'count': 0, 'sum': 0.0}
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['count'] += 1
+        histogram['sum'] += value
+
+
+def snapshot():
+    "Return a copy of the counters and of the histograms"
+    with _LOCK:
+        return (dict(_COUNTERS),
+                dict((key, {'buckets': list(h['buckets']),
+                            'count': h['count'],
+                            'sum': h['sum']})
+                     for key, h in _HISTOGRAMS.iteritems()))
+
+
+def reset():
+    with _LOCK:
+        _COUNTERS.clear()
+        _HISTOGRAMS.clear()
+
+
+def dump(filename, samples=None):
+    "Write samples, by default the snapshot of the process, to filename"
+    counters, histograms = samples or snapshot()
+    data = {
+        'counters': [[name, labels, value]
+                     for (name, labels), value in counters.iteritems()],
+        'histograms': [[name, labels, histogram]
+                       for (name, labels), histogram in histograms.iteritems()],
+    }
+    tmp_file = '%s.atomic' % filename
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_file, filename)
+
+
+def load(filename):
+    "Return the snapshot dumped in filename"
+    with open(filename, 'r') as f:
+        data = json.load(f)
+    counters = dict(((name, tuple(tuple(label) for label in labels)), value)
+                    for name, labels, value in data['counters'])
+    histograms = dict(((name, tuple(tuple(label) for label in labels)), histogram)
+                      for name, labels, histogram in data['histograms'])
+    return counters, histograms
+
+
+def merge(snapshots):
+    "Sum snapshots of several processes"
+    counters = {}
+    histograms = {}
+    for _counters, _histograms in snapshots:
+        for key, value in _counters.iteritems():
+            counters[key] = counters.get(key, 0) + value
+        for key, histogram in _histograms.iteritems():
+            merged = histograms.setdefault(key, {'buckets': [0] * len(BUCKETS),
+                                                 'count': 0, 'sum': 0.0})
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'],
+                                                       histogram['buckets'])]
+            merged['count'] += histogram['count']
+            merged['sum'] += histogram['sum']
+    return counters, histograms
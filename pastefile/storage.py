@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Storage of the uploaded files, selected by the STORAGE_BACKEND option.
+
+A stored file is identified by its location, saved in the db as
+storage_full_filename: its path with the local storage, its key with s3.
+Every storage has the same interface:
+    location(md5), put(source, location), get(location, start, stop),
+    delete(location), exists(location), size(location)
+and raises StorageError (an OSError) when the storage fails."""
+
+import os
+import uuid
+import errno
+import logging
+import threading
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import BotoCoreError, ClientError
+except ImportError:
+    boto3 = None
+
+LOG = logging.getLogger(__name__)
+
+CHUNK_SIZE = 2**16
+
+# Folder of UPLOAD_FOLDER where the claimed files are moved, see
+# LocalStorage.claim. Not an id, those are hexadecimal
+CLAIMS_FOLDER = 'burned'
+
+# S3 clients shared by the requests: {(endpoint, region, access key): client}
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+class StorageError(OSError):
+    pass
+
+
+class LocalStorage(object):
+    "Files in UPLOAD_FOLDER, in UPLOAD_FOLDER_LEVELS levels of directories"
+
+    # The files can be sent by the front web server (SENDFILE_MODE) and
+    # claimed atomically by a burn after read download (claim)
+    local = True
+
+    def __init__(self, config):
+        self._folder = config.get('UPLOAD_FOLDER', '')
+        self._levels = int(config.get('UPLOAD_FOLDER_LEVELS', 0))
+
+    def location(self, md5):
+        "ab/cd/abcd... with 2 levels"
+        shards = [md5[2 * i:2 * i + 2] for i in range(self._levels)]
+        return os.path.join(self._folder, *(shards + [md5]))
+
+    def put(self, source, location):
+        "Move the local file source to location"
+        dest_dir = os.path.dirname(location)
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        os.rename(source, location)
+
+    def get(self, location, start=0, stop=None, chunksize=CHUNK_SIZE):
+        "Generate the content of location from start to stop"
+        with open(location, 'rb') as f:
+            f.seek(start)
+            remaining = stop - start if stop is not None else None
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunksize if remaining is None
+                               else min(chunksize, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, location):
+        os.remove(location)
+
+    def exists(self, location):
+        return os.path.isfile(location)
+
+    def size(self, location):
+        return os.stat(location).st_size
+
+    def claim(self, location):
+        """Move a file aside so that nobody else can claim it: the rename is
+           atomic, only one caller succeeds, even across processes.
+           Return the claimed location, or None if it is already claimed"""
+        claims_folder = os.path.join(self._folder, CLAIMS_FOLDER)
+        claimed = os.path.join(claims_folder, '%s.%s' % (os.path.basename(location),
+                                                         uuid.uuid4().hex))
+        try:
+            if not os.path.isdir(claims_folder):
+                os.makedirs(claims_folder)
+        except OSError:
+            # Created by another claim meanwhile
+            pass
+        try:
+            os.rename(location, claimed)
+        except OSError:
+            return None
+        return claimed
+
+    def release(self, claimed):
+        """Remove the content of a claimed file. The empty file is left for
+           claims until it is deleted"""
+        try:
+            with open(claimed, 'r+b') as f:
+                f.truncate()
+        except IOError as e:
+            # Already deleted by clean_files
+            if e.errno != errno.ENOENT:
+                raise StorageError('release: %s' % e)
+
+    def claims(self):
+        "Return the id and the claimed location of the claimed files"
+        claims_folder = os.path.join(self._folder, CLAIMS_FOLDER)
+        try:
+            filenames = os.listdir(claims_folder)
+        except OSError:
+            return []
+        return [(filename.split('.', 1)[0], os.path.join(claims_folder, filename))
+                for filename in filenames]
+
+
+class S3Storage(object):
+    """Objects of S3_BUCKET (or of any S3 compatible store, see
+       S3_ENDPOINT_URL), so that several pastefile can share the files"""
+
+    local = False
+
+    def __init__(self, config):
+        if boto3 is None:
+            raise StorageError('The s3 storage needs the boto3 module')
+        self._bucket = config['S3_BUCKET']
+        self._prefix = config['S3_PREFIX']
+        self._transfer = TransferConfig(
+            multipart_threshold=int(config['S3_MULTIPART_SIZE']),
+            multipart_chunksize=int(config['S3_MULTIPART_SIZE']))
+        key = (config['S3_ENDPOINT_URL'], config['S3_REGION'], config['S3_ACCESS_KEY'])
+        with _CLIENTS_LOCK:
+            if key not in _CLIENTS:
+                # Without keys, boto3 looks for the credentials as usual
+                # (environment, ~/.aws, instance role)
+                _CLIENTS[key] = boto3.client(
+                    's3',
+                    endpoint_url=config['S3_ENDPOINT_URL'],
+                    region_name=config['S3_REGION'],
+                    aws_access_key_id=config['S3_ACCESS_KEY'],
+                    aws_secret_access_key=config['S3_SECRET_KEY'])
+            self._client = _CLIENTS[key]
+
+    def _call(self, method, **kwargs):
+        try:
+            return getattr(self._client, method)(Bucket=self._bucket, **kwargs)
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError('%s: %s' % (method, e))
+
+    def location(self, md5):
+        return '%s%s' % (self._prefix, md5)
+
+    def put(self, source, location):
+        """Upload the local file source to location, in parts of
+           S3_MULTIPART_SIZE bytes if it is bigger, then remove source"""
+        try:
+            self._client.upload_file(source, self._bucket, location,
+                                     Config=self._transfer)
+        except (BotoCoreError, ClientError) as e:
+            raise StorageError('upload_file: %s' % e)
+        os.remove(source)
+
+    def get(self, location, start=0, stop=None, chunksize=CHUNK_SIZE):
+        "Generate the content of location from start to stop"
+        kwargs = {}
+        if start or stop is not None:
+            kwargs['Range'] = 'bytes=%d-%s' % (start, stop - 1 if stop is not None else '')
+        body = self._call('get_object', Key=location, **kwargs)['Body']
+        try:
+            while True:
+                try:
+                    chunk = body.read(chunksize)
+                except (BotoCoreError, IOError) as e:
+                    raise StorageError('get_object: %s' % e)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    def delete(self, location):
+        self._call('delete_object', Key=location)
+
+    def _head(self, location):
+        try:
+            return self._client.head_object(Bucket=self._bucket, Key=location)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                return None
+            raise StorageError('head_object: %s' % e)
+        except BotoCoreError as e:
+            raise StorageError('head_object: %s' % e)
+
+    def exists(self, location):
+        return self._head(location) is not None
+
+    def size(self, location):
+        head = self._head(location)
+        if head is None:
+            raise StorageError('%s does not exist' % location)
+        return head['ContentLength']
+
+
+BACKENDS = {
+    'local': LocalStorage,
+    's3': S3Storage,
+}
+
+
+def get_storage(config=None):
+    "Return the storage selected by STORAGE_BACKEND"
+    if config is None:
+        config = {}
+    return BACKENDS[config.get('STORAGE_BACKEND', 'local')](config)
@@ -6,14 +6,38 @@ import unittest
 import json
 import shutil
 import mock
+import zlib
+import threading
+import time
+import signal
+import hashlib
+import tarfile
+import zipfile
+import sqlite3
+from StringIO import StringIO
 os.environ['PASTEFILE_SETTINGS'] = '../pastefile-test.cfg'
 os.environ['TESTING'] = 'TRUE'
 
 import pastefile.app as flaskr
 from pastefile.tests.tools import write_random_file, write_file
 from pastefile import utils
+from pastefile import jsondb
 from pastefile.jsondb import JsonDB
 from pastefile import controller
+from pastefile import scheduler
+from pastefile import sessions
+from pastefile import compression
+from pastefile import stats
+from pastefile import metrics
+from pastefile import storage
+try:
+    from pastefile import asyncserver
+except ImportError:
+    asyncserver = None
+try:
+    import moto
+except ImportError:
+    moto = None
 
 
 class FlaskrTestCase(unittest.TestCase):
@@ -25,6 +49,7 @@ class FlaskrTestCase(unittest.TestCase):
 
     def setUp(self):
         self.testdir = './tests'
+        self.config = dict(flaskr.app.config)
         flaskr.app.config['TESTING'] = True
         self.clean_dir()
         os.makedirs(osjoin(self.testdir, 'files'))
@@ -33,6 +58,7 @@ class FlaskrTestCase(unittest.TestCase):
 
 
     def tearDown(self):
+        flaskr.app.config.update(self.config)
         self.clean_dir()
 
 
@@ -58,7 +84,9 @@ class FlaskrTestCase(unittest.TestCase):
         self.assertEquals(['test_pastefile_random.file'], filenames)
 
         # Add one new file. Remove the first file from disk only in the last test
+        # /ls does not check the disk, purge the db
         os.remove(osjoin(flaskr.app.config['UPLOAD_FOLDER'], last_file_md5))
+        controller.db_purge(dbfile=flaskr.app.config['FILE_LIST'])
         _file = osjoin(self.testdir, 'test_file_2')
         write_random_file(_file)
         rv = self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile2_random.file'),})
@@ -76,6 +104,47 @@ class FlaskrTestCase(unittest.TestCase):
         rv = self.app.get('/ls', headers={'User-Agent': 'curl'})
         self.assertEquals(rv.get_data(), 'Administrator disabled the /ls option.\n')
 
+    def test_ls_pagination(self):
+        md5s = []
+        for i in range(5):
+            _file = osjoin(self.testdir, 'test_file%s' % i)
+            md5s.append(write_random_file(_file))
+            data = {'file': (open(_file, 'r'), 'file%s.bin' % i)}
+            if i % 2:
+                data['burn'] = 'True'
+            self.app.post('/', data=data)
+        # Give each file its own timestamp
+        with JsonDB(dbfile=flaskr.app.config['FILE_LIST']) as db:
+            for i, md5 in enumerate(md5s):
+                db.db[md5]['timestamp'] = 1000 + i
+
+        for backend in ['json', 'sqlite']:
+            flaskr.app.config['DB_BACKEND'] = backend
+            # Pages of 2 files sorted by timestamp
+            seen, cursor = [], None
+            for page in range(3):
+                url = '/ls?limit=2' + ('&cursor=%s' % cursor if cursor else '')
+                rv = self.app.get(url, headers={'User-Agent': 'curl'})
+                seen.append(sorted(json.loads(rv.get_data()).keys()))
+                cursor = rv.headers.get('X-Next-Cursor')
+            self.assertEquals([sorted(md5s[0:2]), sorted(md5s[2:4]), [md5s[4]]], seen)
+            self.assertEquals(cursor, None)
+
+            # Sorted by id, one file per line
+            rv = self.app.get('/ls?order=id&format=ndjson', headers={'User-Agent': 'curl'})
+            self.assertEquals(rv.headers['Content-Type'], 'application/x-ndjson')
+            self.assertEquals(sorted(md5s), [json.loads(l)['md5'] for l in rv.get_data().splitlines()])
+
+            # Filters
+            rv = self.app.get('/ls?since=1002&burn=True&name=file', headers={'User-Agent': 'curl'})
+            self.assertEquals([md5s[3]], json.loads(rv.get_data()).keys())
+            rv = self.app.get('/ls?mime_type=text/', headers={'User-Agent': 'curl'})
+            self.assertEquals({}, json.loads(rv.get_data()))
+
+        for url in ['/ls?limit=0', '/ls?cursor=foo', '/ls?order=foo']:
+            rv = self.app.get(url, headers={'User-Agent': 'curl'})
+            self.assertEquals(rv.status, '400 BAD REQUEST')
+
     def test_upload_and_retrieve(self):
         # Upload a random file
         _file = osjoin(self.testdir, 'test_file')
@@ -129,6 +198,682 @@ class FlaskrTestCase(unittest.TestCase):
             rv = self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
             self.assertTrue('Unable to upload the file' in rv.get_data())
 
+    def test_upload_single_pass(self):
+        # The file is hashed while received, never read back from the disk
+        _file = osjoin(self.testdir, 'test_file')
+        test_md5 = write_random_file(_file)
+        with mock.patch('pastefile.utils.get_digest', mock.Mock(side_effect=AssertionError)):
+            rv = self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),
+                                          'other': (open(_file, 'r'), 'ignored.file')})
+        self.assertEquals(rv.get_data(), "http://localhost/%s\n" % (test_md5))
+        # Nothing is left in the tmp directory, even for the ignored file
+        self.assertEquals(os.listdir(flaskr.app.config['TMP_FOLDER']), [])
+
+    def test_storage_put_outside_db_lock(self):
+        put = storage.LocalStorage.put
+
+        def check_unlocked(store, source, location):
+            db = JsonDB(dbfile=flaskr.app.config['FILE_LIST'], timeout=0)
+            self.assertTrue(db._lock())
+            db._release()
+            return put(store, source, location)
+        _file = osjoin(self.testdir, 'test_file')
+        test_md5 = write_random_file(_file)
+        with mock.patch.object(storage.LocalStorage, 'put', autospec=True,
+                               side_effect=check_unlocked) as m:
+            rv = self.app.post('/', data={'file': (open(_file, 'r'), 'test.bin'),})
+            self.assertEquals(rv.get_data(), 'http://localhost/%s\n' % test_md5)
+            self.assertEquals(m.call_count, 1)
+            # Already stored, not uploaded again
+            self.app.post('/', data={'file': (open(_file, 'r'), 'test.bin'),})
+            self.assertEquals(m.call_count, 1)
+
+        # A file put but not registered is removed
+        write_random_file(_file)
+        with mock.patch('pastefile.controller.JsonDB._lock', mock.Mock(return_value=False)):
+            rv = self.app.post('/', data={'file': (open(_file, 'r'), 'test.bin'),})
+        self.assertEquals(rv.get_data(), 'Unable to upload the file, try again later ...\n')
+        self.assertEquals(os.listdir(flaskr.app.config['UPLOAD_FOLDER']), [test_md5])
+        self.assertEquals(os.listdir(flaskr.app.config['TMP_FOLDER']), [])
+
+    def test_batch_upload(self):
+        contents = [os.urandom(1024) for i in range(3)]
+        md5s = [hashlib.md5(content).hexdigest() for content in contents]
+        tar_file = osjoin(self.testdir, 'test.tar.gz')
+        with tarfile.open(tar_file, 'w:gz') as tar:
+            for i, content in enumerate(contents[1:]):
+                member = tarfile.TarInfo('logs/build-%d.log' % i)
+                member.size = len(content)
+                tar.addfile(member, StringIO(content))
+            directory = tarfile.TarInfo('logs/dir')
+            directory.type = tarfile.DIRTYPE
+            tar.addfile(directory)
+
+        # One url per file, in order, and a single db transaction
+        with mock.patch('pastefile.controller.open_db', wraps=controller.open_db) as m:
+            rv = self.app.post('/', data={'file': [(StringIO(contents[0]), 'a.bin'),
+                                                   (StringIO(contents[1]), 'b.bin')],
+                                          'tar': (open(tar_file, 'rb'), 'test.tar.gz')})
+            self.assertEquals([c[1]['operation'] for c in m.call_args_list].count('upload'), 1)
+        self.assertEquals(rv.get_data(), ''.join('http://localhost/%s\n' % md5
+                                                 for md5 in [md5s[0], md5s[1], md5s[1], md5s[2]]))
+        for md5, content in zip(md5s, contents):
+            rv = self.app.get('/%s' % md5, headers={'User-Agent': 'curl'})
+            self.assertEquals(rv.get_data(), content)
+        rv = self.app.get('/%s/infos' % md5s[2], headers={'User-Agent': 'curl'})
+        self.assertEquals(json.loads(rv.get_data())['name'], 'build-1.log')
+        self.assertEquals(os.listdir(flaskr.app.config['TMP_FOLDER']), [])
+
+        rv = self.app.post('/', data={'tar': (StringIO(open(tar_file, 'rb').read()[:100]),
+                                              'test.tar.gz')})
+        self.assertEquals(rv.status_code, 400)
+        self.assertEquals(os.listdir(flaskr.app.config['TMP_FOLDER']), [])
+
+        # The first bytes of a file are released when the next one starts
+        with mock.patch('pastefile.utils.SpooledUpload.release_head', autospec=True,
+                        side_effect=utils.SpooledUpload.release_head) as m:
+            rv = self.app.post('/', data={'file': [(StringIO('hello\n'), 'a.txt'),
+                                                   (StringIO(''), 'b.txt'),
+                                                   (StringIO('world\n'), 'c.txt')]})
+            self.assertEquals(m.call_count, 2)
+        urls = rv.get_data().split()
+        for url, mime_type in zip(urls, ['text/plain', 'inode/x-empty', 'text/plain']):
+            rv = self.app.get('/%s/infos' % url.split('/')[-1], headers={'User-Agent': 'curl'})
+            self.assertEquals(json.loads(rv.get_data())['mime_type'], mime_type)
+
+    def test_hash_algorithm(self):
+        _file = osjoin(self.testdir, 'test_file')
+        old_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'old.bin'),})
+
+        # New uploads use the new algorithm, the md5 ids keep working
+        flaskr.app.config['HASH_ALGORITHM'] = 'sha256'
+        content = os.urandom(1024)
+        write_file(_file, content)
+        sha256 = hashlib.sha256(content).hexdigest()
+        rv = self.app.post('/', data={'file': (open(_file, 'r'), 'new.bin'),})
+        self.assertEquals(rv.get_data(), 'http://localhost/%s\n' % sha256)
+        rv = self.app.get('/%s/infos' % sha256, headers={'User-Agent': 'curl'})
+        self.assertEquals(json.loads(rv.get_data())['hash'], 'sha256')
+        rv = self.app.get('/%s' % sha256, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.get_data(), content)
+        rv = self.app.get('/%s/infos' % old_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(json.loads(rv.get_data())['hash'], 'md5')
+        rv = self.app.get('/%s' % old_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.status_code, 200)
+
+        # An older client announcing the md5 of a new file
+        content = os.urandom(1024)
+        write_file(_file, content)
+        rv = self.app.post('/', headers={'X-Pastefile-Digest': hashlib.md5(content).hexdigest()},
+                           data={'file': (open(_file, 'r'), 'new.bin'),})
+        self.assertEquals(rv.get_data(),
+                          'http://localhost/%s\n' % hashlib.sha256(content).hexdigest())
+
+        self.assertRaises(ValueError, utils.new_hash, 'foobar')
+        if hasattr(hashlib, 'blake2b') or utils.pyblake2 is not None:
+            flaskr.app.config['HASH_ALGORITHM'] = 'blake2b'
+            rv = self.app.post('/', data={'file': (open(_file, 'r'), 'new.bin'),})
+            self.assertEquals(len(rv.get_data().strip().rsplit('/', 1)[1]),
+                              2 * utils.BLAKE2_DIGEST_SIZE)
+
+    def test_upload_with_digest(self):
+        _file = osjoin(self.testdir, 'test_file')
+        test_md5 = write_random_file(_file)
+
+        # Unknown file
+        rv = self.app.get('/%s/exists' % test_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.status, '404 NOT FOUND')
+
+        # The announced digest is checked against the received file
+        rv = self.app.post('/', headers={'X-Pastefile-Digest': 'foobar'},
+                           data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        self.assertEquals(rv.status, '400 BAD REQUEST')
+        self.assertEquals(os.listdir(flaskr.app.config['TMP_FOLDER']), [])
+        rv = self.app.post('/', headers={'X-Pastefile-Digest': test_md5},
+                           data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        self.assertEquals(rv.get_data(), "http://localhost/%s\n" % (test_md5))
+
+        rv = self.app.get('/%s/exists' % test_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.get_data(), "http://localhost/%s\n" % (test_md5))
+
+        # Known file, the body is not read
+        with mock.patch('pastefile.utils.write_tmpfile_to_disk', mock.Mock(side_effect=AssertionError)):
+            rv = self.app.post('/', headers={'X-Pastefile-Digest': test_md5},
+                               data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        self.assertEquals(rv.get_data(), "http://localhost/%s\n" % (test_md5))
+
+        # The digest can't describe several files
+        content = os.urandom(1024)
+        rv = self.app.post('/', headers={'X-Pastefile-Digest': hashlib.md5(content).hexdigest()},
+                           data={'file': [(StringIO(content), 'a.bin'), (StringIO(content), 'b.bin')]})
+        self.assertEquals(rv.status, '400 BAD REQUEST')
+        self.assertEquals(os.listdir(flaskr.app.config['TMP_FOLDER']), [])
+
+        rv = self.app.post('/', data={'foo': 'bar'})
+        self.assertEquals(rv.status, '400 BAD REQUEST')
+
+    def test_upload_session(self):
+        content = os.urandom(3000)
+        _file = osjoin(self.testdir, 'test_file')
+        test_md5 = write_file(_file, content)
+
+        rv = self.app.post('/uploads', data={'size': 'foo'})
+        self.assertEquals(rv.status, '400 BAD REQUEST')
+        rv = self.app.post('/uploads', data={'size': len(content), 'filename': '../session.file'})
+        session = json.loads(rv.get_data())
+        self.assertEquals(session['name'], 'session.file')
+        self.assertEquals(session['received'], [])
+        url = '/uploads/%s' % session['id']
+
+        # Chunks in any order, the last one retried
+        for offset in [2000, 0, 2000]:
+            rv = self.app.put('%s?offset=%d' % (url, offset), data=content[offset:offset + 1000],
+                              content_type='application/x-www-form-urlencoded')
+        self.assertEquals(json.loads(rv.get_data())['received'], [[0, 1000], [2000, 3000]])
+        rv = self.app.put('%s?offset=2500' % url, data=content[:1000])
+        self.assertEquals(rv.status, '400 BAD REQUEST')
+
+        # Not complete
+        rv = self.app.post(url)
+        self.assertEquals(rv.status, '400 BAD REQUEST')
+
+        rv = self.app.put('%s?offset=1000' % url, data=content[1000:2000])
+        self.assertEquals(json.loads(self.app.get(url).get_data())['received'], [[0, 3000]])
+        # The file is kept if it can't be registered, finalize can be retried
+        with mock.patch('pastefile.controller.add_new_file', mock.Mock(return_value=False)):
+            rv = self.app.post(url)
+        self.assertEquals(rv.status, '503 SERVICE UNAVAILABLE')
+        self.assertEquals(os.listdir(flaskr.app.config['UPLOAD_FOLDER']), [])
+        rv = self.app.post(url)
+        self.assertEquals(rv.get_data(), "http://localhost/%s\n" % (test_md5))
+        self.assertEquals(os.listdir(flaskr.app.config['TMP_FOLDER']), [])
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.get_data(), content)
+        self.assertEquals(rv.headers['Content-Disposition'], 'attachment; filename=session.file')
+
+        # Session is gone, also for the requests which found it before it
+        # was finalized
+        self.assertEquals(self.app.get(url).status, '404 NOT FOUND')
+        stale = JsonDB(dbfile=sessions._meta_file(session['id'], flaskr.app.config))
+        with mock.patch('pastefile.sessions._open_session', mock.Mock(return_value=stale)):
+            rv = self.app.post(url)
+        self.assertEquals(rv.status, '404 NOT FOUND')
+        self.assertEquals(sessions._add_received(session['id'], 0, 1000, flaskr.app.config), None)
+        self.assertEquals(os.listdir(flaskr.app.config['TMP_FOLDER']), [])
+        self.assertEquals(self.app.get('/uploads/..').status, '404 NOT FOUND')
+
+        # Abandoned sessions are removed
+        rv = self.app.post('/uploads', data={'size': 10})
+        self.assertEquals(len(os.listdir(flaskr.app.config['TMP_FOLDER'])), 3)
+        flaskr.app.config['UPLOAD_SESSION_EXPIRE'] = -1
+        scheduler.run_maintenance(config=flaskr.app.config)
+        self.assertEquals(os.listdir(flaskr.app.config['TMP_FOLDER']), [])
+
+    def test_conditional_and_range_get(self):
+        content = os.urandom(1000)
+        _file = osjoin(self.testdir, 'test_file')
+        test_md5 = write_file(_file, content)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.headers['ETag'], '"%s"' % test_md5)
+        self.assertTrue('immutable' in rv.headers['Cache-Control'])
+        self.assertEquals(rv.headers['Accept-Ranges'], 'bytes')
+        last_modified = rv.headers['Last-Modified']
+
+        # Conditional requests
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl',
+                                                     'If-None-Match': '"%s"' % test_md5})
+        self.assertEquals(rv.status, '304 NOT MODIFIED')
+        self.assertEquals(rv.get_data(), '')
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl',
+                                                     'If-None-Match': '"foobar"'})
+        self.assertEquals(rv.status, '200 OK')
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl',
+                                                     'If-Modified-Since': last_modified})
+        self.assertEquals(rv.status, '304 NOT MODIFIED')
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl',
+                                                     'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEquals(rv.status, '200 OK')
+
+        # Single range
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl', 'Range': 'bytes=10-19'})
+        self.assertEquals(rv.status, '206 PARTIAL CONTENT')
+        self.assertEquals(rv.get_data(), content[10:20])
+        self.assertEquals(rv.headers['Content-Range'], 'bytes 10-19/1000')
+        self.assertEquals(rv.headers['Content-Disposition'], 'attachment; filename=test_pastefile_random.file')
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl', 'Range': 'bytes=-100'})
+        self.assertEquals(rv.get_data(), content[-100:])
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl', 'Range': 'bytes=990-2000'})
+        self.assertEquals(rv.get_data(), content[990:])
+
+        # Multiple ranges
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl', 'Range': 'bytes=0-9,100-109'})
+        self.assertEquals(rv.status, '206 PARTIAL CONTENT')
+        self.assertTrue(rv.headers['Content-Type'].startswith('multipart/byteranges; boundary='))
+        body = rv.get_data()
+        self.assertEquals(int(rv.headers['Content-Length']), len(body))
+        self.assertTrue('Content-Range: bytes 0-9/1000\r\n\r\n%s\r\n' % content[0:10] in body)
+        self.assertTrue('Content-Range: bytes 100-109/1000\r\n\r\n%s\r\n' % content[100:110] in body)
+
+        # Not satisfiable, or If-Range of another version
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl', 'Range': 'bytes=2000-'})
+        self.assertEquals(rv.status, '416 REQUESTED RANGE NOT SATISFIABLE')
+        self.assertEquals(rv.headers['Content-Range'], 'bytes */1000')
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl', 'Range': 'bytes=0-9',
+                                                     'If-Range': '"foobar"'})
+        self.assertEquals(rv.status, '200 OK')
+        self.assertEquals(rv.get_data(), content)
+
+        # Burn after read files are sent whole, once, and never cached
+        _file = osjoin(self.testdir, 'test_file_burn')
+        burn_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'), 'burn': 'True'})
+        rv = self.app.get('/%s' % burn_md5, headers={'User-Agent': 'curl', 'Range': 'bytes=0-9',
+                                                     'If-None-Match': '"%s"' % burn_md5})
+        self.assertEquals(rv.status, '200 OK')
+        self.assertEquals(len(rv.get_data()), 1024)
+        self.assertEquals(rv.headers['Cache-Control'], 'no-store')
+        rv = self.app.get('/%s' % burn_md5, headers={'User-Agent': 'curl', 'Range': 'bytes=0-9'})
+        self.assertEquals(rv.status, '404 NOT FOUND')
+
+    def test_sendfile_offload(self):
+        _file = osjoin(self.testdir, 'test_file')
+        test_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+
+        flaskr.app.config['SENDFILE_MODE'] = 'x-accel'
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.status, '200 OK')
+        self.assertEquals(rv.get_data(), '')
+        self.assertEquals(rv.headers['X-Accel-Redirect'], '/_pastefile_files/%s' % test_md5)
+        self.assertEquals(rv.headers['Content-Disposition'], 'attachment; filename=test_pastefile_random.file')
+        self.assertEquals(rv.headers['ETag'], '"%s"' % test_md5)
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl',
+                                                     'If-None-Match': '"%s"' % test_md5})
+        self.assertEquals(rv.status, '304 NOT MODIFIED')
+
+        flaskr.app.config['SENDFILE_MODE'] = 'x-sendfile'
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.headers['X-Sendfile'],
+                          os.path.abspath(osjoin(flaskr.app.config['UPLOAD_FOLDER'], test_md5)))
+
+        # Burn after read files are still sent by pastefile
+        _file = osjoin(self.testdir, 'test_file_burn')
+        burn_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'), 'burn': 'True'})
+        rv = self.app.get('/%s' % burn_md5, headers={'User-Agent': 'curl'})
+        self.assertFalse('X-Sendfile' in rv.headers)
+        self.assertEquals(len(rv.get_data()), 1024)
+
+    def test_upload_folder_levels(self):
+        upload_folder = flaskr.app.config['UPLOAD_FOLDER']
+        # Files uploaded with the flat layout
+        flat_md5s = []
+        for i in range(5):
+            _file = osjoin(self.testdir, 'test_file_%d' % i)
+            flat_md5s.append(write_random_file(_file))
+            self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        self.assertTrue(os.path.isfile(osjoin(upload_folder, flat_md5s[0])))
+
+        # New files are sharded, old ones are still served
+        flaskr.app.config['UPLOAD_FOLDER_LEVELS'] = 2
+        _file = osjoin(self.testdir, 'test_file_new')
+        new_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        self.assertTrue(os.path.isfile(osjoin(upload_folder, new_md5[:2], new_md5[2:4], new_md5)))
+        rv = self.app.get('/%s' % new_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(len(rv.get_data()), 1024)
+        rv = self.app.get('/%s' % flat_md5s[0], headers={'User-Agent': 'curl'})
+        self.assertEquals(len(rv.get_data()), 1024)
+
+        # A file already moved but not yet its db entry is found
+        os.makedirs(osjoin(upload_folder, flat_md5s[0][:2], flat_md5s[0][2:4]))
+        os.rename(osjoin(upload_folder, flat_md5s[0]),
+                  osjoin(upload_folder, flat_md5s[0][:2], flat_md5s[0][2:4], flat_md5s[0]))
+        rv = self.app.get('/%s' % flat_md5s[0], headers={'User-Agent': 'curl'})
+        self.assertEquals(len(rv.get_data()), 1024)
+
+        # Migrate the others, 2 by 2
+        self.assertEquals(controller.migrate_files(dbfile=flaskr.app.config['FILE_LIST'],
+                                                   config=flaskr.app.config, batch_size=2), 5)
+        self.assertEquals(controller.migrate_files(dbfile=flaskr.app.config['FILE_LIST'],
+                                                   config=flaskr.app.config, batch_size=2), 0)
+        db = JsonDB(dbfile=flaskr.app.config['FILE_LIST'])
+        db.load()
+        for md5 in flat_md5s + [new_md5]:
+            sharded = osjoin(upload_folder, md5[:2], md5[2:4], md5)
+            self.assertEquals(db.read(md5)['storage_full_filename'], sharded)
+            self.assertTrue(os.path.isfile(sharded))
+            rv = self.app.get('/%s' % md5, headers={'User-Agent': 'curl'})
+            self.assertEquals(len(rv.get_data()), 1024)
+        self.assertFalse(os.path.isfile(osjoin(upload_folder, flat_md5s[1])))
+
+        # And the files can be removed
+        rv = self.app.delete('/%s' % flat_md5s[1])
+        self.assertEquals(rv.status, '200 OK')
+        self.assertFalse(os.path.isfile(osjoin(upload_folder, flat_md5s[1][:2],
+                                               flat_md5s[1][2:4], flat_md5s[1])))
+
+    @unittest.skipIf(moto is None or storage.boto3 is None, 'moto is not installed')
+    def test_s3_storage(self):
+        flaskr.app.config.update({'STORAGE_BACKEND': 's3',
+                                  'S3_BUCKET': 'pastefile',
+                                  'S3_PREFIX': 'files/',
+                                  'S3_REGION': 'us-east-1',
+                                  'S3_ACCESS_KEY': 'testing',
+                                  'S3_SECRET_KEY': 'testing',
+                                  'S3_MULTIPART_SIZE': 5 * 2**20,
+                                  'COMPRESS': {'text/': 'gzip'}})
+        with moto.mock_s3():
+            try:
+                store = storage.get_storage(flaskr.app.config)
+                store._client.create_bucket(Bucket='pastefile')
+                _file = osjoin(self.testdir, 'test_file')
+                content = os.urandom(6 * 2**20)
+                test_md5 = write_file(_file, content)
+                self.app.post('/', data={'file': (open(_file, 'r'), 'test.bin'),})
+                self.assertEquals(os.listdir(flaskr.app.config['UPLOAD_FOLDER']), [])
+                self.assertEquals(os.listdir(flaskr.app.config['TMP_FOLDER']), [])
+                self.assertEquals(store.size('files/%s' % test_md5), len(content))
+
+                rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'},
+                                  buffered=True)
+                self.assertEquals(rv.get_data(), content)
+                rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl',
+                                                             'Range': 'bytes=10-19'})
+                self.assertEquals(rv.status_code, 206)
+                self.assertEquals(rv.get_data(), content[10:20])
+                rv = self.app.get('/%s/infos' % test_md5, headers={'User-Agent': 'curl'})
+                self.assertEquals(json.loads(rv.get_data())['md5'], test_md5)
+
+                # Compressed in the bucket, decompressed on the fly
+                text = 'pastefile log line\n' * 1000
+                text_md5 = write_file(_file, text)
+                self.app.post('/', data={'file': (open(_file, 'r'), 'test.log'),})
+                self.assertTrue(store.size('files/%s' % text_md5) < len(text))
+                rv = self.app.get('/%s' % text_md5, headers={'User-Agent': 'curl'},
+                                  buffered=True)
+                self.assertEquals(rv.get_data(), text)
+
+                # Burned once read, by a single reader
+                burn_md5 = write_file(_file, 'burn after read\n')
+                self.app.post('/', data={'file': (open(_file, 'r'), 'burn.txt'), 'burn': 'True',})
+                rv = self.app.get('/%s' % burn_md5, headers={'User-Agent': 'curl'},
+                                  buffered=True)
+                self.assertEquals(rv.get_data(), 'burn after read\n')
+                rv = self.app.get('/%s' % burn_md5, headers={'User-Agent': 'curl'})
+                self.assertEquals(rv.status_code, 404)
+                self.assertFalse(store.exists('files/%s' % burn_md5))
+
+                rv = self.app.delete('/%s' % test_md5)
+                self.assertFalse(store.exists('files/%s' % test_md5))
+            finally:
+                storage._CLIENTS.clear()
+
+    def test_compression(self):
+        flaskr.app.config['COMPRESS'] = {'text/': 'gzip'}
+        content = 'pastefile log line\n' * 1000
+        _file = osjoin(self.testdir, 'test_file')
+        test_md5 = write_file(_file, content)
+        rv = self.app.post('/', data={'file': (open(_file, 'r'), 'test.log'),})
+        self.assertEquals(rv.get_data(), 'http://localhost/%s\n' % test_md5)
+
+        db = JsonDB(dbfile=flaskr.app.config['FILE_LIST'])
+        db.load()
+        infos = db.read(test_md5)
+        self.assertEquals(infos['encoding'], 'gzip')
+        self.assertEquals(infos['size'], len(content))
+        self.assertTrue(os.stat(infos['storage_full_filename']).st_size < len(content) / 10)
+        self.assertEquals(os.listdir(flaskr.app.config['TMP_FOLDER']), [])
+
+        # Sent compressed to the clients accepting it
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl',
+                                                     'Accept-Encoding': 'gzip, deflate'})
+        self.assertEquals(rv.headers['Content-Encoding'], 'gzip')
+        self.assertEquals(rv.headers['ETag'], '"%s-gzip"' % test_md5)
+        self.assertEquals(rv.headers['Vary'], 'Accept-Encoding')
+        self.assertEquals(zlib.decompress(rv.get_data(), 16 + zlib.MAX_WBITS), content)
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl',
+                                                     'Accept-Encoding': 'gzip',
+                                                     'If-None-Match': '"%s-gzip"' % test_md5})
+        self.assertEquals(rv.status, '304 NOT MODIFIED')
+
+        # And decompressed for the others
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'})
+        self.assertFalse('Content-Encoding' in rv.headers)
+        self.assertEquals(rv.headers['ETag'], '"%s"' % test_md5)
+        self.assertEquals(rv.headers['Content-Length'], str(len(content)))
+        self.assertEquals(rv.get_data(), content)
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl',
+                                                     'Accept-Encoding': 'gzip;q=0',
+                                                     'If-None-Match': '"%s-gzip"' % test_md5})
+        self.assertEquals(rv.status, '200 OK')
+        self.assertEquals(rv.get_data(), content)
+
+        # Files not matching or not worth it are stored as is
+        _file = osjoin(self.testdir, 'test_file_random')
+        random_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        flaskr.app.config['COMPRESS'] = {'': 'gzip'}
+        _file = osjoin(self.testdir, 'test_file_random2')
+        random2_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        db.load()
+        self.assertFalse('encoding' in db.read(random_md5))
+        self.assertFalse('encoding' in db.read(random2_md5))
+        self.assertEquals(os.listdir(flaskr.app.config['TMP_FOLDER']), [])
+
+        # Unavailable encodings are ignored
+        flaskr.app.config['COMPRESS'] = {'text/': 'foobar'}
+        self.assertEquals(compression.choose_encoding('text/plain', flaskr.app.config), None)
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard is not installed')
+    def test_compression_zstd(self):
+        flaskr.app.config['COMPRESS'] = {'text/': 'gzip', 'text/plain': 'zstd'}
+        content = 'pastefile log line\n' * 1000
+        _file = osjoin(self.testdir, 'test_file')
+        test_md5 = write_file(_file, content)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test.log'),})
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.get_data(), content)
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl',
+                                                     'Accept-Encoding': 'zstd'})
+        self.assertEquals(rv.headers['Content-Encoding'], 'zstd')
+
+    @unittest.skipIf(asyncserver is None, 'gevent is not installed')
+    def test_async_server(self):
+        from werkzeug.test import Client
+        client = Client(asyncserver.make_app(flaskr.app, threads=2),
+                        flaskr.app.response_class)
+        threads = []
+
+        def in_pool(func):
+            "Record the thread func runs in"
+            def wrapper(*args, **kwargs):
+                threads.append(threading.current_thread().ident)
+                return func(*args, **kwargs)
+            return mock.Mock(side_effect=wrapper)
+        try:
+            # sqlite connections can't be shared between the threads
+            for backend in ['json', 'sqlite']:
+                flaskr.app.config['DB_BACKEND'] = backend
+                _file = osjoin(self.testdir, 'test_file')
+                test_md5 = write_file(_file, os.urandom(3 * asyncserver.CHUNK_SIZE))
+                with mock.patch('pastefile.controller.store_file', in_pool(controller.store_file)):
+                    rv = client.post('/', data={'file': (open(_file, 'r'), 'test.bin'),})
+                self.assertEquals(rv.get_data(), 'http://localhost/%s\n' % test_md5)
+                rv = client.get('/%s' % test_md5, headers={'User-Agent': 'curl'},
+                                buffered=True)
+                self.assertEquals(rv.get_data(), open(_file, 'r').read())
+                rv = client.get('/%s/infos' % test_md5, headers={'User-Agent': 'curl'})
+                self.assertEquals(json.loads(rv.get_data())['md5'], test_md5)
+                rv = client.get('/%s/exists' % test_md5, headers={'User-Agent': 'curl'})
+                self.assertEquals(rv.status_code, 200)
+                rv = client.get('/ls', headers={'User-Agent': 'curl'})
+                self.assertTrue(test_md5 in json.loads(rv.get_data()))
+                with mock.patch('pastefile.controller.remove_file', in_pool(controller.remove_file)):
+                    rv = client.delete('/%s' % test_md5, headers={'User-Agent': 'curl'})
+                    self.assertEquals(rv.get_data(), 'File %s deleted\n' % test_md5)
+                    rv = client.post('/delete', data={'id': test_md5})
+                    self.assertEquals(json.loads(rv.get_data()), {test_md5: 'not found'})
+                with mock.patch('pastefile.sessions._add_received', in_pool(sessions._add_received)):
+                    status = json.loads(client.post('/uploads', data={'size': 4}).get_data())
+                    client.put('/uploads/%s?offset=0' % status['id'], data='test')
+                rv = client.post('/uploads/%s' % status['id'])
+                self.assertEquals(rv.get_data(), 'http://localhost/%s\n' % hashlib.md5('test').hexdigest())
+                # The blocking work ran in the pool
+                self.assertEquals(len(threads), 3)
+                self.assertFalse(threading.current_thread().ident in threads)
+                del threads[:]
+        finally:
+            utils.BLOCKING_RUNNER = None
+            jsondb.BLOCKING_WAIT = True
+
+    def test_file_type_detection(self):
+        _file = osjoin(self.testdir, 'test_file')
+        test_md5 = write_file(_file, 'pastefile\n')
+        with mock.patch('pastefile.utils.get_file_type',
+                        wraps=utils.get_file_type) as m:
+            self.app.post('/', data={'file': (open(_file, 'r'), 'test.txt'),})
+            self.assertEquals(m.call_count, 1)
+            # Not detected again for a known file
+            self.app.post('/', data={'file': (open(_file, 'r'), 'test.txt'),})
+            self.assertEquals(m.call_count, 1)
+        rv = self.app.get('/%s/infos' % test_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(json.loads(rv.get_data())['mime_type'], 'text/plain')
+
+        # One libmagic handle per thread, reused by the next detections
+        handles = utils._magic_handles()
+        self.assertEquals(utils.get_file_type('pastefile\n')[0], 'text/plain')
+        self.assertTrue(utils._magic_handles() is handles)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(utils._magic_handles()))
+        thread.start()
+        thread.join()
+        self.assertFalse(other[0] is handles)
+
+    def test_db_locking(self):
+        stats.reset()
+        dbfile = osjoin(self.testdir, 'lock_test_db')
+        writer = JsonDB(dbfile=dbfile, timeout=0.2, operation='test')
+        self.assertTrue(writer._lock())
+
+        # Timeout waiting in the main thread, then in another thread
+        other = JsonDB(dbfile=dbfile, timeout=0.2, operation='test')
+        start = time.time()
+        with mock.patch('signal.setitimer', wraps=signal.setitimer) as m:
+            self.assertFalse(other._lock())
+            # Repeated, in case it fires before flock waits
+            self.assertEquals(m.call_args_list[0][0][2], jsondb.ALARM_INTERVAL)
+        self.assertTrue(0.2 <= time.time() - start < 2)
+        self.assertEquals(signal.getsignal(signal.SIGALRM), signal.SIG_DFL)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(other._lock_shared()))
+        thread.start()
+        thread.join()
+        self.assertEquals(results, [False])
+
+        # Got as soon as it is released
+        timer = threading.Timer(0.1, writer._release)
+        timer.start()
+        start = time.time()
+        self.assertTrue(other._lock())
+        self.assertTrue(time.time() - start < 2)
+        other._release()
+        timer.join()
+
+        # Readers share the lock, writers wait for them
+        readers = [JsonDB(dbfile=dbfile, timeout=0.2, operation='test') for i in range(2)]
+        self.assertTrue(all(reader._lock_shared() for reader in readers))
+        self.assertFalse(writer._lock())
+        for reader in readers:
+            reader._release()
+
+        counters, histograms = stats.snapshot()
+        self.assertEquals(counters[('db_lock_timeouts_total',
+                                    (('mode', 'exclusive'), ('operation', 'test')))], 2)
+        self.assertEquals(counters[('db_lock_timeouts_total',
+                                    (('mode', 'shared'), ('operation', 'test')))], 1)
+        self.assertEquals(histograms[('db_lock_hold_seconds',
+                                      (('mode', 'shared'), ('operation', 'test')))]['count'], 2)
+        self.assertEquals(histograms[('db_lock_wait_seconds',
+                                      (('mode', 'exclusive'), ('operation', 'test')))]['count'], 4)
+
+        # Uploads are accounted
+        _file = osjoin(self.testdir, 'test_file')
+        write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        counters, histograms = stats.snapshot()
+        self.assertEquals(histograms[('db_lock_hold_seconds',
+                                      (('mode', 'exclusive'), ('operation', 'upload')))]['count'], 1)
+
+    def test_metrics(self):
+        stats.reset()
+        _file = osjoin(self.testdir, 'test_file')
+        test_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'})
+
+        # Samples of another worker process
+        metrics_folder = flaskr.app.config['METRICS_FOLDER']
+        if not os.path.isdir(metrics_folder):
+            os.makedirs(metrics_folder)
+        json.dump({'counters': [['uploaded_bytes_total', [], 1000]],
+                   'histograms': [['request_duration_seconds',
+                                   [['method', 'GET'], ['route', '/<id_file>'], ['status', '200']],
+                                   {'buckets': [1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+                                    'count': 1, 'sum': 0.0005}]]},
+                  open(osjoin(metrics_folder, 'metrics-999999.json'), 'w'))
+
+        # The gauges come from the totals kept with the cached db
+        with mock.patch.object(JsonDB, 'iteritems', mock.Mock(side_effect=AssertionError)), \
+                mock.patch('pastefile.utils.stored_size', mock.Mock(side_effect=AssertionError)):
+            rv = self.app.get('/metrics', headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.status, '200 OK')
+        self.assertTrue(rv.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = rv.get_data().splitlines()
+        self.assertTrue('# TYPE pastefile_uploaded_bytes_total counter' in lines)
+        self.assertTrue('pastefile_uploaded_bytes_total 3048' in lines)
+        self.assertTrue('pastefile_downloaded_bytes_total 1024' in lines)
+        self.assertTrue('pastefile_dedup_hits_total{source="content"} 1' in lines)
+        self.assertTrue('pastefile_files 1' in lines)
+        self.assertTrue('pastefile_files_bytes 1024' in lines)
+        self.assertTrue('pastefile_request_duration_seconds_count'
+                        '{method="GET",route="/<id_file>",status="200"} 2' in lines)
+        self.assertTrue('pastefile_request_duration_seconds_bucket'
+                        '{method="GET",route="/<id_file>",status="200",le="+Inf"} 2' in lines)
+        self.assertTrue('pastefile_request_duration_seconds_count'
+                        '{method="POST",route="/",status="200"} 2' in lines)
+        self.assertTrue([l for l in lines if l.startswith(
+            'pastefile_db_lock_wait_seconds_count{mode="exclusive",operation="upload"}')])
+        self.assertTrue([l for l in lines if l.startswith(
+            'pastefile_db_load_seconds_count{backend="json"}')])
+        self.assertTrue('pastefile_type_detection_seconds_count 1' in lines)
+
+        # The samples of the exited process are folded, and counted once
+        self.assertEquals(sorted(os.listdir(metrics_folder)),
+                          ['metrics-exited.json', 'metrics.lock'])
+        json.dump({'counters': [['uploaded_bytes_total', [], 500]], 'histograms': []},
+                  open(osjoin(metrics_folder, 'metrics-999999-1.json'), 'w'))
+        rv = self.app.get('/metrics', headers={'User-Agent': 'curl'})
+        self.assertTrue('pastefile_uploaded_bytes_total 3548' in rv.get_data().splitlines())
+        self.assertFalse(os.path.exists(osjoin(metrics_folder, 'metrics-999999-1.json')))
+
+        # The samples of this process are dumped for the others, under an
+        # id a respawned process reusing the pid won't have
+        metrics.dump_process(config=flaskr.app.config, force=True)
+        dump_file = osjoin(metrics_folder, 'metrics-%s.json' % metrics.worker_id())
+        counters, histograms = stats.load(dump_file)
+        self.assertEquals(counters[('uploaded_bytes_total', ())], 2048)
+        self.assertTrue(metrics.worker_id().startswith('%d-' % os.getpid()))
+
+        flaskr.app.config['DISABLED_FEATURE'] = ['metrics']
+        rv = self.app.get('/metrics', headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.get_data(), 'Administrator disabled the /metrics option.\n')
+
     def test_display_feature(self):
         flaskr.app.config['DISPLAY_FOR'] = ['firefox']
 
@@ -200,6 +945,81 @@ class FlaskrTestCase(unittest.TestCase):
         self.assertEquals(rv.get_data(), 'Administrator disabled the delete option.\n')
 
 
+    def test_bulk_infos_and_delete(self):
+        md5s = []
+        for i in range(3):
+            _file = osjoin(self.testdir, 'test_file')
+            md5s.append(write_random_file(_file))
+            self.app.post('/', data={'file': (open(_file, 'r'), 'test-%d.bin' % i),})
+
+        # All from a single snapshot of the db
+        with mock.patch('pastefile.controller.open_db', wraps=controller.open_db) as m:
+            rv = self.app.post('/infos', data=json.dumps(md5s[:2] + ['foobar']),
+                               content_type='application/json')
+            self.assertEquals(m.call_count, 1)
+        infos = json.loads(rv.get_data())
+        self.assertEquals(sorted(infos), sorted(md5s[:2] + ['foobar']))
+        self.assertEquals(infos[md5s[1]]['name'], 'test-1.bin')
+        self.assertEquals(infos['foobar'], None)
+        rv = self.app.post('/infos', data=json.dumps({'ids': md5s}),
+                           content_type='application/json')
+        self.assertEquals(rv.status_code, 400)
+
+        # All in a single transaction
+        with mock.patch('pastefile.controller.JsonDB._lock', mock.Mock(return_value=False)):
+            rv = self.app.post('/delete', data={'id': md5s[:2]})
+        self.assertEquals(rv.status_code, 503)
+        os.remove(osjoin(flaskr.app.config['UPLOAD_FOLDER'], md5s[1]))
+        with mock.patch('pastefile.controller.open_db', wraps=controller.open_db) as m:
+            rv = self.app.post('/delete', data={'id': md5s[:2] + ['foobar']})
+            self.assertEquals(m.call_count, 1)
+        self.assertEquals(json.loads(rv.get_data()), {md5s[0]: 'deleted',
+                                                      md5s[1]: 'deleted',
+                                                      'foobar': 'not found'})
+        self.assertEquals(os.listdir(flaskr.app.config['UPLOAD_FOLDER']), [md5s[2]])
+        self.assertEquals(json.load(open(flaskr.app.config['FILE_LIST'])).keys(), [md5s[2]])
+
+        flaskr.app.config['DISABLED_FEATURE'] = ['delete']
+        rv = self.app.post('/delete', data={'id': md5s[2]})
+        self.assertEquals(rv.get_data(), 'Administrator disabled the delete option.\n')
+
+    def test_archive_download(self):
+        flaskr.app.config['COMPRESS'] = {'text/': 'gzip'}
+        contents = [os.urandom(1024), 'pastefile log line\n' * 1000, os.urandom(1024)]
+        md5s = []
+        for i, content in enumerate(contents):
+            _file = osjoin(self.testdir, 'test_file')
+            md5s.append(write_file(_file, content))
+            data = {'file': (open(_file, 'r'), 'same.log' if i else 'test.bin')}
+            if i == 2:
+                data['burn'] = 'True'
+            self.app.post('/', data=data)
+
+        ids = md5s + ['foobar', md5s[0]]
+        rv = self.app.get('/archive?format=zip&%s' % '&'.join('id=%s' % i for i in ids),
+                          headers={'User-Agent': 'curl'}, buffered=True)
+        self.assertEquals(rv.headers['Content-Type'], 'application/zip')
+        self.assertEquals(int(rv.headers['Content-Length']), len(rv.get_data()))
+        archive = zipfile.ZipFile(StringIO(rv.get_data()))
+        self.assertEquals(archive.namelist(), ['test.bin', 'same.log', '%s-same.log' % md5s[2]])
+        # Compressed files are decompressed
+        self.assertEquals([archive.read(name) for name in archive.namelist()], contents)
+
+        # The burn after read file was burned by the first archive
+        rv = self.app.post('/archive', data=json.dumps(ids),
+                           content_type='application/json', buffered=True)
+        archive = tarfile.open(fileobj=StringIO(rv.get_data()))
+        self.assertEquals(archive.getnames(), ['test.bin', 'same.log'])
+        self.assertEquals(archive.extractfile('same.log').read(), contents[1])
+        rv = self.app.get('/%s' % md5s[2], headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.status, '404 NOT FOUND')
+
+        rv = self.app.get('/archive?id=foobar', headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.status, '404 NOT FOUND')
+        for url in ['/archive', '/archive?format=rar&id=%s' % md5s[0]]:
+            rv = self.app.get(url, headers={'User-Agent': 'curl'})
+            self.assertEquals(rv.status, '400 BAD REQUEST')
+
     def test_clean_files(self):
         # Try to upload 2 file and force one to expire in the db.
         # file 1
@@ -211,8 +1031,9 @@ class FlaskrTestCase(unittest.TestCase):
         file2_md5 = write_random_file(_file2)
         self.app.post('/', data={'file': (open(_file2, 'r'), 'test_pastefile_random2.file'),})
 
-        # Should do nothing, no file expired
-        controller.clean_files(dbfile=flaskr.app.config['FILE_LIST'])
+        # Should do nothing, no file expired. Not even lock the db
+        with mock.patch('pastefile.controller.JsonDB._lock', mock.Mock(side_effect=AssertionError)):
+            self.assertEquals(controller.clean_files(dbfile=flaskr.app.config['FILE_LIST']), 0)
 
         for md5 in [file1_md5, file2_md5]:
             self.assertTrue(os.path.isfile(osjoin(flaskr.app.config['UPLOAD_FOLDER'], md5)))
@@ -238,27 +1059,321 @@ class FlaskrTestCase(unittest.TestCase):
             self.assertFalse(file2_md5 in db.db.keys())
 
 
+    def test_capacity_eviction(self):
+        for backend in ['json', 'sqlite']:
+            flaskr.app.config['DB_BACKEND'] = backend
+            flaskr.app.config['MAX_FILES'] = 3
+            md5s = []
+            for i in range(3):
+                _file = osjoin(self.testdir, 'test_file%s' % i)
+                md5s.append(write_random_file(_file))
+                self.app.post('/', data={'file': (open(_file, 'r'), 'file%s.bin' % i),})
+                with controller.open_db(flaskr.app.config['FILE_LIST'], config=flaskr.app.config) as db:
+                    infos = db.read(md5s[i])
+                    infos['timestamp'] = 1000 + i
+                    db.write(md5s[i], infos)
+            with controller.open_db(flaskr.app.config['FILE_LIST'], config=flaskr.app.config) as db:
+                self.assertEquals(db.usage(), (3 * 1024, 3, 3 * 1024))
+                self.assertEquals(list(db.oldest()), md5s)
+
+            # The oldest file is evicted to store a 4th one
+            _file = osjoin(self.testdir, 'test_file3')
+            md5s.append(write_random_file(_file))
+            rv = self.app.post('/', data={'file': (open(_file, 'r'), 'file3.bin'),})
+            self.assertEquals(rv.get_data(), 'http://localhost/%s\n' % md5s[3])
+            rv = self.app.get('/%s' % md5s[0], headers={'User-Agent': 'curl'})
+            self.assertEquals(rv.status, '404 NOT FOUND')
+            self.assertFalse(os.path.isfile(osjoin(flaskr.app.config['UPLOAD_FOLDER'], md5s[0])))
+
+            # Two more are evicted to stay under MAX_STORAGE_BYTES
+            flaskr.app.config['MAX_FILES'] = None
+            flaskr.app.config['MAX_STORAGE_BYTES'] = 3000
+            write_file(_file, os.urandom(1500))
+            rv = self.app.post('/', data={'file': (open(_file, 'r'), 'file4.bin'),})
+            self.assertTrue(rv.get_data().startswith('http://localhost/'))
+            with controller.open_db(flaskr.app.config['FILE_LIST'], config=flaskr.app.config) as db:
+                self.assertEquals(db.usage(), (1024 + 1500, 2, 1024 + 1500))
+                self.assertTrue(md5s[3] in db)
+
+            # A file bigger than MAX_STORAGE_BYTES is refused
+            write_file(_file, os.urandom(4096))
+            rv = self.app.post('/', data={'file': (open(_file, 'r'), 'big.bin'),})
+            self.assertEquals(rv.get_data(), 'Unable to upload the file, try again later ...\n')
+            rv = self.app.post('/uploads', data={'size': 4096})
+            self.assertEquals(rv.status, '400 BAD REQUEST')
+
+            flaskr.app.config['MAX_STORAGE_BYTES'] = None
+            with controller.open_db(flaskr.app.config['FILE_LIST'], config=flaskr.app.config) as db:
+                for k in list(db.oldest()):
+                    controller.remove_file(db, k, config=flaskr.app.config)
+                self.assertEquals(db.usage(), (0, 0, 0))
+
+    def test_sqlite_usage_migration(self):
+        # A db created before the usage table gets it on first open
+        conn = sqlite3.connect('%s.sqlite' % flaskr.app.config['FILE_LIST'])
+        conn.execute('CREATE TABLE files (md5 TEXT PRIMARY KEY, timestamp INTEGER NOT NULL, '
+                     'infos TEXT NOT NULL)')
+        for md5, infos in [('a' * 32, {'timestamp': 1, 'size': 10}),
+                           ('b' * 32, {'timestamp': 2, 'size': 10, 'stored_size': 4,
+                                       'burn_after_read': 'Burned'})]:
+            conn.execute('INSERT INTO files VALUES (?, ?, ?)', (md5, infos['timestamp'], json.dumps(infos)))
+        conn.execute('PRAGMA user_version = 1')
+        conn.commit()
+        conn.close()
+        flaskr.app.config['DB_BACKEND'] = 'sqlite'
+        with controller.open_db(flaskr.app.config['FILE_LIST'], config=flaskr.app.config) as db:
+            self.assertEquals(db.usage(), (14, 2, 20))
+            self.assertEquals(list(db.oldest()), ['a' * 32, 'b' * 32])
+            # And the index of the burned files
+            self.assertEquals(db.burned(), ['b' * 32])
+            infos = db.read('b' * 32)
+            db.write('b' * 32, dict(infos, burn_after_read='False'))
+            self.assertEquals(db.burned(), [])
+
+    def test_maintenance_thread(self):
+        _file = osjoin(self.testdir, 'test_file')
+        file_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        with JsonDB(dbfile=flaskr.app.config['FILE_LIST']) as db:
+            db.db[file_md5]['timestamp'] = 0
+
+        # Requests don't remove expired files anymore
+        self.app.get('/ls', headers={'User-Agent': 'curl'})
+        self.assertTrue(os.path.isfile(osjoin(flaskr.app.config['UPLOAD_FOLDER'], file_md5)))
+
+        thread = scheduler.MaintenanceThread(config=flaskr.app.config, interval=0.01)
+        thread.start()
+        try:
+            for i in range(100):
+                if not os.path.isfile(osjoin(flaskr.app.config['UPLOAD_FOLDER'], file_md5)):
+                    break
+                thread.join(0.01)
+        finally:
+            thread.stop()
+            thread.join()
+        self.assertFalse(os.path.isfile(osjoin(flaskr.app.config['UPLOAD_FOLDER'], file_md5)))
+
+        # Legacy behaviour, also used when uwsgi does not run the threads
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        with JsonDB(dbfile=flaskr.app.config['FILE_LIST']) as db:
+            db.db[file_md5]['timestamp'] = 0
+        flaskr.app.config['CLEAN_MODE'] = 'thread'
+        with mock.patch('pastefile.scheduler.uwsgi', mock.Mock(opt={'processes': '4'})), \
+                mock.patch('pastefile.scheduler.start_maintenance_thread') as m:
+            for func in flaskr.app.before_first_request_funcs:
+                func()
+            self.assertFalse(m.called)
+        self.assertEquals(flaskr.app.config['CLEAN_MODE'], 'request')
+        self.app.get('/ls', headers={'User-Agent': 'curl'})
+        self.assertFalse(os.path.isfile(osjoin(flaskr.app.config['UPLOAD_FOLDER'], file_md5)))
+        with mock.patch('pastefile.scheduler.uwsgi', mock.Mock(opt={'enable-threads': True})):
+            self.assertTrue(scheduler.threads_enabled())
+
+
     def test_burn_after_read(self):
         # Upload a random file
         _file = osjoin(self.testdir, 'test_file')
         test_md5 = write_random_file(_file)
         rv = self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'), 'burn': 'True',})
 
-        # Try to get the file but can't acquire the lock. Shouldn't not send the file.
+        # Get the file, without rewriting the db. Should send the file.
+        db_mtime = os.stat(flaskr.app.config['FILE_LIST']).st_mtime
         with mock.patch('pastefile.controller.JsonDB._lock', mock.Mock(return_value=False)):
-            rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'})
-        self.assertEquals("Can't lock db for burning file", rv.get_data())
-
-        # Try to get the file with the lock acquired. Should send the file.
-        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'})
-        gotten_file = osjoin(self.testdir, 'gotten_test_file')
-        gotten_test_md5 = write_file(filename=gotten_file, content=rv.get_data())
+            rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'}, buffered=True)
+            gotten_file = osjoin(self.testdir, 'gotten_test_file')
+            gotten_test_md5 = write_file(filename=gotten_file, content=rv.get_data())
         self.assertEquals(test_md5, gotten_test_md5)
+        self.assertEquals(db_mtime, os.stat(flaskr.app.config['FILE_LIST']).st_mtime)
+        # The blob is emptied once sent, until the maintenance
+        claims = osjoin(flaskr.app.config['UPLOAD_FOLDER'], storage.CLAIMS_FOLDER)
+        self.assertEquals(os.listdir(flaskr.app.config['UPLOAD_FOLDER']), [storage.CLAIMS_FOLDER])
+        self.assertEquals([os.stat(osjoin(claims, f)).st_size for f in os.listdir(claims)], [0])
 
         # Try to get the file a second time, shouldn't work and return a 404 since it is 'burned'.
         rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'})
         self.assertEquals(rv.status, '404 NOT FOUND')
+        # /infos only reads the db entry, which is left to the maintenance
+        rv = self.app.get('/%s/infos' % test_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(json.loads(rv.get_data())['burn_after_read'], 'True')
+        rv = self.app.get('/%s/exists' % test_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.status, '404 NOT FOUND')
 
+        # The entry is removed by the maintenance, which only reads the
+        # claimed entries, and the file can be uploaded again
+        with mock.patch.object(JsonDB, 'iteritems', mock.Mock(side_effect=AssertionError)):
+            self.assertEquals(controller.clean_files(dbfile=flaskr.app.config['FILE_LIST'],
+                                                     config=flaskr.app.config), 1)
+        self.assertFalse(test_md5 in json.load(open(flaskr.app.config['FILE_LIST'])))
+        self.assertEquals(os.listdir(claims), [])
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'), 'burn': 'True',})
+        rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(len(rv.get_data()), 1024)
+
+        # Uploaded again before the maintenance, the entry of the file read
+        # is replaced
+        self.app.post('/', data={'file': (open(_file, 'r'), 'again.file'),})
+        rv = self.app.get('/%s/infos' % test_md5, headers={'User-Agent': 'curl'})
+        infos = json.loads(rv.get_data())
+        self.assertEquals((infos['burn_after_read'], infos['name']), ('False', 'again.file'))
+        for i in range(2):
+            rv = self.app.get('/%s' % test_md5, headers={'User-Agent': 'curl'}, buffered=True)
+            self.assertEquals(rv.status_code, 200)
+            self.assertEquals(len(rv.get_data()), 1024)
+        self.assertEquals(controller.clean_files(dbfile=flaskr.app.config['FILE_LIST'],
+                                                 config=flaskr.app.config), 0)
+
+    def test_burn_after_read_concurrency(self):
+        _file = osjoin(self.testdir, 'test_file')
+        test_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'), 'burn': 'True',})
+
+        # Let all the readers load the db before one of them claims the file
+        results = []
+        barrier = threading.Semaphore(0)
+        readers = 10
+        claim = controller._claim_burn
+
+        def wait_and_claim(*args):
+            barrier.acquire()
+            return claim(*args)
+
+        def get():
+            rv = flaskr.app.test_client().get('/%s' % test_md5, headers={'User-Agent': 'curl'},
+                                              buffered=True)
+            results.append((rv.status_code, rv.get_data()))
+
+        with mock.patch('pastefile.controller._claim_burn', side_effect=wait_and_claim):
+            threads = [threading.Thread(target=get) for i in range(readers)]
+            for thread in threads:
+                thread.start()
+            for i in range(readers):
+                barrier.release()
+            for thread in threads:
+                thread.join()
+
+        self.assertEquals(sorted(status for status, data in results), [200] + [404] * (readers - 1))
+        self.assertEquals([len(data) for status, data in results if status == 200], [1024])
+        claims = osjoin(flaskr.app.config['UPLOAD_FOLDER'], storage.CLAIMS_FOLDER)
+        self.assertEquals(os.listdir(flaskr.app.config['UPLOAD_FOLDER']), [storage.CLAIMS_FOLDER])
+        self.assertEquals(len(os.listdir(claims)), 1)
+
+
+
+    def test_sqlite_backend(self):
+        # Upload a file with the json backend
+        _file = osjoin(self.testdir, 'test_file')
+        json_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+        # And one only in the journal
+        flaskr.app.config['DB_JOURNAL'] = True
+        journal_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'journal.file'),})
+        self.assertTrue(os.path.isfile('%s.journal' % flaskr.app.config['FILE_LIST']))
+        flaskr.app.config['DB_JOURNAL'] = False
+
+        # Switch to sqlite, the json db should be imported
+        flaskr.app.config['DB_BACKEND'] = 'sqlite'
+        rv = self.app.get('/%s' % json_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.status, '200 OK')
+        self.assertTrue(os.path.isfile('%s.sqlite' % flaskr.app.config['FILE_LIST']))
+
+        # Upload, list, get infos and delete a new file
+        _file = osjoin(self.testdir, 'test_file_2')
+        sqlite_md5 = write_random_file(_file)
+        rv = self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile2_random.file'),})
+        self.assertEquals(rv.get_data(), "http://localhost/%s\n" % (sqlite_md5))
+        # The json db is left untouched
+        self.assertFalse(sqlite_md5 in json.load(open(flaskr.app.config['FILE_LIST'])))
+
+        rv = self.app.get('/ls', headers={'User-Agent': 'curl'})
+        self.assertEquals(sorted([json_md5, journal_md5, sqlite_md5]),
+                          sorted(json.loads(rv.get_data()).keys()))
+
+        rv = self.app.get('/%s/infos' % sqlite_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(json.loads(rv.get_data())['name'], 'test_pastefile2_random.file')
+
+        rv = self.app.delete('/%s' % sqlite_md5, headers={'User-Agent': 'curl'})
+        self.assertTrue('%s deleted' % sqlite_md5 in rv.get_data())
+        rv = self.app.get('/%s' % sqlite_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.status, '404 NOT FOUND')
+
+        # Expire the imported file
+        with controller.open_db(flaskr.app.config['FILE_LIST'], config=flaskr.app.config) as db:
+            infos = db.read(json_md5)
+            infos['timestamp'] = 0
+            db.write(json_md5, infos)
+        controller.clean_files(dbfile=flaskr.app.config['FILE_LIST'], config=flaskr.app.config)
+        self.assertFalse(os.path.isfile(osjoin(flaskr.app.config['UPLOAD_FOLDER'], json_md5)))
+
+
+    def test_journal_mode(self):
+        flaskr.app.config['DB_JOURNAL'] = True
+        dbfile = flaskr.app.config['FILE_LIST']
+        journal = '%s.journal' % dbfile
+        md5s = []
+        for i in range(2):
+            _file = osjoin(self.testdir, 'test_file%s' % i)
+            md5s.append(write_random_file(_file))
+            self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+
+        # Changes are only appended to the journal
+        self.assertEquals(len(open(journal).readlines()), 2)
+        self.assertFalse(os.path.isfile(dbfile) and open(dbfile).read())
+        rv = self.app.get('/ls', headers={'User-Agent': 'curl'})
+        self.assertEquals(sorted(md5s), sorted(json.loads(rv.get_data()).keys()))
+
+        # A torn last line is ignored, then truncated on next write
+        with open(journal, 'a') as f:
+            f.write('{"op": "delete", "ke')
+        db = JsonDB(dbfile=dbfile, journal=True)
+        db.load()
+        self.assertEquals(sorted(md5s), sorted(db.db.keys()))
+        rv = self.app.delete('/%s' % md5s[0], headers={'User-Agent': 'curl'})
+        lines = open(journal).readlines()
+        self.assertEquals(len(lines), 3)
+        self.assertEquals(json.loads(lines[-1]), {'op': 'delete', 'key': md5s[0]})
+
+        # Compaction folds the journal into the snapshot
+        self.assertTrue(JsonDB(dbfile=dbfile, journal=True).compact())
+        self.assertEquals(open(journal).read(), '')
+        self.assertEquals([md5s[1]], json.load(open(dbfile)).keys())
+
+        # Without journal, a save drops the journal
+        flaskr.app.config['DB_JOURNAL'] = False
+        self.app.delete('/%s' % md5s[1], headers={'User-Agent': 'curl'})
+        self.assertFalse(os.path.exists(journal))
+        self.assertEquals({}, json.load(open(dbfile)))
+
+
+    def test_db_cache(self):
+        def cache_stats(result):
+            return stats.snapshot()[0].get(('db_cache_total', (('result', result),)), 0)
+        _file = osjoin(self.testdir, 'test_file')
+        file_md5 = write_random_file(_file)
+        self.app.post('/', data={'file': (open(_file, 'r'), 'test_pastefile_random.file'),})
+
+        # Once loaded, the db is not parsed again until modified
+        self.app.get('/%s/infos' % file_md5, headers={'User-Agent': 'curl'})
+        hits, misses = cache_stats('hit'), cache_stats('miss')
+        for i in range(3):
+            rv = self.app.get('/%s/infos' % file_md5, headers={'User-Agent': 'curl'})
+            self.assertEquals(rv.status, '200 OK')
+        self.assertEquals(cache_stats('hit'), hits + 3)
+        self.assertEquals(cache_stats('miss'), misses)
+
+        # A change done by another process is seen
+        with JsonDB(dbfile=flaskr.app.config['FILE_LIST']) as db:
+            db.db[file_md5]['real_name'] = 'renamed'
+        rv = self.app.get('/%s/infos' % file_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(json.loads(rv.get_data())['name'], 'renamed')
+        self.assertEquals(cache_stats('miss'), misses + 1)
+
+        # Modifying a cached db does not alter the cache
+        db = JsonDB(dbfile=flaskr.app.config['FILE_LIST'], cache=True)
+        db.load()
+        db.delete(file_md5)
+        rv = self.app.get('/%s/infos' % file_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(rv.status, '200 OK')
 
 
     def test_check_db_consistency(self):
@@ -289,8 +1404,29 @@ class FlaskrTestCase(unittest.TestCase):
         self.assertEquals(rv_json['md5'], file_md5)
         self.assertEquals(rv_json['name'], 'test_pastefile_random.file')
 
-        # Try to get info on a file only in DB. (not on disk). Should return false
+        # Size is stored in the db, infos don't touch the disk
+        self.assertEquals(rv_json['size'], utils.human_readable(1024))
+        real_stat = os.stat
+        def stat(path):
+            self.assertFalse(path.startswith(flaskr.app.config['UPLOAD_FOLDER']))
+            return real_stat(path)
+        with mock.patch('os.stat', stat):
+            rv = self.app.get('/%s/infos' % file_md5, headers={'User-Agent': 'curl'})
+            self.assertEquals(rv.status, '200 OK')
+            rv = self.app.get('/ls', headers={'User-Agent': 'curl'})
+            self.assertEquals(json.loads(rv.get_data())[file_md5]['name'], 'test_pastefile_random.file')
+
+        # Entries of older versions have no size, backfill it
+        with JsonDB(dbfile=flaskr.app.config['FILE_LIST']) as db:
+            del db.db[file_md5]['size']
+        rv = self.app.get('/%s/infos' % file_md5, headers={'User-Agent': 'curl'})
+        self.assertEquals(json.loads(rv.get_data())['size'], utils.human_readable(1024))
+        self.assertEquals(controller.backfill_files(dbfile=flaskr.app.config['FILE_LIST']), 1)
+        self.assertEquals(json.load(open(flaskr.app.config['FILE_LIST']))[file_md5]['size'], 1024)
+
+        # Try to get info on a file only in DB. (not on disk). Should return false once the db is purged
         os.remove(osjoin(flaskr.app.config['UPLOAD_FOLDER'], file_md5))
+        controller.db_purge(dbfile=flaskr.app.config['FILE_LIST'])
         rv = self.app.get('/%s/infos' % file_md5, headers={'User-Agent': 'curl'})
         self.assertEquals(rv.status, '404 NOT FOUND')
 
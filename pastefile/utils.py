@@ -3,12 +3,47 @@
 
 import hashlib
 import os
+import sys
+import time
+import zlib
+import tarfile
 import tempfile
 import logging
+import threading
+import magic
 from functools import partial
+from pastefile import stats
+
+try:
+    # blake2 is in hashlib since python 3.6
+    import pyblake2
+except ImportError:
+    pyblake2 = None
 
 LOG = logging.getLogger(__name__)
 
+# Bytes of the uploaded file kept in memory for the type detection,
+# the same amount libmagic reads by default from a file
+HEAD_SIZE = 2**20
+
+# Size in bytes of the blake2 digests, see new_hash
+BLAKE2_DIGEST_SIZE = 32
+
+# libmagic handles can't be shared between threads, each thread keeps its own
+_MAGIC = threading.local()
+
+# Runs the blocking work of the requests (db locks and parsing, type
+# detection, compression, moving files), see run_blocking. Set by the gevent
+# server (pastefile.asyncserver) to its pool of threads
+BLOCKING_RUNNER = None
+
+
+def run_blocking(func, *args, **kwargs):
+    "Call func, with BLOCKING_RUNNER if any, and return its result"
+    if BLOCKING_RUNNER is None:
+        return func(*args, **kwargs)
+    return BLOCKING_RUNNER(func, args, kwargs)
+
 
 def build_base_url(env):
     """Build a base url from an app environment.
@@ -26,28 +61,162 @@ def human_readable(size):
     return "%.2f%s" % (size, 'Y')
 
 
-def get_md5(filename, chunksize=2**15, bufsize=-1):
-    "Return md5sum of a file"
-    _sum = hashlib.md5()
-    with open(filename, 'rb', bufsize) as f:
+def stored_size(infos):
+    "Bytes of a stored file from its db entry, compressed files are smaller"
+    return int(infos.get('stored_size', infos.get('size', 0)))
+
+
+def new_hash(algorithm='md5'):
+    """Return a new hash object of the HASH_ALGORITHM algorithm: any of
+       hashlib (md5, sha1, sha256...), or blake2b and blake2s, cut to
+       BLAKE2_DIGEST_SIZE bytes to keep the ids short.
+       Raise ValueError if the algorithm is not supported"""
+    if algorithm in ('blake2b', 'blake2s'):
+        module = hashlib if hasattr(hashlib, algorithm) else pyblake2
+        if module is None:
+            raise ValueError('%s needs the pyblake2 module' % algorithm)
+        return getattr(module, algorithm)(digest_size=BLAKE2_DIGEST_SIZE)
+    return hashlib.new(algorithm)
+
+
+def get_digest(filename, algorithm='md5', chunksize=2**20):
+    "Return the hex digest of a file"
+    _sum = new_hash(algorithm)
+    with open(filename, 'rb') as f:
         for chunk in iter(partial(f.read, chunksize), b''):
             _sum.update(chunk)
     return _sum.hexdigest()
 
 
-def write_tmpfile_to_disk(file, dest_dir):
-    "Write file from request to a specific location and return the md5"
+def get_md5(filename):
+    "Return md5sum of a file"
+    return get_digest(filename, 'md5')
+
+
+def _magic_handles():
+    "Return the (mime, description) libmagic handles of the current thread"
+    handles = getattr(_MAGIC, 'handles', None)
+    if handles is None:
+        handles = _MAGIC.handles = (magic.Magic(mime=True), magic.Magic())
+    return handles
+
+
+def get_file_type(head):
+    "Return the mime type and the description of a file from its first bytes"
+    if not head:
+        # Keep what libmagic says about an empty file
+        return 'inode/x-empty', 'empty'
+    start = time.time()
+    mime, description = _magic_handles()
+    file_type = mime.from_buffer(head), description.from_buffer(head)
+    stats.observe('type_detection_seconds', time.time() - start)
+    return file_type
+
+
+class SpooledUpload(object):
+    """Writable file receiving an upload: while it is received, the content
+    is written to a temporary file in dest_dir, hashed with algorithm, and
+    its first bytes are kept for the type detection, until release_head.
+    The temporary file is removed on close unless it was detached."""
+
+    def __init__(self, dest_dir, head_size=HEAD_SIZE, algorithm='md5'):
+        fd, self.name = tempfile.mkstemp(prefix='processing-', dir=dest_dir)
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = new_hash(algorithm)
+        self._head_size = head_size
+        self._detached = False
+        self.head = b''
+        self.file_type = None
+        self.size = 0
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def write(self, data):
+        self._file.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+        if self.head is not None and len(self.head) < self._head_size:
+            self.head += data[:self._head_size - len(self.head)]
+
+    def release_head(self):
+        "Detect the type of the complete file, see get_file_type, and release its first bytes"
+        self.file_type = get_file_type(self.head)
+        self.head = None
+
+    def detach(self):
+        """Close the file and return digest, filename, first bytes (None if
+           released) and size. The caller now owns the file"""
+        self._file.close()
+        self._detached = True
+        return self._hash.hexdigest(), self.name, self.head, self.size
+
+    def close(self):
+        self._file.close()
+        if self._detached:
+            return
+        try:
+            os.remove(self.name)
+        except OSError:
+            pass
+
+
+def write_tmpfile_to_disk(file, dest_dir, chunksize=2**16, algorithm='md5'):
+    """Write file from request to a specific location and return the digest,
+       the location, the first bytes and the size of the file"""
 
     if not file:
         raise IOError('No file')
 
-    fd, tmp_full_filename = tempfile.mkstemp(prefix='processing-',
-                                             dir=dest_dir)
-    os.close(fd)
+    # Already written and hashed while the request was parsed
+    if isinstance(file.stream, SpooledUpload):
+        return file.stream.detach()
+
+    upload = None
     try:
-        file.save(tmp_full_filename)
-    except IOError as e:
+        upload = SpooledUpload(dest_dir=dest_dir, algorithm=algorithm)
+        for chunk in iter(partial(file.stream.read, chunksize), b''):
+            upload.write(chunk)
+    except (IOError, OSError) as e:
         LOG.error("Can't save tmp file: %s" % e)
+        if upload is not None:
+            upload.close()
         raise IOError(e)
-    file_md5 = get_md5(tmp_full_filename)
-    return file_md5, tmp_full_filename
+    return upload.detach()
+
+
+def write_tar_members_to_disk(filename, dest_dir, chunksize=2**16, algorithm='md5'):
+    """Unpack the regular files of a tar archive, compressed or not, in
+       dest_dir. Return the name, the digest, the location, the type (see
+       get_file_type) and the size of each file. The type is detected while
+       unpacking, so that the first bytes of every file are not kept. Raise
+       tarfile.TarError if the archive is invalid"""
+    members = []
+    try:
+        with tarfile.open(filename, 'r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                upload = SpooledUpload(dest_dir=dest_dir, algorithm=algorithm)
+                try:
+                    f = tar.extractfile(member)
+                    for chunk in iter(partial(f.read, chunksize), b''):
+                        upload.write(chunk)
+                except:
+                    upload.close()
+                    raise
+                digest, location, head, size = upload.detach()
+                members.append((os.path.basename(member.name), digest, location,
+                                get_file_type(head), size))
+    except:
+        for member in members:
+            try:
+                os.remove(member[2])
+            except OSError:
+                pass
+        error = sys.exc_info()[1]
+        if isinstance(error, zlib.error):
+            # Corrupted gzip stream
+            raise tarfile.ReadError(str(error))
+        raise
+    return members
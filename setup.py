@@ -9,5 +9,7 @@ setup(name='pastefile',
       author_email='guillaume@abrioux.info',
       url='https://github.com/guits/pastefile',
       packages=['pastefile'],
-      scripts=['pastefile-run.py'],
+      scripts=['pastefile-run.py', 'pastefile-admin.py', 'pastefile-gevent.py'],
+      # pastefile-gevent.py
+      extras_require={'gevent': ['gevent']},
      )